@@ -1,16 +1,26 @@
 import argparse
-import subprocess
+import sys
 
 from pathlib import Path
 
+from job_runner import add_runner_args, runner_from_args, CPU
+from pair_files import add_pairing_args
+import tracing
+
 def main():
     parser = argparse.ArgumentParser(description="Use alass to synchronize a batch of subtitles.")
     parser.add_argument('sync_path', type=str, help="Path to in-sync subtitles")
     parser.add_argument('oos_path', type=str, help="Path to out-of-sync subtitles")
     parser.add_argument('-g', '--guess-framerate', default=False, type=bool, action=argparse.BooleanOptionalAction, help="enables guessing and correcting of framerate differences between reference file and input file")
     parser.add_argument('-s', '--split', default=True, type=bool, action=argparse.BooleanOptionalAction, help="synchronize subtitles by looking for splits/breaks")
+    parser.add_argument('--pair-by', choices=("name", "content"), default="name",
+        help="Pair subtitles by sorted file name, or by comparing their cue timelines so that differently named or missing files are caught before syncing.")
+    add_pairing_args(parser)
+    add_runner_args(parser)
+    tracing.add_trace_args(parser)
 
     args = parser.parse_args()
+    tracing.start(args.trace)
 
     synced_path = Path(args.sync_path)
     oos_path = Path(args.oos_path)
@@ -18,20 +28,32 @@ def main():
     synced_files = sorted(list(synced_path.glob("*.srt")))
     oos_files = sorted(list(oos_path.glob("*.srt")))
 
-    assert len(synced_files) == len(oos_files), f"Mismatched number of files, found {len(synced_files)} in-sync subtitles and {len(oos_files)} out-of-sync subtitles."
+    if args.pair_by == "content":
+        # Pairing by content needs numpy, which is only imported when it is used
+        from pair_files import pair_files, verified_pairs
+
+        pairs = verified_pairs(pair_files(synced_files, oos_files, args), oos_files)
+    else:
+        assert len(synced_files) == len(oos_files), f"Mismatched number of files, found {len(synced_files)} in-sync subtitles and {len(oos_files)} out-of-sync subtitles."
+        pairs = list(zip(synced_files, oos_files))
+
+    with runner_from_args(args) as runner:
+        for i, (synced_file, oos_file) in enumerate(pairs):
+            print(f"Syncing {oos_file.name} to {synced_file.name},  {i + 1} of {len(synced_files)}")
+            out_name = synced_file.stem + "-synced" + synced_file.suffix
 
-    for i, (synced_file, oos_file) in enumerate(zip(synced_files, oos_files)):
-        print(f"Syncing {oos_file.name} to {synced_file.name},  {i + 1} of {len(synced_files)}")
-        out_name = synced_file.stem + "-synced" + synced_file.suffix
+            cmd = ["alass", synced_file, oos_file, out_name]
 
-        cmd = ["alass", synced_file, oos_file, out_name]
+            if not args.guess_framerate:
+                cmd.append("-g")
+            if not args.split:
+                cmd.append("-l")
 
-        if not args.guess_framerate:
-            cmd.append("-g")
-        if not args.split:
-            cmd.append("-l")
+            # alass loads both subtitle files into memory, so it is only limited by CPU
+            runner.submit(synced_file.stem, runner.run, cmd, [CPU])
 
-        subprocess.run(cmd, check=True)
+        if runner.wait():
+            sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Stand-in for the external tools run by the batch scripts. The benchmark harness puts a wrapper named after each tool on
+# PATH that runs this script with the tool name as the first argument. Each run reads its inputs, burns CPU time and
+# writes its outputs as configured for the tool in BENCH_PROFILE, then appends a record of the run to BENCH_LOG.
+
+import json
+import os
+import sys
+import time
+
+
+CHUNK_SIZE = 1024 ** 2
+MB = 1024 ** 2
+DEFAULT = {'cpu': 0.0, 'read_mb': None, 'write_mb': 0}
+
+
+def main():
+    tool, args = sys.argv[1], sys.argv[2:]
+    profile = json.loads(os.environ.get("BENCH_PROFILE", "{}"))
+    subcommand, inputs, outputs = TOOLS.get(tool, generic)(args)
+    name = f"{tool} {subcommand}" if subcommand else tool
+    config = {**DEFAULT, **profile.get(tool, {}), **profile.get(name, {})}
+
+    start = time.time()
+    read = sum(read_file(path, config['read_mb']) for path in inputs)
+    burn_cpu(config['cpu'])
+    # A write size of null writes as much as was read, like a remux
+    write_size = read if config['write_mb'] is None else int(config['write_mb'] * MB)
+    for path in outputs:
+        write_file(path, write_size)
+    end = time.time()
+
+    if tool == "ffprobe":
+        # remove_cc only checks whether the first video stream has closed captions
+        print(os.environ.get("BENCH_CLOSED_CAPTIONS", "1"))
+
+    log = os.environ.get("BENCH_LOG")
+    if log:
+        record = {'tool': name, 'start': start, 'end': end, 'read': read, 'written': write_size * len(outputs), 'pid': os.getpid()}
+        # Appends of a single short line are atomic, so concurrent fakes do not need a lock
+        with open(log, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def read_file(path, limit_mb):
+    """
+    Read up to limit_mb from path, or all of it if limit_mb is None. Named pipes are always read until they are closed.
+    """
+    limit = None if limit_mb is None or not os.path.isfile(path) else int(limit_mb * MB)
+    total = 0
+    with open(path, "rb") as f:
+        while limit is None or total < limit:
+            chunk = f.read(CHUNK_SIZE if limit is None else min(CHUNK_SIZE, limit - total))
+            if not chunk:
+                break
+            total += len(chunk)
+    return total
+
+
+def write_file(path, size):
+    chunk = bytes(CHUNK_SIZE)
+    with open(path, "wb") as f:
+        for offset in range(0, size, CHUNK_SIZE):
+            f.write(chunk[:min(CHUNK_SIZE, size - offset)])
+
+
+def burn_cpu(seconds):
+    # CPU time rather than wall time, so that fakes competing for cores take longer like the real tools would
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+
+def existing(paths):
+    return [path for path in paths if os.path.exists(path)]
+
+
+def option_values(args, *options):
+    return [args[i + 1] for i, arg in enumerate(args[:-1]) if arg in options]
+
+
+def mkvmerge(args):
+    outputs = option_values(args, "-o", "--output")
+    return None, [path for path in existing(args) if path not in outputs], outputs
+
+
+def mkvpropedit(args):
+    # Only the header is edited in place
+    return None, [], []
+
+
+def mkvextract(args):
+    mode = args[1] if len(args) > 1 else None
+    if mode == "tracks":
+        outputs = [arg.split(":", 1)[1] for arg in args[2:] if ":" in arg]
+    else:
+        outputs = args[2:3]
+    return mode, args[:1], outputs
+
+
+def ffmpeg(args):
+    outputs = [args[-1]] if args and not args[-1].startswith("-") else []
+    return None, option_values(args, "-i"), outputs
+
+
+def ffprobe(args):
+    return None, [], []
+
+
+def dovi_tool(args):
+    # Global options such as -m 3 come before the subcommand
+    i = 0
+    while i < len(args) and args[i].startswith("-"):
+        i += 2
+    subcommand, rest = args[i], args[i + 1:]
+    inputs = option_values(rest, "-i", "--input", "--rpu-in", "-j", "--json")
+    if rest and not rest[0].startswith("-"):
+        inputs.append(rest[0])
+    return subcommand, existing(inputs), option_values(rest, "-o", "--output")
+
+
+def alass(args):
+    positional = [arg for arg in args if not arg.startswith("-")]
+    return None, existing(positional[:2]), positional[2:3]
+
+
+def generic(args):
+    return None, existing(args), []
+
+
+TOOLS = {
+    'mkvmerge': mkvmerge,
+    'mkvpropedit': mkvpropedit,
+    'mkvextract': mkvextract,
+    'ffmpeg': ffmpeg,
+    'ffprobe': ffprobe,
+    'dovi_tool': dovi_tool,
+    'alass': alass,
+}
+
+
+if __name__ == "__main__":
+    main()
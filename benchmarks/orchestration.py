@@ -0,0 +1,355 @@
+import argparse
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+REPO = Path(__file__).resolve().parent.parent
+BENCHMARKS = Path(__file__).resolve().parent
+FAKE_TOOL = BENCHMARKS / "fake_tool.py"
+FAKE_MODULES = BENCHMARKS / "fake_modules"
+TOOLS = ("mkvmerge", "mkvpropedit", "mkvextract", "ffmpeg", "ffprobe", "dovi_tool", "alass")
+
+MB = 1024 ** 2
+SAMPLE_INTERVAL = 0.05
+
+# Per tool CPU seconds, MB read from each input (null for all of it) and MB written to each output (null for as much as
+# was read). Keys with a subcommand override the tool's entry.
+DEFAULT_PROFILE = {
+    'mkvmerge': {'cpu': 0.3, 'read_mb': None, 'write_mb': None},
+    'mkvpropedit': {'cpu': 0.02},
+    'mkvextract': {'cpu': 0.1, 'read_mb': None, 'write_mb': None},
+    'ffmpeg': {'cpu': 0.3, 'read_mb': None, 'write_mb': None},
+    'ffprobe': {'cpu': 0.05, 'read_mb': 1},
+    'dovi_tool': {'cpu': 0.2, 'read_mb': None, 'write_mb': 1},
+    'dovi_tool inject-rpu': {'cpu': 0.4, 'read_mb': None, 'write_mb': None},
+    'dovi_tool editor': {'cpu': 0.01, 'write_mb': 1},
+    'alass': {'cpu': 0.5, 'read_mb': None, 'write_mb': 0.1},
+}
+
+VIDEO_TRACK = {
+    'track_type': "Video", 'track_id': 1, 'format': "HEVC", 'codec_id': "V_MPEGH/ISO/HEVC", 'width': 3840, 'height': 2160,
+    'frame_rate': "23.976", 'framerate_num': "24000", 'framerate_den': "1001", 'frame_count': "34000", 'duration': 1418084.0,
+    'hdr_format_profile': None, 'mastering_display_luminance': "min: 0.0050 cd/m2, max: 1000 cd/m2",
+    'maximum_content_light_level': "1000 cd/m2", 'maximum_frameaverage_light_level': "400 cd/m2",
+}
+AUDIO_TRACK = {'track_type': "Audio", 'track_id': 2, 'format': "MLP FBA", 'codec_id': "A_TRUEHD", 'language': "en", 'compression_mode': "Lossless", 'channel_s': 8}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the orchestration of the batch tools with fake external tools and MediaInfo.",
+        epilog="Arguments after -- are passed to every tool being benchmarked, such as --jobs or --max-writes.")
+    parser.add_argument('scenarios', type=str, nargs='*', default=list(SCENARIOS), help=f"Scenarios to run, any of {', '.join(SCENARIOS)}.")
+    parser.add_argument('--files', '-n', type=int, default=8, help="Number of files in each batch.")
+    parser.add_argument('--size', type=float, default=32, help="Size in MB of each input media file.")
+    parser.add_argument('--profile', type=str, help="JSON file with tool settings that override the defaults, in the format of DEFAULT_PROFILE.")
+    parser.add_argument('--repeat', type=int, default=1, help="Number of times to run each scenario.")
+    parser.add_argument('--workdir', type=str, help="Directory to create the fake media in, defaults to a temporary directory.")
+    parser.add_argument('--json', type=str, metavar='PATH', help="Also write the results to PATH as JSON.")
+    parser.add_argument('--show-output', action='store_true', help="Show the output of the tools being benchmarked.")
+
+    argv = sys.argv[1:]
+    split = argv.index("--") if "--" in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    tool_args = argv[split + 1:]
+
+    profile = dict(DEFAULT_PROFILE)
+    if args.profile:
+        with open(args.profile) as f:
+            profile.update(json.load(f))
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    assert not unknown, f"Unknown scenarios: {', '.join(sorted(unknown))}"
+
+    results = []
+    for name in args.scenarios:
+        for _ in range(args.repeat):
+            with tempfile.TemporaryDirectory(prefix=f"bench_{name}_", dir=args.workdir) as workdir:
+                result = run_scenario(name, Path(workdir), args.files, args.size, profile, tool_args, args.show_output)
+            results.append(result)
+            print_result(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def run_scenario(name, workdir, files, size, profile, tool_args=(), show_output=False):
+    """
+    Create the fake media for a scenario in workdir, run its tool against it and return the measurements.
+    """
+    bin_dir = workdir / "bin"
+    bin_dir.mkdir()
+    for tool in TOOLS:
+        wrapper = bin_dir / tool
+        wrapper.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_TOOL}" {tool} "$@"\n')
+        wrapper.chmod(0o755)
+
+    # Tool arguments can refer to the scenario's directory, such as a scratch directory whose use should be measured
+    tool_args = [arg.replace("{workdir}", str(workdir)) for arg in tool_args]
+    mediainfo = {}
+    cmd, cwd = SCENARIOS[name](workdir, files, int(size * MB), mediainfo)
+    (workdir / "mediainfo.json").write_text(json.dumps(mediainfo))
+    log = workdir / "tools.jsonl"
+    log.touch()
+
+    env = dict(os.environ)
+    env.update({
+        'PATH': os.pathsep.join([str(bin_dir), env.get('PATH', "")]),
+        'PYTHONPATH': os.pathsep.join([str(FAKE_MODULES), str(REPO)]),
+        'BENCH_PROFILE': json.dumps(profile),
+        'BENCH_LOG': str(log),
+        'BENCH_MEDIAINFO': str(workdir / "mediainfo.json"),
+        'MEDIA_UTILS_LEDGER': str(workdir / "ledger.db"),
+    })
+
+    monitor = DiskMonitor(workdir, exclude=[bin_dir, log])
+    output = None if show_output else subprocess.DEVNULL
+    start = time.time()
+    with monitor:
+        process = subprocess.run([sys.executable, REPO / "media_utils.py", name, *cmd, *tool_args], cwd=cwd, env=env, stdout=output, stderr=output)
+    end = time.time()
+
+    with open(log) as f:
+        events = [json.loads(line) for line in f]
+    return summarize(name, files, start, end, events, monitor, process.returncode)
+
+
+def summarize(name, files, start, end, events, monitor, returncode):
+    wall = end - start
+    busy = union_length([(event['start'], event['end']) for event in events])
+    concurrency = concurrency_profile(events)
+    tools = {}
+    for event in events:
+        stats = tools.setdefault(event['tool'], {'runs': 0, 'seconds': 0.0})
+        stats['runs'] += 1
+        stats['seconds'] += event['end'] - event['start']
+    return {
+        'scenario': name,
+        'files': files,
+        'returncode': returncode,
+        'wall_s': wall,
+        'per_file_s': wall / files,
+        # Time during which no external tool was running is spent in Python: startup, probing and scheduling
+        'overhead_per_file_s': (wall - busy) / files,
+        'mean_concurrency': sum(event['end'] - event['start'] for event in events) / wall,
+        'max_concurrency': max(concurrency, default=0),
+        'read_mb': sum(event['read'] for event in events) / MB,
+        'written_mb': sum(event['written'] for event in events) / MB,
+        'scratch_peak_mb': monitor.scratch_peak / MB,
+        'disk_peak_mb': monitor.disk_peak / MB,
+        'tools': tools,
+    }
+
+
+def union_length(intervals):
+    total = 0.0
+    end = float("-inf")
+    for interval_start, interval_end in sorted(intervals):
+        if interval_end > end:
+            total += interval_end - max(interval_start, end)
+            end = interval_end
+    return total
+
+
+def concurrency_profile(events):
+    """
+    Number of tools running after each start or end of a tool, in order.
+    """
+    changes = sorted([(event['start'], 1) for event in events] + [(event['end'], -1) for event in events])
+    running = 0
+    counts = []
+    for _, change in changes:
+        running += change
+        counts.append(running)
+    return counts
+
+
+class DiskMonitor:
+    """
+    Samples the disk space used by each file under a directory in a background thread. scratch_peak is the most space
+    used at once by files that were created while monitoring and are gone by the end, such as extracted streams and
+    outputs that are moved into place, and disk_peak the most space used by all files that were created.
+    """
+
+    def __init__(self, path, exclude=()):
+        self.path = Path(path)
+        self.exclude = {Path(p) for p in exclude}
+        self.samples = []
+        self.scratch_peak = 0
+        self.disk_peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self.baseline = set(self.usage())
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        remaining = set(self.usage())
+        for sample in self.samples:
+            created = {path: size for path, size in sample.items() if path not in self.baseline}
+            self.disk_peak = max(self.disk_peak, sum(created.values()))
+            self.scratch_peak = max(self.scratch_peak, sum(size for path, size in created.items() if path not in remaining))
+
+    def usage(self):
+        sizes = {}
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = [d for d in dirs if Path(root, d) not in self.exclude]
+            for name in files:
+                path = Path(root, name)
+                if path in self.exclude:
+                    continue
+                try:
+                    sizes[path] = os.stat(path).st_blocks * 512
+                except FileNotFoundError:
+                    # Files come and go while the tools run
+                    pass
+        return sizes
+
+    def _sample(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            self.samples.append(self.usage())
+
+
+def print_result(result):
+    print(f"{result['scenario']}: {result['files']} files in {result['wall_s']:.2f}s"
+        + (f" (exited with status {result['returncode']})" if result['returncode'] else ""))
+    print(f"  per file {result['per_file_s']:.3f}s, orchestration overhead per file {result['overhead_per_file_s']:.3f}s")
+    print(f"  concurrency mean {result['mean_concurrency']:.2f}, max {result['max_concurrency']}")
+    print(f"  read {result['read_mb']:.0f} MB, written {result['written_mb']:.0f} MB, scratch peak {result['scratch_peak_mb']:.0f} MB, "
+        f"new files peak {result['disk_peak_mb']:.0f} MB")
+    for tool, stats in sorted(result['tools'].items()):
+        print(f"  {tool:<24} {stats['runs']:>4} runs {stats['seconds']:>8.2f}s")
+
+
+# Scenarios create their inputs under workdir, add the MediaInfo response of each media file to mediainfo and return
+# the arguments of the tool and the directory to run it in.
+
+def merge_subs_scenario(workdir, files, size, mediainfo):
+    source = make_dir(workdir / "source")
+    out = make_dir(workdir / "out")
+    for i in range(files):
+        write_mkv(source / f"Movie {i:03}.mkv", size)
+        write_srt(source / f"Movie {i:03}.srt", i)
+    return [out], source
+
+
+def remove_cc_scenario(workdir, files, size, mediainfo):
+    source = make_dir(workdir / "source")
+    out = make_dir(workdir / "out")
+    for i in range(files):
+        write_mkv(source / f"Episode {i:03}.mkv", size)
+    return [source, "--output-dir", out], workdir
+
+
+def dv_hybrid_scenario(workdir, files, size, mediainfo):
+    dv = make_dir(workdir / "dv")
+    hdr10 = make_dir(workdir / "hdr10")
+    scratch = make_dir(workdir / "scratch")
+    for i in range(files):
+        write_mkv(dv / f"Movie {i:03}.mkv", size)
+        write_mkv(hdr10 / f"Movie {i:03}.mkv", size)
+        mediainfo[str(dv / f"Movie {i:03}.mkv")] = [{**VIDEO_TRACK, 'hdr_format_profile': "dvhe.05"}]
+        mediainfo[str(hdr10 / f"Movie {i:03}.mkv")] = [VIDEO_TRACK, AUDIO_TRACK]
+    return [dv, hdr10], scratch
+
+
+def merge_hybrid_scenario(workdir, files, size, mediainfo):
+    source = make_dir(workdir / "source")
+    out = make_dir(workdir / "out")
+    for i in range(files):
+        write_mkv(source / f"Movie {i:03}.mkv", size)
+        write_file(source / f"Movie {i:03}_injected.hevc", size)
+    return [out], source
+
+
+def alass_batch_scenario(workdir, files, size, mediainfo):
+    synced = make_dir(workdir / "synced")
+    unsynced = make_dir(workdir / "unsynced")
+    out = make_dir(workdir / "out")
+    for i in range(files):
+        write_srt(synced / f"Episode {i:03}.srt", i)
+        write_srt(unsynced / f"Episode {i:03}.srt", i, offset=2.5)
+    return [synced, unsynced], out
+
+
+SCENARIOS = {
+    'merge_subs': merge_subs_scenario,
+    'remove_cc': remove_cc_scenario,
+    'dv_hybrid': dv_hybrid_scenario,
+    'merge_hybrid': merge_hybrid_scenario,
+    'alass_batch': alass_batch_scenario,
+}
+
+
+def make_dir(path):
+    path.mkdir(parents=True)
+    return path
+
+
+def write_file(path, size):
+    chunk = bytes(MB)
+    with open(path, "wb") as f:
+        for offset in range(0, size, MB):
+            f.write(chunk[:min(MB, size - offset)])
+
+
+def write_srt(path, seed, offset=0.0, cues=400):
+    lines = []
+    for i in range(cues):
+        start = offset + i * 6 + (seed * 7 + i * 13) % 5
+        lines.append(f"{i + 1}\n{srt_time(start)} --> {srt_time(start + 2)}\nLine {i}\n")
+    path.write_text("\n".join(lines))
+
+
+def srt_time(seconds):
+    ms = int(seconds * 1000)
+    return f"{ms // 3600000:02}:{ms // 60000 % 60:02}:{ms // 1000 % 60:02},{ms % 1000:03}"
+
+
+def write_mkv(path, size):
+    """
+    Write a Matroska file with an HEVC video, a lossless English audio and a forced English PGS subtitle track, padded with
+    a Void element to size bytes. mkv_probe can read it, while the fake tools only care about its size.
+    """
+    tracks = element(0x1654AE6B,
+        element(0xAE, element(0xD7, 1) + element(0x73C5, 1) + element(0x83, 1) + element(0x86, "V_MPEGH/ISO/HEVC")
+            + element(0xE0, element(0xB0, 3840) + element(0xBA, 2160)))
+        + element(0xAE, element(0xD7, 2) + element(0x73C5, 2) + element(0x83, 2) + element(0x86, "A_TRUEHD")
+            + element(0x22B59C, "eng") + element(0xE1, element(0x9F, 8)))
+        + element(0xAE, element(0xD7, 3) + element(0x73C5, 3) + element(0x83, 17) + element(0x86, "S_HDMV/PGS")
+            + element(0x22B59C, "eng") + element(0x55AA, 1) + element(0x536E, "Forced"))
+    )
+    info = element(0x1549A966, element(0x2AD7B1, 1000000) + element(0x4489, struct.pack(">d", 1418084.0)))
+    header = element(0x1A45DFA3, element(0x4282, "matroska"))
+    # Segment of unknown size, so that the padding does not need to be counted
+    segment = bytes.fromhex("18538067") + bytes.fromhex("01ffffffffffffff") + info + tracks
+    used = len(header) + len(segment)
+    padding = max(0, size - used - 9)
+    with open(path, "wb") as f:
+        f.write(header + segment + bytes([0xEC]) + (0x0100000000000000 | padding).to_bytes(8, "big"))
+        chunk = bytes(MB)
+        for offset in range(0, padding, MB):
+            f.write(chunk[:min(MB, padding - offset)])
+
+
+def element(element_id, body):
+    if isinstance(body, int):
+        body = body.to_bytes(max(1, (body.bit_length() + 7) // 8), "big")
+    elif isinstance(body, str):
+        body = body.encode()
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + (0x0100000000000000 | len(body)).to_bytes(8, "big") + body
+
+
+if __name__ == "__main__":
+    main()
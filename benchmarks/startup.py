@@ -0,0 +1,76 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+from media_utils import SUBCOMMANDS
+
+
+# Packages that take tens of milliseconds to import and should never be needed to print the help of a subcommand
+HEAVY_MODULES = ("numpy", "pymediainfo", "plexapi", "tqdm", "pythumb")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long each media-utils subcommand takes to print its help.")
+    parser.add_argument('subcommands', type=str, nargs='*', default=list(SUBCOMMANDS), help="Subcommands to measure, defaults to all of them.")
+    parser.add_argument('--repeat', type=int, default=10, help="Number of runs of each subcommand, the fastest is reported.")
+    parser.add_argument('--limit', type=float, default=100,
+        help="Largest time in milliseconds a subcommand may add to the startup of a bare interpreter, the exit status is 1 if any takes longer.")
+    parser.add_argument('--json', type=str, metavar='PATH', help="Also write the results to PATH as JSON.")
+    args = parser.parse_args()
+
+    unknown = set(args.subcommands) - set(SUBCOMMANDS)
+    assert not unknown, f"Unknown subcommands: {', '.join(sorted(unknown))}"
+
+    baseline = best_time([sys.executable, "-c", "pass"], args.repeat)
+    print(f"{'bare interpreter':<22} {baseline * 1000:7.1f} ms")
+
+    results = []
+    for name in args.subcommands:
+        cmd = [sys.executable, "-m", "media_utils", name, "--help"]
+        total = best_time(cmd, args.repeat)
+        heavy = heavy_imports(cmd)
+        overhead = total - baseline
+        results.append({'subcommand': name, 'total_ms': total * 1000, 'overhead_ms': overhead * 1000, 'heavy_imports': heavy})
+        flag = "  SLOW" if overhead * 1000 > args.limit else ""
+        imports = f"  imports {', '.join(heavy)}" if heavy else ""
+        print(f"{name:<22} {total * 1000:7.1f} ms  (+{overhead * 1000:.1f} ms){flag}{imports}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'baseline_ms': baseline * 1000, 'results': results}, f, indent=2)
+
+    if any(result['overhead_ms'] > args.limit for result in results):
+        sys.exit(1)
+
+
+def best_time(cmd, repeat):
+    """
+    Fastest wall time of repeat runs of cmd, which has to succeed.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=REPO, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def heavy_imports(cmd):
+    """
+    List the packages in HEAVY_MODULES that cmd imports, from the import times Python reports with -X importtime.
+    """
+    process = subprocess.run([cmd[0], "-X", "importtime", *cmd[1:]], cwd=REPO, check=True, capture_output=True, text=True)
+    imported = {line.rsplit("|", 1)[-1].strip() for line in process.stderr.splitlines() if line.startswith("import time:")}
+    return [module for module in HEAVY_MODULES if module in imported]
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,21 @@ import argparse
 import os
 import sys
 
+from keyframes import add_keyframe_args, index_from_args, snap_chapter_times
+import tracing
+
 
 def main():
     parser = argparse.ArgumentParser(description="Combine two MKV chapters files by taking timestamps from one file and names from the other.")
     parser.add_argument("times", help="A simple text representation of MKV chapters with the desired timestamps")
     parser.add_argument("names", help="A simple text representation of MKV chapters with the desired names")
+    parser.add_argument("--snap", type=str, metavar="VIDEO",
+        help="Snap the chapter times to the nearest keyframes of this video file, usually the encode the chapters are for.")
+    add_keyframe_args(parser)
+    tracing.add_trace_args(parser)
 
     args = parser.parse_args()
+    tracing.start(args.trace)
 
     chapter_times = args.times
     chapter_names = args.names
@@ -27,6 +35,11 @@ def main():
             if "NAME" not in line:
             	times.append(line.split("=")[1].strip())
 
+    if args.snap:
+        keyframes = index_from_args(args).keyframes(args.snap)
+        times, moved = snap_chapter_times(times, keyframes, args.tolerance)
+        print(f"Snapped {moved} of {len(times)} chapters to keyframes.")
+
     output_name = os.path.basename(chapter_times)
 
     with open(output_name + "_combined.chapters.txt", "w") as f:
@@ -1,9 +1,15 @@
 import argparse
+import sys
 import json
 from pathlib import Path
-from subprocess import run, CalledProcessError
+from subprocess import CalledProcessError
 
-from pymediainfo import MediaInfo
+from dv_hdr_hybrid.merge_hybrid import find_chapters, find_subtitle, merge_cmd
+from job_runner import add_runner_args, disk_read, disk_write, runner_from_args, CPU, JobRunner
+from ledger import add_ledger_args, ledger_from_args
+from media_probe import probe_many
+from pair_files import add_pairing_args
+import tracing
 
 
 DV_STREAM_SUFFIX = "_dovi.hevc"
@@ -15,6 +21,11 @@ EDIT_SUFFIX = "_edit.json"
 
 DV_P5_STR = "dvhe.05"
 
+PROBE_FIELDS = (
+    "hdr_format_profile", "duration", "frame_rate", "frame_count", "framerate_num", "framerate_den", "width", "height",
+    "mastering_display_luminance", "maximum_content_light_level", "maximum_frameaverage_light_level",
+)
+
 
 def main():
     parser = argparse.ArgumentParser(description="Inject Dolby Vision metadata from a profile 5 file into an HDR10 file to create a profile 8 video stream.")
@@ -26,8 +37,21 @@ def main():
         help="Use mkvextract to create raw HEVC stream instead of ffmpeg. In some cases the HEVC stream created by ffmpeg can cause errors, using mkvextract may help."
         )
     parser.add_argument('--dv-name', default=False, type=bool, action=argparse.BooleanOptionalAction, help="Name output files based on DV file instead of HDR10 file.")
+    parser.add_argument('--mux', type=str, metavar='OUTPATH',
+        help="Mux the hybrid video into an MKV in OUTPATH along with the audio, subtitle and chapters that merge_hybrid would add. "
+        "The injected stream is written next to the MKV and removed as soon as it has been muxed.")
+    parser.add_argument('--measure-light-levels', default=False, type=bool, action=argparse.BooleanOptionalAction,
+        help="If the RPU has to be edited, always measure the MaxCLL and MaxFALL of the HDR10 file by decoding it. "
+        "By default they are only measured if the values reported by MediaInfo are missing or implausible.")
+    parser.add_argument('--pair-by', choices=("name", "content"), default="name",
+        help="In batch mode, pair files by sorted file name, or by their duration and frame count so that differently named or missing files are caught before injecting.")
+    add_pairing_args(parser)
+    add_runner_args(parser)
+    add_ledger_args(parser)
+    tracing.add_trace_args(parser)
 
     args = parser.parse_args()
+    tracing.start(args.trace)
 
     dv_path = Path(args.dv).resolve()
     assert dv_path.exists(), f"Path to DV file does not exist: {dv_path}"
@@ -40,6 +64,10 @@ def main():
 
     assert both_dirs or both_files, "Paths to DV and HDR10 file(s) must both be directories or both be files."
 
+    ledger = ledger_from_args(args)
+    mux_dir = Path(args.mux).resolve() if args.mux else None
+    assert mux_dir is None or mux_dir.is_dir(), f"Output path does not exist: {mux_dir}"
+
     if both_dirs:
         print("Batch processing files in directories...")
         dv_files = list(dv_path.glob("*.mkv"))
@@ -50,48 +78,113 @@ def main():
         dv_files.sort()
         base_files.sort()
 
-        for i, (dv_file, base_file) in enumerate(zip(dv_files, base_files)):
-            print(f"Processing file {i + 1} of {len(base_files)}")
+        # Probe every file in parallel before starting, the video track fields are all that is kept of each probe
+        if args.pair_by == "content":
+            files = dv_files + base_files
+        else:
+            files = [path for pair in zip(dv_files, base_files) for path in pair]
+        with tracing.step("probe"):
+            probes = dict(zip(files, probe_many(files, PROBE_FIELDS, track_types=("Video",))))
+
+        if args.pair_by == "content":
+            # Pairing by content needs numpy, which is only imported when it is used
+            from pair_files import media_fingerprint, pair_files, verified_pairs
+
+            fingerprints = {path: media_fingerprint(path, tracks[0] if tracks else None) for path, tracks in probes.items()}
+            pairs = verified_pairs(pair_files(dv_files, base_files, args, fingerprints=fingerprints), base_files)
+        else:
+            pairs = list(zip(dv_files, base_files))
+
+        with runner_from_args(args) as runner:
+            for i, (dv_file, base_file) in enumerate(pairs):
+                video_tracks = probes[dv_file], probes[base_file]
+                runner.submit(base_file.stem, process_pair, runner, ledger, args, dv_file, base_file, i, len(pairs), video_tracks, mux_dir)
+            if runner.wait():
+                sys.exit(1)
+    else:
+        with ledger_entry(ledger, args, dv_path, base_path) as entry:
+            if entry.done:
+                print(f"{base_path.name} was already processed, skipping.")
+                return
             try:
-                create_hybrid(args.ffmpeg, args.dovi_tool, dv_file, base_file, args.mkvextract, args.dv_name)
-            except CalledProcessError as cpe:
-                print(f"Error for file {i + 1}: {cpe}")
+                entry.outputs = [create_hybrid(
+                    args.ffmpeg, args.dovi_tool, dv_path, base_path, args.mkvextract, args.dv_name, runner_from_args(args),
+                    measure_levels=args.measure_light_levels, mux_dir=mux_dir
+                )]
             finally:
-                cleanup()
-    else:
+                cleanup([dv_path.stem, base_path.stem])
+
+
+def process_pair(runner, ledger, args, dv_file, base_file, i, total, video_tracks=None, mux_dir=None):
+    with ledger_entry(ledger, args, dv_file, base_file) as entry:
+        if entry.done:
+            print(f"File {i + 1} of {total} was already processed, skipping.")
+            return
+        print(f"Processing file {i + 1} of {total}")
         try:
-            create_hybrid(args.ffmpeg, args.dovi_tool, dv_path, base_path, args.mkvextract, args.dv_name)
-        except:
+            entry.outputs = [create_hybrid(
+                args.ffmpeg, args.dovi_tool, dv_file, base_file, args.mkvextract, args.dv_name, runner, video_tracks,
+                args.measure_light_levels, mux_dir
+            )]
+        except CalledProcessError as cpe:
+            print(f"Error for file {i + 1}: {cpe}")
             raise
         finally:
-            cleanup()
+            cleanup([dv_file.stem, base_file.stem])
+
 
+def ledger_entry(ledger, args, dv_path, base_path):
+    # Output files are written to the current directory
+    options = {'mkvextract': args.mkvextract, 'dv_name': args.dv_name, 'cwd': str(Path.cwd()),
+        'measure_light_levels': args.measure_light_levels, 'mux': args.mux}
+    return ledger.entry("dv_hybrid", [dv_path, base_path], options)
 
-def cleanup():
-    for suffix in [DV_STREAM_SUFFIX, BASE_STREAM_SUFFIX, RPU_SUFFIX, EDIT_SUFFIX, RPU_EDITED_SUFFIX]:
-        for f in Path.cwd().glob(f"*{suffix}"):
-            f.unlink(missing_ok=True)
+
+def cleanup(stems):
+    """
+    Remove the temp files created for the given file stems, other files being processed concurrently are left alone.
+    """
+    for stem in stems:
+        for suffix in [DV_STREAM_SUFFIX, BASE_STREAM_SUFFIX, RPU_SUFFIX, EDIT_SUFFIX, RPU_EDITED_SUFFIX]:
+            (Path.cwd() / f"{stem}{suffix}").unlink(missing_ok=True)
     print("Cleaned up temp files.\n")
 
 
-def create_hybrid(ffmpeg, dovi_tool, dv_path, base_path, mkvextract=False, dv_name=False):
-    dv_info = MediaInfo.parse(dv_path)
+def create_hybrid(ffmpeg, dovi_tool, dv_path, base_path, mkvextract=False, dv_name=False, runner=None, video_tracks=None,
+                  measure_levels=False, mux_dir=None):
+    """
+    Create the hybrid stream for a pair of files and return the path of the output. video_tracks can be given as the
+    probe_many results of the DV and base files, using PROBE_FIELDS and only video tracks, otherwise both files are probed.
+
+    If the RPU has to be edited, the MaxCLL and MaxFALL of the base file are measured when measure_levels is set or the
+    probed values are missing or implausible.
 
-    if len(dv_info.video_tracks) > 1:
+    If mux_dir is given, the injected stream is written to mux_dir and muxed into an MKV there with the audio of the file
+    the output is named after, like merge_hybrid does, and the path of the MKV is returned.
+    """
+    runner = runner or JobRunner()
+    scratch = Path.cwd()
+
+    if video_tracks is None:
+        with tracing.step("probe"):
+            video_tracks = probe_many([dv_path, base_path], PROBE_FIELDS, track_types=("Video",))
+    dv_video_tracks, base_video_tracks = video_tracks
+    assert dv_video_tracks is not None, f"Could not probe {dv_path.name}"
+    assert base_video_tracks is not None, f"Could not probe {base_path.name}"
+
+    if len(dv_video_tracks) > 1:
         print(f"WARNING: {dv_path.name} has multiple video tracks, only using first track.")
 
-    dv_track = dv_info.video_tracks[0].to_data()
+    dv_track = dv_video_tracks[0]._asdict()
 
     # Confirm that DV file is profile 5
     assert dv_track['hdr_format_profile'] == DV_P5_STR, f"Dolby Vision file is not profile 5, expected {DV_P5_STR}, but was actually {dv_track['hdr_format_profile']}"
     print(f"{dv_path.name} is a Profile 5 file.")
 
-    base_info = MediaInfo.parse(base_path)
-
-    if len(base_info.video_tracks) > 1:
+    if len(base_video_tracks) > 1:
         print(f"WARNING: {base_path.name} has multiple video tracks, only using first track.")
 
-    base_track = base_info.video_tracks[0].to_data()
+    base_track = base_video_tracks[0]._asdict()
 
     # Confirm that DV and Base have the same frame count, frame rate, and display dimensions
     dv_framerate = dv_track['frame_rate']
@@ -111,28 +204,42 @@ def create_hybrid(ffmpeg, dovi_tool, dv_path, base_path, mkvextract=False, dv_na
     print(f"Extracting HEVC stream from {dv_path.name}...")
     dv_stream = dv_path.stem + DV_STREAM_SUFFIX
     if mkvextract:
-        run(["mkvextract", dv_path, "tracks", f"0:{dv_stream}"], check=True)
+        runner.run(["mkvextract", dv_path, "tracks", f"0:{dv_stream}"], [disk_read(dv_path), disk_write(scratch)], label="extract dv stream")
     else:
-        run(
+        runner.run(
             [ffmpeg, "-loglevel", "warning", "-hide_banner", "-stats", "-i", dv_path, "-c", "copy" ,"-vbsf", "hevc_mp4toannexb", dv_stream],
-            check=True
+            [disk_read(dv_path), disk_write(scratch)], label="extract dv stream"
         )
 
     print("Extracting and converting Dolby Vision RPU...")
     rpu_bin = Path(dv_path.stem + RPU_SUFFIX)
     try:
-        run([dovi_tool, "-m", "3", "extract-rpu", dv_stream, "-o", rpu_bin], check=True)
+        # Conversion failures are expected for some files and handled below, so do not retry
+        runner.run([dovi_tool, "-m", "3", "extract-rpu", dv_stream, "-o", rpu_bin], [CPU, disk_read(scratch)], retries=0, label="extract rpu")
     except CalledProcessError:
         print("Failed to convert RPU. Retrying with an edited RPU...")
-        run([dovi_tool, "extract-rpu", dv_stream, "-o", rpu_bin], check=True)
+        runner.run([dovi_tool, "extract-rpu", dv_stream, "-o", rpu_bin], [CPU, disk_read(scratch)], label="extract rpu")
 
         min_mdl_str, max_mdl_str = base_track['mastering_display_luminance'].split(',')
 
         min_mdl = int(float(min_mdl_str.replace("min:", "").replace("cd/m2", "").strip()) * 10000)
         max_mdl = int(max_mdl_str.replace("max:", "").replace("cd/m2", "").strip())
 
-        max_cll = int(base_track['maximum_content_light_level'].replace('cd/m2','').strip())
-        max_fall = int(base_track['maximum_frameaverage_light_level'].replace('cd/m2','').strip())
+        max_cll = parse_light_level(base_track['maximum_content_light_level'])
+        max_fall = parse_light_level(base_track['maximum_frameaverage_light_level'])
+        if measure_levels or not (max_cll and max_fall and max_fall <= max_cll):
+            if measure_levels:
+                print(f"Measuring MaxCLL and MaxFALL of {base_path.name}...")
+            else:
+                print(f"MaxCLL and MaxFALL of {base_path.name} are missing or implausible ({max_cll}, {max_fall}), measuring them...")
+            from light_levels import measure_light_levels
+
+            # The chunks of the file are decoded by a process pool sized to the runner's CPU limit, so every CPU slot is
+            # held while it runs rather than oversubscribing the CPUs alongside other jobs
+            with runner.hold([CPU, disk_read(base_path)], cpu_slots=runner.limits[CPU]), tracing.step("measure light levels"):
+                levels = measure_light_levels(base_path, ffmpeg, workers=runner.limits[CPU])
+            max_cll, max_fall = levels.max_cll, levels.max_fall
+            print(f"Measured MaxCLL {max_cll} cd/m2 and MaxFALL {max_fall} cd/m2 over {levels.frames} frames.")
 
         metadata_edit = {
             "mode": 3,
@@ -150,7 +257,7 @@ def create_hybrid(ffmpeg, dovi_tool, dv_path, base_path, mkvextract=False, dv_na
             json.dump(metadata_edit, f)
 
         rpu_edited_bin = dv_path.stem + RPU_EDITED_SUFFIX
-        run([dovi_tool, "editor", "-i", rpu_bin, "-j", json_edit_file, "-o", rpu_edited_bin], check=True)
+        runner.run([dovi_tool, "editor", "-i", rpu_bin, "-j", json_edit_file, "-o", rpu_edited_bin], [CPU], label="edit rpu")
         rpu_bin = rpu_edited_bin
         print("Metadata successfully edited.")
     
@@ -162,23 +269,62 @@ def create_hybrid(ffmpeg, dovi_tool, dv_path, base_path, mkvextract=False, dv_na
     print(f"Extracting HEVC stream from {base_path.name}...")
     base_stream = base_path.stem + BASE_STREAM_SUFFIX
     if mkvextract:
-        run(["mkvextract", base_path, "tracks", f"0:{base_stream}"], check=True)
+        runner.run(["mkvextract", base_path, "tracks", f"0:{base_stream}"], [disk_read(base_path), disk_write(scratch)], label="extract base stream")
     else:
-        run(
+        runner.run(
             [ffmpeg, "-loglevel", "warning", "-hide_banner", "-stats", "-i", base_path, "-c", "copy", "-vbsf", f"hevc_metadata=tick_rate={base_framerate_str}:num_ticks_poc_diff_one=1", base_stream],
-            check=True
+            [disk_read(base_path), disk_write(scratch)], label="extract base stream"
         )
 
     print("Injecting DV metadata into HDR10 base...")
-    if dv_name:
-        out_name = dv_path.stem + OUT_SUFFIX
-    else:
-        out_name = base_path.stem + OUT_SUFFIX
-    run(
+    source = dv_path if dv_name else base_path
+    out_name = source.stem + OUT_SUFFIX
+    if mux_dir:
+        return inject_and_mux(dovi_tool, base_stream, rpu_bin, mux_dir / out_name, source, mux_dir / f"{source.stem}.mkv", runner)
+    runner.run(
         [dovi_tool, "inject-rpu", "-i", base_stream, "--rpu-in", rpu_bin, "-o", out_name],
-        check=True
+        [CPU, disk_read(scratch), disk_write(scratch)], label="inject rpu"
     )
     print("Successfully created hybrid video stream!")
+    return scratch / out_name
+
+
+def inject_and_mux(dovi_tool, base_stream, rpu_bin, injected, source, output, runner):
+    """
+    Inject the RPU into base_stream at injected, which is next to output so that it is written and read back on the
+    output's disk rather than the scratch disk, and mux it into output. The injected stream is removed as soon as the mux
+    finishes, and a partial output is removed if either step fails.
+    """
+    try:
+        runner.run(
+            [dovi_tool, "inject-rpu", "-i", base_stream, "--rpu-in", rpu_bin, "-o", injected],
+            [CPU, disk_read(base_stream), disk_write(injected)], label="inject rpu"
+        )
+        print(f"Muxing hybrid video into {output.name}...")
+        # The subtitle and chapters are optional here, files without them are muxed with the audio only
+        cmd = merge_cmd(output, source, injected, find_subtitle(source.stem, source.parent), find_chapters(source.stem, source.parent))
+        result = runner.run(cmd, [disk_read(source), disk_read(injected), disk_write(output)], check=False, label="mux")
+        # mkvmerge exits with 1 if there were only warnings
+        if result.returncode > 1:
+            result.check_returncode()
+    except BaseException:
+        output.unlink(missing_ok=True)
+        raise
+    finally:
+        injected.unlink(missing_ok=True)
+
+    print(f"Successfully muxed hybrid video into {output}")
+    return output
+
+
+def parse_light_level(value):
+    """
+    Parse a MediaInfo light level such as '1000 cd/m2', returning None if it is missing or not a number.
+    """
+    try:
+        return int(float(str(value).replace('cd/m2', '').strip()))
+    except ValueError:
+        return None
 
 
 if __name__ == "__main__":
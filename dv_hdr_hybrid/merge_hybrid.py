@@ -1,6 +1,9 @@
 import argparse
+import sys
 from pathlib import Path
-from subprocess import run
+
+from job_runner import add_runner_args, disk_read, disk_write, runner_from_args
+import tracing
 
 
 VIDEO_SUFFIX = "_injected.hevc"
@@ -10,23 +13,62 @@ CHAPTERS_SUFFIX = ".chapters.txt"
 def main():
     parser = argparse.ArgumentParser(description="Merge DV hybrid video streams generated by dv_hybrid into .mkv files")
     parser.add_argument('outpath', type=str, help="Output path for merged files.")
+    add_runner_args(parser)
+    tracing.add_trace_args(parser)
     args = parser.parse_args()
+    tracing.start(args.trace)
 
     out = Path(args.outpath).resolve()
 
     files = sorted(Path('.').glob("*.mkv"))
+    # Every file needs a subtitle and chapters, check them all before any merge starts
+    for file in files:
+        assert find_subtitle(file.stem), f"No subtitle file found for {file.name}, expected {file.stem}*.srt"
+        assert find_chapters(file.stem), f"No chapters file found for {file.name}, expected {file.stem}{CHAPTERS_SUFFIX}"
+
+    with runner_from_args(args) as runner:
+        for i, file in enumerate(files):
+            print(f"File {i + 1} of {len(files)}")
+            print(f"Merging {file}")
+
+            video_stream = Path(f"{file.stem}{VIDEO_SUFFIX}")
+            cmd = merge_cmd(out / file.name, file, video_stream, find_subtitle(file.stem), find_chapters(file.stem))
+            runner.submit(file.stem, merge, runner, cmd, [disk_read(file), disk_read(video_stream), disk_write(out)])
+
+        if runner.wait():
+            sys.exit(1)
+
+
+def merge(runner, cmd, resources):
+    result = runner.run(cmd, resources, check=False)
+    # mkvmerge exits with 1 if there were only warnings
+    if result.returncode > 1:
+        result.check_returncode()
+    return result
+
+
+def merge_cmd(output, source, video_stream, sub_file=None, chapters_file=None):
+    """
+    Build the mkvmerge command that replaces the video of source with video_stream while keeping its audio, adding an
+    external subtitle and chapters if given. The video comes first in the track order, then the audio and the subtitle.
+    """
+    cmd = ["mkvmerge", "--output", output, "--no-video", "--no-subtitles", "(", source, ")", "(", video_stream, ")"]
+    track_order = "1:0,0:1"
+    if sub_file:
+        cmd += ["--language", "0:en", "--default-track-flag", "0:no", "(", sub_file, ")"]
+        track_order += ",2:0"
+    if chapters_file:
+        cmd += ["--chapter-language", "en", "--chapter-charset", "UTF-8", "--chapters", chapters_file]
+    return cmd + ["--track-order", track_order]
+
 
-    for i, file in enumerate(files):
-        print(f"File {i + 1} of {len(files)}")
-        print(f"Merging {file}")
+def find_subtitle(stem, directory=Path('.')):
+    return next(iter(sorted(Path(directory).glob(f"{stem}*.srt"))), None)
 
-        video_stream = Path(f"{file.stem}{VIDEO_SUFFIX}")
-        sub_file = sorted(Path('.').glob(f"{file.stem}*.srt"))[0]
-        chapters_file = Path(f"{file.stem}{CHAPTERS_SUFFIX}")
 
-        run(["mkvmerge", "--output", out / file.name, "--no-video", "--no-subtitles", "(", file, ")",
-            "(", video_stream, ")", "--language", "0:en", "--default-track-flag", "0:no", "(", sub_file, ")",
-            "--chapter-language", "en", "--chapter-charset", "UTF-8", "--chapters", chapters_file, "--track-order", "1:0,0:1,2:0"])
+def find_chapters(stem, directory=Path('.')):
+    chapters_file = Path(directory) / f"{stem}{CHAPTERS_SUFFIX}"
+    return chapters_file if chapters_file.exists() else None
 
 
 if __name__ == "__main__":
@@ -2,9 +2,8 @@ import argparse
 from itertools import pairwise
 from pathlib import Path
 
-from tqdm import tqdm
-
 from extract_timecodes.pgsreader import PGSReader
+import tracing
 
 
 OUT_FORMAT = "timecodes-{path_stem}.srt"
@@ -13,8 +12,10 @@ OUT_FORMAT = "timecodes-{path_stem}.srt"
 def main():
     parser = argparse.ArgumentParser(description="Extract timecodes from a .sup file and output into a .srt file.")
     parser.add_argument("path", type=str, help="Path to .sup file or directory containing .sup files.")
+    tracing.add_trace_args(parser)
 
     args = parser.parse_args()
+    tracing.start(args.trace)
 
     filepath = Path(args.path).resolve()
 
@@ -22,14 +23,16 @@ def main():
 
     if filepath.is_file():
         outpath = filepath.parent / OUT_FORMAT.format(path_stem=filepath.stem)
-        extract_timecodes(filepath, outpath)
+        with tracing.step("extract timecodes"):
+            extract_timecodes(filepath, outpath)
     elif filepath.is_dir():
         sup_paths = list(filepath.glob("*.sup"))
         sup_paths.sort()
         print(f"Batch processing {len(sup_paths)} files")
         for i, sup_path in enumerate(sup_paths):
             print(f"Extracting time codes for file {i + 1} of {len(sup_paths)}: {sup_path.name}")
-            extract_timecodes(sup_path, sup_path.parent / OUT_FORMAT.format(path_stem=sup_path.stem))
+            with tracing.step("extract timecodes"):
+                extract_timecodes(sup_path, sup_path.parent / OUT_FORMAT.format(path_stem=sup_path.stem))
     else:
         raise ValueError(f"{filepath} is not a directory or file.")
 
@@ -38,6 +41,8 @@ def extract_timecodes(sup_filepath, outpath):
     """
     Extracts timecodes from provided .sup file and outputs a .srt file
     """
+    from tqdm import tqdm
+
     pgs = PGSReader(sup_filepath)
     ds_iter = pgs.iter_displaysets()
 
@@ -56,6 +56,36 @@ class PGSReader:
             self._displaysets = list(self.iter_displaysets())
         return self._displaysets
 
+def iter_raw_segments(f):
+    '''
+    Yield the raw bytes of each segment in a binary file object, only reading one segment into memory at a time.
+    '''
+    while True:
+        header = f.read(13)
+        if not header:
+            return
+        if len(header) < 13 or header[:2] != b'PG':
+            raise InvalidSegmentError
+        size = int(header[11:13].hex(), 16)
+        body = f.read(size)
+        if len(body) < size:
+            # The file was truncated partway through a segment
+            raise InvalidSegmentError
+        yield header + body
+
+
+def iter_raw_displaysets(f):
+    '''
+    Yield each display set in a binary file object as a list of raw segments, without parsing any of the segments.
+    '''
+    ds = []
+    for segment in iter_raw_segments(f):
+        ds.append(segment)
+        if segment[10] == END:
+            yield ds
+            ds = []
+
+
 class BaseSegment:
 
     SEGMENT = {
@@ -96,7 +126,8 @@ class PresentationCompositionSegment(BaseSegment):
             self.bytes = bytes_
             self.object_id = int(bytes_[0:2].hex(), base=16)
             self.window_id = bytes_[2]
-            self.cropped = bool(bytes_[3])
+            self.cropped = bool(bytes_[3] & 0x80)
+            self.forced = bool(bytes_[3] & 0x40)
             self.x_offset = int(bytes_[4:6].hex(), base=16)
             self.y_offset = int(bytes_[6:8].hex(), base=16)
             if self.cropped:
@@ -141,7 +172,7 @@ class PresentationCompositionSegment(BaseSegment):
         bytes_ = self.data[11:]
         comps = []
         while bytes_:
-            length = 8*(1 + bool(bytes_[3]))
+            length = 8*(1 + bool(bytes_[3] & 0x80))
             comps.append(self.CompositionObject(bytes_[:length]))
             bytes_ = bytes_[length:]
         return comps
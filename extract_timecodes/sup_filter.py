@@ -0,0 +1,175 @@
+import argparse
+import math
+from pathlib import Path
+
+from extract_timecodes.pgsreader import END, PCS, ODS, WDS, InvalidSegmentError, PresentationCompositionSegment, iter_raw_displaysets
+import tracing
+
+
+IO_BUFFER_SIZE = 1 << 20
+PTS_CLOCK = 90
+
+EPOCH_START = 0x80
+NORMAL = 0x00
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter, cut or split a .sup (PGS) subtitle stream without decoding any images.")
+    parser.add_argument("path", type=str, help="Path to .sup file.")
+    parser.add_argument("--output", "-o", type=str,
+        help="Output path, defaults to [NAME].filtered.sup, or [NAME].part[N].sup when splitting.")
+    parser.add_argument("--forced", action="store_true", help="Only keep display sets that contain forced subtitles.")
+    parser.add_argument("--drop-empty", action="store_true", help="Drop display sets that do not show or clear any subtitles.")
+    parser.add_argument("--start", type=parse_time, default=0, help="Drop subtitles before this time, as seconds or HH:MM:SS.sss.")
+    parser.add_argument("--end", type=parse_time, default=math.inf, help="Drop subtitles from this time on, as seconds or HH:MM:SS.sss.")
+    parser.add_argument("--split", type=parse_time, nargs="+", default=[], metavar="TIME",
+        help="Split the stream into a new file at each of these times.")
+    parser.add_argument("--rebase", action="store_true", help="Shift the timestamps of each output so that it starts at its start time.")
+    tracing.add_trace_args(parser)
+
+    args = parser.parse_args()
+    tracing.start(args.trace)
+
+    filepath = Path(args.path).resolve()
+    assert filepath.is_file(), f"{filepath} does not exist."
+
+    bounds = [args.start, *sorted(t for t in args.split if args.start < t < args.end), args.end]
+    if len(bounds) > 2:
+        output = Path(args.output) if args.output else filepath
+        outpaths = [output.with_name(f"{output.stem}.part{i + 1}.sup") for i in range(len(bounds) - 1)]
+    else:
+        outpaths = [Path(args.output) if args.output else filepath.with_name(f"{filepath.stem}.filtered.sup")]
+
+    with tracing.step("filter sup"):
+        filters = filter_sup(filepath, outpaths, bounds, args.forced, args.drop_empty, args.rebase)
+
+    for outpath, display_set_filter in zip(outpaths, filters):
+        print(f"Wrote {display_set_filter.written} display sets to {outpath}")
+        if display_set_filter.warnings:
+            print(f"Warning: {display_set_filter.warnings} display sets in {outpath.name} reuse objects from display sets "
+                  "that were dropped and may not display correctly.")
+
+
+def filter_sup(filepath, outpaths, bounds, forced_only=False, drop_empty=False, rebase=False):
+    """
+    Stream the display sets of a .sup file into one output per pair of consecutive times in bounds.
+    Only the composition segment of each display set is parsed, and only one display set is held in memory at a time.
+    """
+    outs = [open(outpath, "wb", buffering=IO_BUFFER_SIZE) for outpath in outpaths]
+    try:
+        filters = [
+            DisplaySetFilter(out, start, end, forced_only, drop_empty, offset=start if rebase else 0)
+            for out, start, end in zip(outs, bounds, bounds[1:])
+        ]
+        with open(filepath, "rb", buffering=IO_BUFFER_SIZE) as f:
+            for segments in iter_raw_displaysets(f):
+                if segments[0][10] != PCS:
+                    raise InvalidSegmentError
+                pcs = PresentationCompositionSegment(segments[0])
+                for display_set_filter in filters:
+                    display_set_filter.feed(pcs, segments)
+    finally:
+        for out in outs:
+            out.close()
+    return filters
+
+
+class DisplaySetFilter:
+    """
+    Decide which display sets of a stream to write to an output.
+
+    A display set that shows subtitles is kept if it starts within [start, end) and, if forced_only is set, shows a
+    forced object. A display set that clears the screen is kept if it clears a kept subtitle, and otherwise only when
+    neither forced_only nor drop_empty are set. If a kept subtitle would be replaced by one that is dropped, a display set
+    that clears the screen is written in its place.
+
+    Display sets are written as they were read, except that a display set following a dropped one in the same epoch is
+    marked as an epoch start, since decoders would otherwise expect the state left by the dropped display set.
+    """
+
+    def __init__(self, out, start=0, end=math.inf, forced_only=False, drop_empty=False, offset=0):
+        self.out = out
+        self.start = start
+        self.end = end
+        self.forced_only = forced_only
+        self.drop_empty = drop_empty
+        self.offset_ticks = round(offset * PTS_CLOCK)
+        self.showing = False
+        self.last_dropped = False
+        self.written = 0
+        self.warnings = 0
+
+    def feed(self, pcs, segments):
+        objects = pcs.composition_objects
+        in_range = self.start <= pcs.presentation_timestamp < self.end
+
+        if objects:
+            keep = in_range and (not self.forced_only or any(obj.forced for obj in objects))
+            if not keep and self.showing:
+                self.write(clear_displayset(segments))
+                self.showing = False
+        else:
+            keep = self.showing or (in_range and not self.forced_only and not self.drop_empty)
+
+        if keep:
+            if pcs.composition_state == 'Normal' and self.last_dropped:
+                if objects and not any(segment[10] == ODS for segment in segments):
+                    self.warnings += 1
+                segments = [start_epoch(segments[0]), *segments[1:]]
+            self.write(segments)
+            self.showing = bool(objects)
+        self.last_dropped = not keep
+
+    def write(self, segments):
+        for segment in segments:
+            if self.offset_ticks:
+                segment = shift_segment(segment, self.offset_ticks)
+            self.out.write(segment)
+        self.written += 1
+
+
+def clear_displayset(segments):
+    """
+    Build a display set that clears the screen at the time of the given display set, from its PCS and window definitions.
+    """
+    header = bytearray(segments[0][:13])
+    header[11:13] = (11).to_bytes(2, "big")
+    data = bytearray(segments[0][13:24])
+    data[7] = NORMAL
+    # No palette update and no composition objects
+    data[8] = 0
+    data[10] = 0
+    return [bytes(header + data), *(s for s in segments if s[10] == WDS), *(s for s in segments if s[10] == END)]
+
+
+def start_epoch(pcs_bytes):
+    data = bytearray(pcs_bytes)
+    data[13 + 7] = EPOCH_START
+    data[13 + 8] = 0
+    return bytes(data)
+
+
+def shift_segment(segment, offset_ticks):
+    """
+    Move the PTS and DTS of a segment offset_ticks earlier, in units of the 90 kHz PTS clock.
+    """
+    data = bytearray(segment)
+    for i in (2, 6):
+        ticks = int.from_bytes(data[i:i + 4], "big")
+        if ticks:
+            data[i:i + 4] = max(ticks - offset_ticks, 0).to_bytes(4, "big")
+    return bytes(data)
+
+
+def parse_time(value):
+    """
+    Parse a time given as seconds or HH:MM:SS.sss into milliseconds.
+    """
+    seconds = 0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds * 1000
+
+
+if __name__ == "__main__":
+    main()
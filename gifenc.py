@@ -1,24 +1,308 @@
 import argparse
-import subprocess
+import csv
+import os
 import shlex
+import shutil
+import tempfile
+from collections import namedtuple
+from fractions import Fraction
 from pathlib import Path
 
+from job_runner import JobRunner, CPU
+from light_levels import probe_video
+import tracing
+
+
+PALETTE_FPS = 4
+
+# Fractions of the cached width and frame rate and palette sizes tried by --max-size
+SIZE_SEARCH_SCALES = (1, 0.85, 0.7, 0.6, 0.5, 0.4, 0.3)
+SIZE_SEARCH_FPS = (1, 2 / 3, 1 / 2, 1 / 3)
+SIZE_SEARCH_COLORS = (256, 128, 64, 32)
+
+GIF_EXTENSION = 0x21
+GIF_IMAGE = 0x2C
+GIF_TRAILER = 0x3B
+GIF_APPLICATION_LABEL = 0xFF
+
+Clip = namedtuple('Clip', "start length output")
+EncodeSettings = namedtuple('EncodeSettings', "width fps colors")
+
 
 def main():
 	parser = argparse.ArgumentParser(description='Generate a gif from a video file.')
 	parser.add_argument('input', type=str, help="Input video file")
-	parser.add_argument('--start', default=0, help='Start timestamp (in seconds) to generate the video. By default will start at the beginning of the video.')
-	parser.add_argument('--length', default=30, help='Length of the gif in seconds.')
+	parser.add_argument('--start', type=float, default=0, help='Start timestamp (in seconds) to generate the video. By default will start at the beginning of the video.')
+	parser.add_argument('--length', type=float, default=30, help='Length of the gif in seconds.')
+	parser.add_argument('--segments', type=int, default=1,
+		help='Split the clip into this many time segments and encode them concurrently using a shared palette. By default the whole clip is encoded in a single ffmpeg process.')
+	parser.add_argument('--clips', type=str,
+		help='Path to a CSV file of clips to generate from a single decode of the input. Each row should have the columns start, length and output. Overrides --start and --length.')
+	parser.add_argument('--max-size', type=float,
+		help='Largest size of the gif in megabytes. The clip is decoded once into a frame cache, then re-encoded from it, lowering the width first, '
+		'then the frame rate, then the palette size, until the gif is under this size.')
+	parser.add_argument('--max-width', type=int, default=640, help='With --max-size, width of the frame cache and of the largest gif tried.')
+	parser.add_argument('--max-fps', type=float, default=30, help='With --max-size, frame rate of the frame cache and of the largest gif tried.')
+	tracing.add_trace_args(parser)
 
 	args = parser.parse_args()
+	tracing.start(args.trace)
 
 	input_path = Path(args.input).resolve()
 	outpath = f'{input_path.parent / input_path.stem}.gif'
 
-	cmd_split = ['ffmpeg', '-v', 'quiet', '-stats', '-ss', args.start, '-t', args.length, '-i', input_path,
+	if args.clips:
+		if args.segments > 1:
+			parser.error('--segments cannot be combined with --clips')
+		encode_clips(input_path, read_clips(args.clips))
+	elif args.max_size:
+		if args.segments > 1:
+			parser.error('--segments cannot be combined with --max-size')
+		encode_max_size(input_path, outpath, args.start, args.length, int(args.max_size * 1000 ** 2), args.max_width, args.max_fps)
+	elif args.segments > 1:
+		encode_segmented(input_path, outpath, args.start, args.length, args.segments)
+	else:
+		encode(input_path, outpath, args.start, args.length)
+
+
+def encode(input_path, outpath, start, length):
+	cmd_split = ['ffmpeg', '-v', 'quiet', '-stats', '-ss', str(start), '-t', str(length), '-i', input_path,
 			'-filter_complex', '[0:v] split [a][b];[a] palettegen [p];[b][p] paletteuse', outpath]
 
-	subprocess.run(cmd_split, check=True)
+	tracing.run(cmd_split, check=True)
+
+
+def encode_segmented(input_path, outpath, start, length, segments):
+	"""
+	Generate a palette for the whole clip from subsampled frames, then encode each segment in its own ffmpeg process
+	with that palette and join the resulting gifs.
+	"""
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		palette_path = Path(tmp_dir) / 'palette.png'
+		tracing.run(
+			['ffmpeg', '-v', 'quiet', '-ss', str(start), '-t', str(length), '-i', input_path,
+				'-vf', f'fps={PALETTE_FPS},palettegen', '-y', palette_path],
+			check=True
+		)
+
+		segment_length = length / segments
+		segment_paths = []
+		cmds = []
+		for i in range(segments):
+			segment_start = start + i * segment_length
+			# The last segment absorbs any rounding error so that the total length is preserved
+			duration = segment_length if i < segments - 1 else start + length - segment_start
+			segment_path = Path(tmp_dir) / f'segment_{i:04}.gif'
+			segment_paths.append(segment_path)
+			cmds.append(['ffmpeg', '-v', 'error', '-ss', str(segment_start), '-t', str(duration), '-i', input_path,
+				'-i', palette_path, '-lavfi', '[0:v][1:v] paletteuse', '-y', segment_path])
+
+		print(f'Encoding {segments} segments...')
+		# Each segment is a CPU heavy ffmpeg process, so never run more at once than there are cores
+		with JobRunner(cpu=min(segments, os.cpu_count())) as runner:
+			for i, cmd in enumerate(cmds):
+				runner.submit(f'segment_{i}', runner.run, cmd, [CPU])
+			if runner.wait():
+				raise RuntimeError('Failed to encode all segments')
+
+		with tracing.step('join segments'):
+			join_gifs(segment_paths, outpath)
+
+
+def encode_max_size(input_path, outpath, start, length, max_bytes, max_width, max_fps):
+	"""
+	Encode a gif that fits in max_bytes. The clip is decoded and downscaled once into a file of raw frames, from which
+	each trial is encoded. The output size only reliably shrinks as a single setting is lowered, so the settings are
+	searched one at a time: the largest width that fits at the full frame rate and palette is binary searched first,
+	then if even the smallest width is too large, the frame rate at that width, then the palette size.
+	"""
+	width, height, frame_rate, _ = probe_video(input_path)
+	if frame_rate is None:
+		raise ValueError(f'ffprobe could not determine the frame rate of {input_path}')
+	cache_width = min(max_width, width) // 2 * 2
+	cache_height = max(2, round(cache_width * height / width / 2) * 2)
+	cache_fps = min(frame_rate, Fraction(max_fps).limit_denominator(1001))
+
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		cache_path = Path(tmp_dir) / 'frames.rgb'
+		print(f'Decoding the clip into a {cache_width}x{cache_height} frame cache...')
+		tracing.run(
+			['ffmpeg', '-v', 'quiet', '-stats', '-ss', str(start), '-t', str(length), '-i', input_path,
+				'-vf', f'fps={cache_fps},scale={cache_width}:{cache_height}:flags=lanczos', '-pix_fmt', 'rgb24', '-f', 'rawvideo', '-y', cache_path],
+			check=True
+		)
+		cache_input = ['-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{cache_width}x{cache_height}', '-r', str(cache_fps), '-i', cache_path]
+
+		best_path = Path(tmp_dir) / 'best.gif'
+		trial_path = Path(tmp_dir) / 'trial.gif'
+
+		def fits(settings):
+			tracing.run(
+				['ffmpeg', '-v', 'error', *cache_input, '-filter_complex',
+					f'[0:v] fps={settings.fps:.3f},scale={settings.width}:-2:flags=lanczos,split [a][b];'
+					f'[a] palettegen=max_colors={settings.colors} [p];[b][p] paletteuse', '-y', trial_path],
+				check=True
+			)
+			size = trial_path.stat().st_size
+			print(f'{settings.width}px at {settings.fps:.3g} fps with {settings.colors} colors: {size / 1000 ** 2:.2f} MB')
+			if size > max_bytes:
+				return False
+			trial_path.replace(best_path)
+			return True
+
+		axes = size_search_axes(cache_width, cache_fps)
+		settings = EncodeSettings(*(values[0] for values in axes))
+		best = None
+		for i, (field, values) in enumerate(zip(EncodeSettings._fields, axes)):
+			# Past the first setting, the largest value was already tried as the smallest value of the previous setting
+			candidates = [settings._replace(**{field: value}) for value in values[1 if i else 0:]]
+			best = largest_fitting(candidates, fits)
+			if best is not None:
+				break
+			settings = settings._replace(**{field: values[-1]})
+
+		if best is None:
+			raise RuntimeError(f'Could not encode a gif under {max_bytes / 1000 ** 2:.2f} MB, try a shorter clip')
+		print(f'Writing the {best.width}px, {best.fps:.3g} fps, {best.colors} color gif to {outpath}')
+		shutil.move(best_path, outpath)
+
+
+def largest_fitting(candidates, fits):
+	"""
+	Binary search candidates, sorted from the largest output to the smallest, for the first one that fits. The gif of
+	the last candidate that fit is the one left by fits, which is the first one that fits when the search ends.
+	"""
+	best = None
+	low, high = 0, len(candidates) - 1
+	while low <= high:
+		mid = (low + high) // 2
+		if fits(candidates[mid]):
+			best = candidates[mid]
+			high = mid - 1
+		else:
+			low = mid + 1
+	return best
+
+
+def size_search_axes(width, fps):
+	"""
+	List the widths, frame rates and palette sizes tried by --max-size, each from the largest output to the smallest.
+	"""
+	widths = sorted({max(2, round(width * scale / 2) * 2) for scale in SIZE_SEARCH_SCALES}, reverse=True)
+	rates = [float(fps * Fraction(fps_scale)) for fps_scale in SIZE_SEARCH_FPS]
+	return widths, rates, list(SIZE_SEARCH_COLORS)
+
+
+def read_clips(clips_path):
+	"""
+	Read clips from a CSV file with a header row of start, length and output.
+	"""
+	with open(clips_path, newline='') as f:
+		return [Clip(float(row['start']), float(row['length']), row['output']) for row in csv.DictReader(f)]
+
+
+def build_clips_filter(clips, origin):
+	"""
+	Build a filter graph that splits a single decoded video stream into one palettegen/paletteuse branch per clip.
+	Clip start times are relative to the source, origin is the source timestamp of the first decoded frame.
+	"""
+	branches = ''.join(f'[s{i}]' for i in range(len(clips)))
+	graph = [f'[0:v] split={len(clips)} {branches}']
+	for i, clip in enumerate(clips):
+		graph.append(
+			f'[s{i}] trim=start={clip.start - origin}:duration={clip.length},setpts=PTS-STARTPTS,split [a{i}][b{i}];'
+			f'[a{i}] palettegen [p{i}];[b{i}][p{i}] paletteuse [o{i}]'
+		)
+	return ';'.join(graph)
+
+
+def encode_clips(input_path, clips):
+	"""
+	Generate several gifs, which may overlap, while only decoding each frame of the source once.
+	"""
+	origin = min(clip.start for clip in clips)
+	end = max(clip.start + clip.length for clip in clips)
+
+	cmd = ['ffmpeg', '-v', 'quiet', '-stats', '-ss', str(origin), '-t', str(end - origin), '-i', input_path,
+		'-filter_complex', build_clips_filter(clips, origin)]
+	for i, clip in enumerate(clips):
+		cmd.extend(['-map', f'[o{i}]', clip.output])
+
+	print(f'Generating {len(clips)} gifs...')
+	tracing.run(cmd, check=True)
+
+
+def split_gif(data):
+	"""
+	Split a gif into its header (signature, logical screen descriptor and global color table) and a list of
+	(block type, label, bytes) tuples for each extension and image block that follows.
+	"""
+	pos = 13
+	packed = data[10]
+	if packed & 0x80:
+		pos += 3 * 2 ** ((packed & 0x07) + 1)
+	header = data[:pos]
+
+	blocks = []
+	while pos < len(data) and data[pos] != GIF_TRAILER:
+		block_start = pos
+		block_type = data[pos]
+		label = None
+		if block_type == GIF_EXTENSION:
+			label = data[pos + 1]
+			pos += 2
+		elif block_type == GIF_IMAGE:
+			packed = data[pos + 9]
+			pos += 10
+			if packed & 0x80:
+				pos += 3 * 2 ** ((packed & 0x07) + 1)
+			# LZW minimum code size
+			pos += 1
+		else:
+			raise ValueError(f'Unexpected gif block type {block_type:#x} at byte {pos}')
+
+		# Both extensions and image data end in a sequence of sub-blocks terminated by an empty sub-block
+		while data[pos] != 0:
+			pos += data[pos] + 1
+		pos += 1
+		blocks.append((block_type, label, data[block_start:pos]))
+
+	return header, blocks
+
+
+def join_gifs(gif_paths, outpath):
+	"""
+	Concatenate the frames of several gifs into a single gif, using the header and loop settings of the first.
+	"""
+	out_header = None
+	out_blocks = []
+
+	for gif_path in gif_paths:
+		header, blocks = split_gif(Path(gif_path).read_bytes())
+
+		if out_header is None:
+			out_header = header
+			out_blocks.extend(block for _, _, block in blocks)
+			continue
+
+		if header[6:10] != out_header[6:10]:
+			raise ValueError(f'{gif_path} has different dimensions than the first segment')
+
+		for block_type, label, block in blocks:
+			if label == GIF_APPLICATION_LABEL:
+				# Only keep the looping extension from the first gif
+				continue
+			if block_type == GIF_IMAGE and header[13:] and header[13:] != out_header[13:] and not block[9] & 0x80:
+				# Frame relies on a different global color table, carry it over as a local color table
+				packed = (block[9] & 0x70) | 0x80 | (header[10] & 0x07)
+				block = block[:9] + bytes([packed]) + header[13:] + block[10:]
+			out_blocks.append(block)
+
+	with open(outpath, 'wb') as f:
+		f.write(out_header)
+		f.writelines(out_blocks)
+		f.write(bytes([GIF_TRAILER]))
+
 
 if __name__ == "__main__":
     main()
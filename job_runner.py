@@ -0,0 +1,297 @@
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from pathlib import Path
+
+import tracing
+
+
+CPU = "cpu"
+DISK_READ = "read"
+DISK_WRITE = "write"
+
+MAX_TASKS = 32
+MAX_FAILURES = 1000
+RETRY_DELAY = 5
+
+
+class JobCancelled(Exception):
+    '''Raised when a command is started after the runner was cancelled'''
+
+
+def disk_read(path):
+    """
+    Resource key for reading from the device that holds path.
+    """
+    return f"{DISK_READ}:{device_of(path)}"
+
+
+def disk_write(path):
+    """
+    Resource key for writing to the device that holds path. The path does not need to exist yet.
+    """
+    return f"{DISK_WRITE}:{device_of(path)}"
+
+
+def device_of(path):
+    path = Path(path).resolve()
+    while not path.exists():
+        path = path.parent
+    return os.stat(path).st_dev
+
+
+def add_runner_args(parser):
+    """
+    Add the common arguments used to configure a JobRunner to an argument parser.
+    """
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help="Maximum number of CPU heavy commands to run at once.")
+    parser.add_argument('--max-reads', type=int, default=2, help="Maximum number of commands reading from the same disk at once.")
+    parser.add_argument('--max-writes', type=int, default=1, help="Maximum number of commands writing to the same disk at once.")
+    parser.add_argument('--retries', type=int, default=0, help="Number of times to retry a failed command.")
+    parser.add_argument('--log-dir', type=str, help="Write the output of each job to its own log file in this directory instead of the console.")
+
+
+def runner_from_args(args):
+    return JobRunner(cpu=args.jobs, disk_read=args.max_reads, disk_write=args.max_writes, retries=args.retries, log_dir=args.log_dir)
+
+
+class JobRunner:
+    """
+    Run tasks that invoke external tools concurrently, while limiting how many commands use each resource at once.
+
+    Tasks are plain functions submitted with submit(), which call run() for each external command along with the
+    resources the command uses. CPU heavy commands are limited by the cpu limit, while disk reads and writes are limited
+    per device so that several remuxes do not thrash the same disk.
+    """
+
+    def __init__(self, cpu=None, disk_read=2, disk_write=1, retries=0, log_dir=None):
+        self.limits = {
+            CPU: cpu or os.cpu_count(),
+            DISK_READ: disk_read,
+            DISK_WRITE: disk_write,
+        }
+        self.retries = retries
+        self.log_dir = Path(log_dir) if log_dir else None
+        if self.log_dir:
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+
+        self._semaphores = {}
+        self._lock = threading.Lock()
+        self._multi_slot_lock = threading.Lock()
+        self._processes = set()
+        self._cancelled = threading.Event()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=MAX_TASKS)
+        # Only unfinished tasks and the latest failures are kept, so that a long running daemon that never calls wait()
+        # does not hold on to every task it has run
+        self._futures = {}
+        self._failures = deque(maxlen=MAX_FAILURES)
+        self._failed = 0
+        self._finished = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.cancel()
+        self._executor.shutdown(wait=exc_type is None)
+
+    def submit(self, name, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) as a task. The name is used for log files and error messages.
+        """
+        future = self._executor.submit(self._run_task, name, fn, *args, **kwargs)
+        with self._lock:
+            self._futures[future] = name
+        future.add_done_callback(self._task_done)
+        return future
+
+    def _task_done(self, future):
+        with self._lock:
+            name = self._futures.pop(future)
+            if future.cancelled():
+                return
+            self._finished += 1
+            exc = future.exception()
+            if exc is not None:
+                self._failed += 1
+                self._failures.append((name, exc))
+
+    def _run_task(self, name, fn, *args, **kwargs):
+        self._local.name = name
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._local.name = None
+
+    def run(self, cmd, resources=(), check=True, capture=False, retries=None, label=None, cwd=None):
+        """
+        Run an external command once all of its resources are available, retrying failures up to the runner's retry limit
+        unless retries is given. Output goes to the log file of the current task if a log directory was given, or is
+        returned if capture is set. The label is used for the command in traces, defaulting to the executable name.
+        The command is run in cwd if given.
+        """
+        if retries is None:
+            retries = self.retries
+
+        attempt = 0
+        while True:
+            try:
+                with self._acquire(resources):
+                    return self._run_once(cmd, check, capture, label, cwd)
+            except subprocess.CalledProcessError:
+                if attempt >= retries or self._cancelled.is_set():
+                    raise
+                attempt += 1
+                print(f"Command failed, retrying ({attempt} of {retries}): {cmd[0]}")
+                time.sleep(RETRY_DELAY)
+
+    def _run_once(self, cmd, check, capture, label=None, cwd=None):
+        if self._cancelled.is_set():
+            raise JobCancelled(f"Cancelled before running {cmd[0]}")
+
+        name = getattr(self._local, 'name', None)
+        log = None
+        if capture:
+            stdout = stderr = subprocess.PIPE
+        elif self.log_dir and name:
+            log = open(self.log_dir / f"{name}.log", "a")
+            stdout = stderr = log
+        else:
+            stdout = stderr = None
+
+        try:
+            process = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, text=capture, cwd=cwd)
+            with self._lock:
+                self._processes.add(process)
+            try:
+                out, err = tracing.communicate(process, label)
+            finally:
+                with self._lock:
+                    self._processes.discard(process)
+        finally:
+            if log:
+                log.close()
+
+        result = subprocess.CompletedProcess(cmd, process.returncode, out, err)
+        if check:
+            result.check_returncode()
+        return result
+
+    def hold(self, resources, cpu_slots=1):
+        """
+        Context manager that holds resources while work is done in Python rather than by an external command, such as
+        moving a file between disks. If CPU is one of the resources, cpu_slots of the CPU limit are held, up to the whole
+        limit, for work that runs its own pool of processes.
+        """
+        if self._cancelled.is_set():
+            raise JobCancelled("Cancelled before acquiring resources")
+        return self._acquire(resources, cpu_slots)
+
+    def _acquire(self, resources, cpu_slots=1):
+        # Always acquire semaphores in the same order to avoid deadlocks between commands sharing resources
+        semaphores = []
+        for resource in sorted(set(resources)):
+            count = min(cpu_slots, self.limits[CPU]) if resource == CPU else 1
+            semaphores.extend([self._semaphore(resource)] * count)
+        # Slots of the same semaphore are taken one at a time, so two tasks taking several at once could each end up
+        # holding part of the limit while waiting for the rest
+        lock = self._multi_slot_lock if len(semaphores) > len(set(semaphores)) else None
+        return _AcquireAll(semaphores, lock)
+
+    def _semaphore(self, resource):
+        with self._lock:
+            if resource not in self._semaphores:
+                resource_class = resource.split(':', 1)[0]
+                self._semaphores[resource] = threading.BoundedSemaphore(self.limits[resource_class])
+            return self._semaphores[resource]
+
+    def cancel(self):
+        """
+        Stop running commands and drop any tasks that have not started yet.
+        """
+        self._cancelled.set()
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        with self._lock:
+            for process in self._processes:
+                process.terminate()
+
+    def wait(self):
+        """
+        Wait for every submitted task to finish and return a list of (name, exception) for the tasks that failed since the
+        last call to wait(), keeping only the latest MAX_FAILURES. Ctrl-C cancels all tasks.
+        """
+        try:
+            while True:
+                with self._lock:
+                    pending = set(self._futures)
+                if not pending:
+                    break
+                # Wait with a timeout so that Ctrl-C is handled promptly
+                wait(pending, timeout=1)
+        except KeyboardInterrupt:
+            print("\nCancelling jobs...")
+            self.cancel()
+            raise
+
+        with self._lock:
+            failures = list(self._failures)
+            failed = self._failed
+            finished = self._finished
+            self._failures.clear()
+            self._failed = 0
+            self._finished = 0
+
+        if failures:
+            print(f"{failed} of {finished} jobs failed:")
+            if failed > len(failures):
+                print(f"  (only the last {len(failures)} are listed)")
+            for name, exc in failures:
+                print(f"  {name}: {exc}")
+        return failures
+
+
+class SpaceBudget:
+    """
+    Limit the total size in bytes of the files staged in a scratch directory at once. A reservation larger than the
+    whole budget is allowed once nothing else is reserved, so that oversized files are still staged one at a time.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def reserve(self, size):
+        with self._condition:
+            self._condition.wait_for(lambda: self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+
+    def release(self, size):
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+class _AcquireAll:
+
+    def __init__(self, semaphores, lock=None):
+        self.semaphores = semaphores
+        self.lock = lock
+
+    def __enter__(self):
+        with self.lock or nullcontext():
+            for semaphore in self.semaphores:
+                semaphore.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        for semaphore in reversed(self.semaphores):
+            semaphore.release()
@@ -0,0 +1,156 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from job_runner import disk_read, JobRunner
+from ledger import fingerprint
+import mkv_probe
+
+
+CACHE_NAME = "keyframes.db"
+CACHE_ENV = "MEDIA_UTILS_KEYFRAMES"
+MATROSKA_SUFFIXES = (".mkv", ".mka", ".webm")
+SNAP_TOLERANCE = 0.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keyframes (
+    path TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    source TEXT NOT NULL,
+    times BLOB NOT NULL
+)
+"""
+
+
+def add_keyframe_args(parser):
+    """
+    Add the common arguments used to snap chapters to keyframes to an argument parser.
+    """
+    parser.add_argument('--tolerance', type=float, default=SNAP_TOLERANCE,
+        help="Largest distance in seconds a chapter is moved to snap it to a keyframe, chapters further from any keyframe are left alone.")
+    parser.add_argument('--keyframe-cache', type=str, default=os.environ.get(CACHE_ENV),
+        help=f"Path to the cache of keyframe indexes, defaults to the {CACHE_ENV} environment variable or media_utils/{CACHE_NAME} in "
+        "$XDG_CACHE_HOME (~/.cache if it is not set).")
+
+
+def index_from_args(args):
+    return KeyframeIndex(args.keyframe_cache or default_cache_path())
+
+
+def default_cache_path():
+    """
+    Path of the keyframe cache in the user's cache directory, which is shared by every directory the tools are run in.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "media_utils" / CACHE_NAME
+
+
+class KeyframeIndex:
+    """
+    Cache of the keyframe times of video files, keyed on their path. A file is scanned again once its size or
+    modification time changes.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else default_cache_path()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Files are scanned from runner threads, access to the connection is serialised by the lock
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(SCHEMA)
+
+    def keyframes(self, path, runner=None):
+        """
+        Sorted array of the keyframe times of the first video track of path in seconds.
+        """
+        import numpy as np
+
+        path = Path(path).resolve()
+        current = fingerprint(path)
+        with self._lock:
+            row = self._conn.execute("SELECT fingerprint, times FROM keyframes WHERE path = ?", (str(path),)).fetchone()
+        if row is not None and row[0] == current:
+            return np.frombuffer(row[1], dtype=np.float64)
+
+        times, source = scan_keyframes(path, runner)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO keyframes (path, fingerprint, source, times) VALUES (?, ?, ?, ?)",
+                (str(path), current, source, times.tobytes())
+            )
+        return times
+
+
+def scan_keyframes(path, runner=None):
+    """
+    Find the keyframes of the first video track without decoding any video. The Cues index of Matroska files is used if
+    it has an entry for the video track, otherwise ffprobe lists the flags of every video packet.
+    Returns the sorted keyframe times in seconds and the name of the source they were read from.
+    """
+    import numpy as np
+
+    path = Path(path)
+    if path.suffix.lower() in MATROSKA_SUFFIXES:
+        try:
+            cues = mkv_probe.video_cues(path)
+        except mkv_probe.InvalidMatroskaError:
+            cues = None
+        if cues:
+            return np.unique(np.asarray(cues, dtype=np.float64)), "cues"
+
+    runner = runner or JobRunner()
+    process = runner.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path],
+        [disk_read(path)], capture=True, label="scan keyframes"
+    )
+    times = []
+    for line in process.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time != "N/A":
+            times.append(float(pts_time))
+    return np.unique(np.asarray(times, dtype=np.float64)), "packets"
+
+
+def snap(times, keyframes, tolerance=SNAP_TOLERANCE):
+    """
+    Move each time to the nearest keyframe if one is within tolerance seconds, returning an array of the snapped times.
+    """
+    import numpy as np
+
+    times = np.asarray(times, dtype=np.float64)
+    keyframes = np.asarray(keyframes, dtype=np.float64)
+    if len(keyframes) == 0:
+        return times
+    after = np.searchsorted(keyframes, times).clip(0, len(keyframes) - 1)
+    before = (after - 1).clip(0)
+    nearest = np.where(np.abs(keyframes[before] - times) <= np.abs(keyframes[after] - times), keyframes[before], keyframes[after])
+    return np.where(np.abs(nearest - times) <= tolerance, nearest, times)
+
+
+def parse_chapter_time(text):
+    """
+    Seconds of a simple chapter format time such as 00:01:02.345.
+    """
+    hours, minutes, seconds = text.strip().split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def format_chapter_time(seconds):
+    # Matroska timestamps are in milliseconds by default, so rounding keeps a snapped time on its keyframe
+    ms = round(seconds * 1000)
+    return f"{ms // 3600000:02}:{ms // 60000 % 60:02}:{ms // 1000 % 60:02}.{ms % 1000:03}"
+
+
+def snap_chapter_times(times, keyframes, tolerance=SNAP_TOLERANCE):
+    """
+    Snap a list of simple chapter format times to keyframes, returning the new times and the number that were moved.
+    Times that are not moved are returned unchanged.
+    """
+    import numpy as np
+
+    seconds = np.array([parse_chapter_time(time) for time in times], dtype=np.float64)
+    snapped = snap(seconds, keyframes, tolerance)
+    moved = np.abs(snapped - seconds) >= 0.0005
+    return [format_chapter_time(new) if is_moved else time for time, new, is_moved in zip(times, snapped, moved)], int(moved.sum())
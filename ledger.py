@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+LEDGER_NAME = ".media_utils_ledger.db"
+LEDGER_ENV = "MEDIA_UTILS_LEDGER"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    tool TEXT NOT NULL,
+    inputs TEXT NOT NULL,
+    options_hash TEXT NOT NULL,
+    fingerprints TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (tool, inputs, options_hash)
+)
+"""
+
+
+def add_ledger_args(parser):
+    """
+    Add the common arguments used to configure the processed file ledger to an argument parser.
+    """
+    parser.add_argument('--ledger', type=str, default=os.environ.get(LEDGER_ENV),
+        help=f"Path to the ledger of processed files, defaults to the {LEDGER_ENV} environment variable or {LEDGER_NAME} in the "
+        "current directory. Files that the ledger shows were already processed with the same options are skipped.")
+    parser.add_argument('--force', action='store_true', help="Process every file, even if the ledger shows it was already processed.")
+
+
+def ledger_from_args(args):
+    return Ledger(args.ledger or Path.cwd() / LEDGER_NAME, force=args.force)
+
+
+def fingerprint(path):
+    """
+    Cheap fingerprint of a file's contents, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class Ledger:
+    """
+    Record which files each tool has processed, so that rerunning a batch skips the work that was already done.
+
+    Entries are keyed on the tool, its input paths and a hash of the options that affect its output. An entry is only
+    considered done while its inputs and outputs are unchanged since it was recorded, so replaced inputs and deleted
+    outputs are processed again. Tools that edit a file in place list it as both an input and an output.
+    """
+
+    def __init__(self, path, force=False):
+        self.path = Path(path)
+        self.force = force
+        self._lock = threading.Lock()
+        # Tasks record their results from runner threads, access to the connection is serialised by the lock
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(SCHEMA)
+
+    def entry(self, tool, inputs, options=None):
+        return LedgerEntry(self, tool, [Path(path).resolve() for path in inputs], options or {})
+
+    def _lookup(self, key):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT fingerprints, outputs FROM entries WHERE tool = ? AND inputs = ? AND options_hash = ? AND status = 'done'", key
+            ).fetchone()
+
+    def _record(self, key, fingerprints, outputs, status, error=None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (tool, inputs, options_hash, fingerprints, outputs, status, error, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, json.dumps(fingerprints), json.dumps(outputs), status, error, time.time())
+            )
+
+
+class LedgerEntry:
+    """
+    The ledger entry for one run of a tool. Used as a context manager around the work, which should check done first
+    and set outputs once it has written them. The entry is recorded as done if the block finishes and as failed if it
+    raises an exception.
+    """
+
+    def __init__(self, ledger, tool, inputs, options):
+        self.ledger = ledger
+        options_hash = hashlib.sha1(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+        self.key = (tool, json.dumps([str(path) for path in inputs]), options_hash)
+        self.inputs = inputs
+        # Fingerprint the inputs before any work is done, since the work may edit them in place
+        self.fingerprints = [fingerprint(path) for path in inputs]
+        self.outputs = []
+        self.done = not ledger.force and self._is_done()
+
+    def _is_done(self):
+        row = self.ledger._lookup(self.key)
+        if row is None:
+            return False
+        fingerprints, outputs = json.loads(row[0]), dict(json.loads(row[1]))
+        for path, old, new in zip(self.inputs, fingerprints, self.fingerprints):
+            if new != outputs.get(str(path), old):
+                return False
+        return all(fingerprint(path) == output_fingerprint for path, output_fingerprint in outputs.items())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.done:
+            return
+        outputs = [[str(Path(path).resolve()), fingerprint(path)] for path in self.outputs]
+        if exc_type is None:
+            self.ledger._record(self.key, self.fingerprints, outputs, 'done')
+        else:
+            self.ledger._record(self.key, self.fingerprints, outputs, 'failed', repr(exc))
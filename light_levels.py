@@ -0,0 +1,206 @@
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from functools import lru_cache
+
+import tracing
+
+
+# SMPTE ST 2084 (PQ) constants
+PQ_M1 = 2610 / 16384
+PQ_M2 = 2523 / 4096 * 128
+PQ_C1 = 3424 / 4096
+PQ_C2 = 2413 / 4096 * 32
+PQ_C3 = 2392 / 4096 * 32
+PQ_PEAK = 10000
+
+CODE_VALUES = 1024
+# Full range 10-bit planar RGB, the PQ curve is left applied so that code values index the lookup table
+PIXEL_FORMAT = "gbrp10le"
+
+LightLevels = namedtuple('LightLevels', "max_cll max_fall frames")
+VideoInfo = namedtuple('VideoInfo', "width height frame_rate duration")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the MaxCLL and MaxFALL of an HDR10 video by decoding it.")
+    parser.add_argument('path', type=str, help="Path to an HDR10 (PQ) video file.")
+    parser.add_argument('--ffmpeg', type=str, help="Path to ffmpeg executable, ffprobe is run from the same directory", default="ffmpeg")
+    parser.add_argument('--workers', type=int, help="Number of time chunks decoded at once, defaults to the number of CPUs.")
+    parser.add_argument('--frame-step', type=int, default=1, help="Only measure every nth frame. Frames are still decoded, but not converted or measured.")
+    parser.add_argument('--pixel-step', type=int, default=1,
+        help="Only measure every nth pixel of every nth row. Faster, but may miss small highlights that set the MaxCLL.")
+    tracing.add_trace_args(parser)
+
+    args = parser.parse_args()
+    tracing.start(args.trace)
+
+    start = time.perf_counter()
+    with tracing.step("measure light levels"):
+        levels = measure_light_levels(args.path, args.ffmpeg, args.workers, args.frame_step, args.pixel_step)
+    elapsed = time.perf_counter() - start
+    print(f"MaxCLL: {levels.max_cll} cd/m2")
+    print(f"MaxFALL: {levels.max_fall} cd/m2")
+    print(f"Measured {levels.frames} frames in {elapsed:.1f}s ({levels.frames / elapsed:.1f} fps)")
+
+
+def pq_to_nits(code_values):
+    """
+    Light level in cd/m2 of full range 10-bit PQ code values.
+    """
+    import numpy as np
+
+    signal = np.asarray(code_values, dtype=np.float64) / (CODE_VALUES - 1)
+    power = signal ** (1 / PQ_M2)
+    return PQ_PEAK * (np.maximum(power - PQ_C1, 0) / (PQ_C2 - PQ_C3 * power)) ** (1 / PQ_M1)
+
+
+@lru_cache(maxsize=None)
+def nits_table():
+    """
+    Lookup table of the light level of every 10-bit code value.
+    """
+    import numpy as np
+
+    return pq_to_nits(np.arange(CODE_VALUES))
+
+
+def measure_light_levels(path, ffmpeg="ffmpeg", workers=None, frame_step=1, pixel_step=1):
+    """
+    Measure the MaxCLL and MaxFALL of the first video stream of path as defined by CTA-861.3: the brightest maxRGB of any
+    pixel, and the brightest frame average of maxRGB. The video is split into time chunks that are decoded by separate
+    ffmpeg processes, each streaming raw frames to a pool worker that measures them.
+    """
+    video = probe_video(path, ffprobe_path(ffmpeg))
+    if video.duration is None:
+        raise ValueError(f"ffprobe could not determine the duration of {path}")
+    workers = workers or os.cpu_count()
+    chunk_length = video.duration / workers
+    tasks = [
+        (ffmpeg, str(path), i * chunk_length, chunk_length if i < workers - 1 else None, video.width, video.height, frame_step, pixel_step)
+        for i in range(workers)
+    ]
+
+    if workers == 1:
+        results = list(map(measure_chunk, tasks))
+    else:
+        # Forked workers would inherit the threads and locks of the caller, such as a JobRunner's, in whatever state they are in
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = list(pool.map(measure_chunk, tasks))
+
+    frames = sum(result[2] for result in results)
+    if frames == 0:
+        raise ValueError(f"No frames were decoded from {path}")
+    max_code = max(result[0] for result in results)
+    max_fall = max(result[1] for result in results)
+    return LightLevels(round(nits_table()[max_code]), round(max_fall), frames)
+
+
+def ffprobe_path(ffmpeg):
+    """
+    Path to the ffprobe next to the given ffmpeg executable, or ffprobe from the PATH if ffmpeg is found on the PATH.
+    """
+    directory, name = os.path.split(os.fspath(ffmpeg))
+    # Keep any extension such as .exe
+    return os.path.join(directory, "ffprobe" + os.path.splitext(name)[1])
+
+
+def probe_video(path, ffprobe="ffprobe"):
+    """
+    Width, height, frame rate and duration in seconds of the first video stream of path. The frame rate falls back to
+    the average frame rate when ffprobe cannot guess a base one (0/0), and the duration to that of the stream when the
+    container does not have one. Either is None if it is not known at all.
+    """
+    process = tracing.run(
+        [ffprobe, "-v", "error", "-select_streams", "v:0", "-show_entries",
+         "stream=width,height,r_frame_rate,avg_frame_rate,duration:format=duration", "-of", "json", path],
+        check=True, capture_output=True, text=True
+    )
+    info = json.loads(process.stdout)
+    if not info.get("streams"):
+        raise ValueError(f"No video stream found in {path}")
+    stream = info["streams"][0]
+
+    frame_rate = None
+    for rate in (stream.get("r_frame_rate"), stream.get("avg_frame_rate")):
+        if rate and not rate.endswith("/0") and Fraction(rate) > 0:
+            frame_rate = Fraction(rate)
+            break
+    duration = None
+    for value in (info.get("format", {}).get("duration"), stream.get("duration")):
+        if value not in (None, "N/A"):
+            duration = float(value)
+            break
+    return VideoInfo(int(stream["width"]), int(stream["height"]), frame_rate, duration)
+
+
+def measure_chunk(task):
+    """
+    Worker for measure_light_levels. Returns the highest maxRGB code value, the highest frame average light level and
+    the number of frames measured in a chunk of the video. A length of None measures until the end.
+    """
+    import numpy as np
+
+    ffmpeg, path, start, length, width, height, frame_step, pixel_step = task
+    # Nearest neighbour scaling picks pixels rather than averaging them, so subsampling never lowers a pixel's level
+    width = -(-width // pixel_step)
+    height = -(-height // pixel_step)
+    filters = [f"scale={width}:{height}:flags=neighbor:in_color_matrix=bt2020:out_range=full", f"format={PIXEL_FORMAT}"]
+    if frame_step > 1:
+        filters.insert(0, f"select=not(mod(n\\,{frame_step}))")
+
+    cmd = [ffmpeg, "-v", "error", "-nostdin", "-threads", "1", "-ss", str(start)]
+    if length is not None:
+        cmd += ["-t", str(length)]
+    cmd += ["-i", path, "-map", "0:v:0", "-vf", ",".join(filters), "-fps_mode", "passthrough", "-f", "rawvideo", "-"]
+
+    nits = nits_table()
+    frame = np.empty((3, height, width), dtype="<u2")
+    buffer = memoryview(frame).cast("B")
+    max_code = 0
+    max_fall = 0.0
+    frames = 0
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while read_frame(process.stdout, buffer):
+            max_rgb = np.maximum(np.maximum(frame[0], frame[1]), frame[2])
+            # Averaging a histogram of code values through the lookup table avoids converting every pixel to nits
+            counts = np.bincount(max_rgb.ravel(), minlength=CODE_VALUES)[:CODE_VALUES]
+            max_code = max(max_code, int(np.flatnonzero(counts)[-1]))
+            max_fall = max(max_fall, float(counts @ nits) / max_rgb.size)
+            frames += 1
+        stderr = process.stderr.read()
+        process.wait()
+    except:
+        process.kill()
+        process.wait()
+        raise
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr)
+    return max_code, max_fall, frames
+
+
+def read_frame(stream, buffer):
+    """
+    Fill buffer with the next frame from stream. Returns False at the end of the stream.
+    """
+    filled = 0
+    while filled < len(buffer):
+        count = stream.readinto(buffer[filled:])
+        if not count:
+            if filled:
+                raise ValueError(f"Stream ended partway through a frame, {filled} of {len(buffer)} bytes were read")
+            return False
+        filled += count
+    return True
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import csv
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+import tracing
+
+
+TRACK_TYPES = ("Video", "Audio", "Text")
+DEFAULT_FIELDS = (
+    "format", "codec_id", "language", "title", "default", "forced", "compression_mode", "frame_rate", "frame_count",
+    "width", "height", "hdr_format",
+)
+MEDIA_EXTENSIONS = (".mkv", ".mp4", ".m2ts", ".ts", ".mov")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Probe the tracks of many media files in parallel and write the chosen fields as CSV.")
+    parser.add_argument('paths', type=str, nargs='+', help="Media files or directories to search for media files.")
+    parser.add_argument('--fields', '-f', type=str, nargs='+', default=DEFAULT_FIELDS, help="MediaInfo track fields to include.")
+    parser.add_argument('--track-types', type=str, nargs='+', default=TRACK_TYPES, help="MediaInfo track types to include.")
+    parser.add_argument('--output', '-o', type=str, help="Path to write the CSV to, defaults to stdout.")
+    parser.add_argument('--workers', '-j', type=int, help="Number of processes to probe with, defaults to the number of CPUs.")
+    tracing.add_trace_args(parser)
+
+    args = parser.parse_args()
+    tracing.start(args.trace)
+
+    paths = []
+    for path in map(Path, args.paths):
+        if path.is_dir():
+            paths.extend(sorted(p for p in path.rglob("*") if p.suffix.lower() in MEDIA_EXTENSIONS))
+        else:
+            paths.append(path)
+
+    with tracing.step("probe"):
+        results = probe_many(paths, args.fields, args.track_types, args.workers)
+
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        writer = csv.writer(out)
+        writer.writerow(["path", *record_type(tuple(args.fields))._fields])
+        for path, tracks in zip(paths, results):
+            for track in tracks or []:
+                writer.writerow([path, *track])
+    finally:
+        if args.output:
+            out.close()
+
+
+@lru_cache
+def record_type(fields):
+    """
+    Record type for tracks probed with the given fields, the track type and ID are always included.
+    """
+    return namedtuple("TrackRecord", ("track_type", "track_id", *fields))
+
+
+def probe_many(paths, fields=DEFAULT_FIELDS, track_types=TRACK_TYPES, workers=None):
+    """
+    Probe files with MediaInfo across a process pool, keeping only the given fields of the tracks of the given types.
+
+    Returns a list with an entry for each path in order, which is a list of records for the file's tracks, or None if the
+    file could not be probed. The full MediaInfo parse of each file is discarded in its worker process, so only the
+    requested fields are sent back and kept. Fields a track does not have are None.
+    """
+    fields = tuple(fields)
+    track_types = tuple(track_types)
+    record = record_type(fields)
+    tasks = [(str(path), fields, track_types) for path in paths]
+
+    if len(tasks) <= 1 or workers == 1:
+        rows = map(probe_file, tasks)
+        return [rows_to_records(path, result, record) for path, result in zip(paths, rows)]
+
+    with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count(), len(tasks))) as pool:
+        rows = pool.map(probe_file, tasks, chunksize=max(1, len(tasks) // (4 * (workers or os.cpu_count()))))
+        return [rows_to_records(path, result, record) for path, result in zip(paths, rows)]
+
+
+def probe_file(task):
+    """
+    Worker for probe_many. Returns a list of plain tuples, which are cheaper to send between processes than records,
+    or the error message if the file could not be parsed.
+    """
+    path, fields, track_types = task
+    from pymediainfo import MediaInfo
+
+    try:
+        media_info = MediaInfo.parse(path)
+    except Exception as e:
+        return str(e)
+    # Track attributes that are missing are None
+    return [
+        (track.track_type, track.track_id, *(getattr(track, field) for field in fields))
+        for track in media_info.tracks if track.track_type in track_types
+    ]
+
+
+def rows_to_records(path, rows, record):
+    if isinstance(rows, str):
+        print(f"Could not probe {path}: {rows}", file=sys.stderr)
+        return None
+    return [record._make(row) for row in rows]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import importlib
+import sys
+
+
+# Subcommand name -> (module, function). Modules are only imported when their subcommand is run.
+SUBCOMMANDS = {
+    'alass_batch': ('alass_batch', 'main'),
+    'combine_chapters': ('combine_chapters', 'main'),
+    'dv_hybrid': ('dv_hdr_hybrid.dv_hybrid', 'main'),
+    'extract_timecodes': ('extract_timecodes.extract_sup_timecodes', 'main'),
+    'gifenc': ('gifenc', 'main'),
+    'light_levels': ('light_levels', 'main'),
+    'merge_hybrid': ('dv_hdr_hybrid.merge_hybrid', 'main'),
+    'media_probe': ('media_probe', 'main'),
+    'merge_subs': ('merge_subs', 'main'),
+    'mkv_append_tag': ('mkv_append_tag', 'entrypoint'),
+    'pair_files': ('pair_files', 'main'),
+    'radarr_enqueue': ('radarr_queue', 'main'),
+    'radarr_post_process': ('radarr_post_process', 'entrypoint'),
+    'remove_cc': ('remove_cc', 'main'),
+    'remux_pipeline': ('remux_pipeline', 'main'),
+    'rename_chapters': ('rename_chapters', 'entrypoint'),
+    'set_extra_thumbnail': ('plex_extras_thumbnail.set_extra_thumbnail', 'main'),
+    'sup_filter': ('extract_timecodes.sup_filter', 'main'),
+    'tag_episodes': ('tv_episode_tagger.tag_episodes', 'main'),
+    'watch_folder': ('watch_folder', 'main'),
+}
+
+USAGE = "usage: media-utils [-h] <subcommand> [args...]"
+
+
+def print_help():
+    print(USAGE)
+    print("\nA collection of scripts and utilities to manipulate media files.\n")
+    print("subcommands:")
+    for name in SUBCOMMANDS:
+        print(f"  {name}")
+    print("\nRun 'media-utils <subcommand> --help' for help on a subcommand.")
+
+
+def main():
+    # argparse is deliberately not used here, so that startup only pays for importing the selected subcommand
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        print_help()
+        return
+
+    name = sys.argv[1].replace('-', '_')
+    if name not in SUBCOMMANDS:
+        print(USAGE, file=sys.stderr)
+        print(f"media-utils: error: unknown subcommand '{sys.argv[1]}'", file=sys.stderr)
+        sys.exit(2)
+
+    module_name, func_name = SUBCOMMANDS[name]
+    sys.argv = [f"media-utils {name}", *sys.argv[2:]]
+    module = importlib.import_module(module_name)
+    return getattr(module, func_name)()
+
+
+if __name__ == "__main__":
+    main()
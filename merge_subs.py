@@ -1,8 +1,28 @@
 import argparse
 import os
+import shutil
 import sys
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from job_runner import add_runner_args, disk_read, disk_write, runner_from_args, SpaceBudget
+from ledger import add_ledger_args, ledger_from_args
+from media_probe import probe_many
+from mkv_probe import Track
+import mkv_probe
+import tracing
+
+
+SCRATCH_FREE_FRACTION = 0.9
+SUBTITLE_SUFFIXES = (".srt", ".eng.srt", ".en.srt", ".sup")
+MEDIAINFO_FIELDS = ("codec_id", "language", "title", "default", "forced", "compression_mode", "width", "height", "channel_s")
+
+# A track to keep in the output, in order. Flags and names that are None are left as they are in the source
+TrackPlan = namedtuple("TrackPlan", "track default forced name")
+# The external subtitle is added after the file's forced subtitles, it is never the default track
+EXTERNAL_SUBTITLE = TrackPlan(None, False, None, None)
 
-from pymediainfo import MediaInfo
 
 def main():
     parser = argparse.ArgumentParser(description="Intelligently merge MKV/MP4 files with corresponding subtitle files.")
@@ -10,8 +30,17 @@ def main():
     # TODO
     # parser.add_argument('--no-subs', action='store_true',
     #     help="Flag to signal to simply process the existing tracks without an external subtitle file.")
+    parser.add_argument('--scratch', type=str,
+        help="Local directory to write each output to before moving it to the output path. "
+        "Muxing to local storage and moving the finished file to a network share overlaps with muxing the next file.")
+    parser.add_argument('--scratch-budget', type=float,
+        help="Maximum GiB of outputs to keep in the scratch directory at once, defaults to 90%% of its free space.")
+    add_runner_args(parser)
+    add_ledger_args(parser)
+    tracing.add_trace_args(parser)
 
     args = parser.parse_args()
+    tracing.start(args.trace)
 
     outpath = os.path.realpath(args.outpath)
 
@@ -22,156 +51,277 @@ def main():
     files = [s for s in os.listdir(os.getcwd()) if os.path.splitext(s)[1] == ".mkv" or os.path.splitext(s)[1] == ".mp4"]
     files.sort()
 
+    runner = runner_from_args(args)
+    ledger = ledger_from_args(args)
+
+    scratch_dir = None
+    budget = None
+    if args.scratch:
+        # Use a fresh directory so that concurrent runs sharing a scratch directory do not collide
+        scratch_dir = tempfile.mkdtemp(prefix="merge_subs_", dir=args.scratch)
+        if args.scratch_budget:
+            budget = SpaceBudget(args.scratch_budget * 1024 ** 3)
+        else:
+            budget = SpaceBudget(shutil.disk_usage(scratch_dir).free * SCRATCH_FREE_FRACTION)
+
+    entries = {}
+    for file in files:
+        name, ext = os.path.splitext(file)
+        subtitle_file = find_subtitle(name)
+        if subtitle_file is None:
+            continue
+        inputs = [file, subtitle_file]
+        if os.path.exists(name + ".chapters.txt"):
+            inputs.append(name + ".chapters.txt")
+        entries[file] = subtitle_file, ledger.entry("merge_subs", inputs, {'outpath': outpath})
+
+    # Probe every file that will be merged up front, so that the files are probed in parallel
+    with tracing.step("probe"):
+        tracks_by_file = probe_tracks([file for file, (_, entry) in entries.items() if not entry.done])
+
     for i, file in enumerate(files):
         print("File {} of {}".format(i + 1, len(files)))
         print("Merging {}".format(file))
         name, ext = os.path.splitext(file)
 
-        if os.path.exists(name + ".srt"):
-            subtitle_file = name + ".srt"
-        elif os.path.exists(name + ".eng.srt"):
-            subtitle_file = name + ".eng.srt"
-        elif os.path.exists(name + ".en.srt"):
-            subtitle_file = name + ".en.srt"
-        elif os.path.exists(name + ".sup"):
-            subtitle_file = name + ".sup"
-        else:
+        if file not in entries:
             print("No matching subtitle file found, skipping file.")
             continue
-        
-        media_info = MediaInfo.parse(file)
-        
-        audio_tracks = []
-        subtitle_tracks = []
-
-        track_order = []
-
-        for track in media_info.tracks:
-            if track.track_type == "Video":
-                # Video tracks are passed through and will be first in track order
-                # TODO: track_id - 1 is not guaranteed to be the correct track id in mkvmerge
-                # See this link for info https://gitlab.com/mbunkus/mkvtoolnix/-/wikis/About-track-UIDs,-track-numbers-and-track-IDs
-                track_order.append("0:{}".format(track.track_id - 1))
-
-            if track.track_type == "Audio":
-                audio_tracks.append(track)
-
-            if track.track_type == "Text":
-                subtitle_tracks.append(track)
-
-        # Handle audio tracks
-        main_audio_tracks = []
-        commentary_audio_tracks = []
-
-        if len(audio_tracks) > 1:
-            # Determine which audio tracks to keep
-            for track in audio_tracks:
-                if ('lossless' in track.compression_mode.lower()):
-                    main_audio_tracks.append(track)
-                elif (track.title) and ("commentary" in track.title.lower()):
-                    print(f"Commentary audio track found. Track {track.track_id} - {track.title}")
-                    commentary_audio_tracks.append(track)
-        elif len(audio_tracks) == 1:
-            # There's only one audio track, it must be the main track
-            main_audio_tracks.append(audio_tracks[0])
-        else:
-            print("No audio tracks found, skipping file.")
+
+        subtitle_file, entry = entries[file]
+        if entry.done:
+            print("File was already merged, skipping file.")
             continue
 
-        # Set track order and flags for audio tracks
-
-        audio_track_ids = []
-        audio_track_params = []
-
-        for track in main_audio_tracks:
-            print(f"Lossless audio track found. Track {track.track_id} - {track.language} - {track.title}")
-            track_id = str(track.track_id - 1)
-            audio_track_ids.append(track_id)
-            audio_track_params.append("--forced-track {}:no".format(track_id))
-            audio_track_params.append("--default-track {}:yes".format(track_id))
-            audio_track_params.append("--compression '{}:none'".format(track_id))
-            track_order.append("0:{}".format(track_id))
-            if len(main_audio_tracks) > 1 and track.language.lower() == "en":
-                # Should handle cases where an English dub is wanted as a secondary audio track
-                print("Found English main track, dropping remaining lossless tracks.")
-                break
-        
-        if commentary_audio_tracks:
-            for track in commentary_audio_tracks:
-                track_id = str(track.track_id - 1)
-                audio_track_ids.append(track_id)
-                audio_track_params.append("--default-track {}:no".format(track_id))
-                audio_track_params.append("--compression '{}:none'".format(track_id))
-                track_order.append("0:{}".format(track_id))
-
-        audio_flags = "-a " + ",".join(audio_track_ids)
-        audio_flags += " " + " ".join(audio_track_params)
-
-        # Handle subtitle tracks
-        commentary_sub_tracks = []
-        forced_sub_tracks = []
-
-        for track in subtitle_tracks:
-            if track.language == "en":
-                if track.forced == "Yes" or (
-                    (track.title) and (
-                        ("forced" in track.title.lower()) or ("foreign" in track.title.lower())
-                        )
-                    ):
-                    forced_sub_tracks.append(track)
-                    print("Forced subtitle track found. Track {} - {}".format(track.track_id, track.title))
-                if (track.title) and ("commentary" in track.title.lower()):
-                    commentary_sub_tracks.append(track)
-                    print("Commentary subtitle track found. Track {} - {}".format(track.track_id, track.title))
-
-        # Set track order and flags for subtitle tracks
-        sub_tracks = []
-        sub_params = []
+        tracks = tracks_by_file[file]
+        if tracks is None:
+            print("Could not probe file, skipping file.")
+            continue
         
-        if len(forced_sub_tracks) > 0:
-            for forced_track in forced_sub_tracks:
-                track_id = forced_track.track_id - 1
-                sub_tracks.append(str(track_id))
-                sub_params.append("--forced-track {}:yes".format(track_id))
-                sub_params.append("--default-track {}:no".format(track_id))
-                sub_params.append("--track-name '{}:Forced'".format(track_id))
-                sub_params.append("--compression '{}:none'".format(track_id))
-                track_order.append("0:{}".format(track_id))
-
-        track_order.append("1:0") # External subtitle comes after forced tracks, and before commentary tracks
-
-        if len(commentary_sub_tracks) > 0: 
-            for commentary_track in commentary_sub_tracks:
-                track_id = commentary_track.track_id - 1
-                sub_tracks.append(str(track_id))
-                sub_params.append("--default-track {}:no".format(track_id))
-                sub_params.append("--compression '{}:none'".format(track_id))
-                track_order.append("0:{}".format(track_id))
-
-        if len(sub_tracks) > 0:
-            sub_flags = "-s " + ",".join(sub_tracks)
-        else:
-            sub_flags = "-S" # Do not copy any subtitles if none are of interest
-
-        sub_flags += " " + " ".join(sub_params)
-
-        track_order_flag = ",".join(track_order)
+        plan = plan_tracks(tracks)
+        if plan is None:
+            print("No audio tracks found, skipping file.")
+            continue
 
         output_name = os.path.join(outpath, name + '.mkv')
-        
-        merge_cmd = f"mkvmerge -o \"{output_name}\" --no-global-tags {audio_flags} {sub_flags} '(' \"{file}\" ')' --language 0:eng --default-track 0:no '(' \"{subtitle_file}\" ')' --title \"\" --track-order {track_order_flag}"
+        work_name = os.path.join(scratch_dir, name + '.mkv') if scratch_dir else output_name
+
+        merge_cmd = mkvmerge_cmd(work_name, file, subtitle_file, plan)
             
-        remove_tags_cmd = f'mkvpropedit \"{output_name}\" --edit track:a1 --delete name --edit track:v1 --delete name'
+        remove_tags_cmd = ["mkvpropedit", work_name, "--edit", "track:a1", "--delete", "name", "--edit", "track:v1", "--delete", "name"]
 
         if os.path.exists(name + ".chapters.txt"):
             print("Chapters file found, integrating chapters...")
-            remove_tags_cmd += f" --chapters '{name + '.chapters.txt'}'"
+            remove_tags_cmd += ["--chapters", name + ".chapters.txt"]
 
-        os.system(merge_cmd)
-        os.system(remove_tags_cmd)
+        # The output is at most as large as the inputs
+        size = os.path.getsize(file) + os.path.getsize(subtitle_file)
+        runner.submit(name, merge, runner, entry, file, work_name, output_name, merge_cmd, remove_tags_cmd, budget, size)
         
         print()
 
+    failures = runner.wait()
+    if scratch_dir:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    if failures:
+        sys.exit(1)
+
+
+def plan_tracks(tracks):
+    """
+    Choose which tracks of a file to keep and how to flag them. Returns a TrackPlan for each track to keep in output
+    order, with EXTERNAL_SUBTITLE where the external subtitle goes, or None if the file has no audio tracks.
+    """
+    video_tracks = []
+    audio_tracks = []
+    subtitle_tracks = []
+
+    for track in tracks:
+        if track.type == "video":
+            # Video tracks are passed through and will be first in track order
+            video_tracks.append(track)
+
+        if track.type == "audio":
+            audio_tracks.append(track)
+
+        if track.type == "subtitles":
+            subtitle_tracks.append(track)
+
+    # Handle audio tracks
+    main_audio_tracks = []
+    commentary_audio_tracks = []
+
+    if len(audio_tracks) > 1:
+        # Determine which audio tracks to keep
+        for track in audio_tracks:
+            if track.lossless:
+                main_audio_tracks.append(track)
+            elif (track.name) and ("commentary" in track.name.lower()):
+                print(f"Commentary audio track found. Track {track.id} - {track.name}")
+                commentary_audio_tracks.append(track)
+    elif len(audio_tracks) == 1:
+        # There's only one audio track, it must be the main track
+        main_audio_tracks.append(audio_tracks[0])
+    else:
+        return None
+
+    plan = [TrackPlan(track, None, None, None) for track in video_tracks]
+
+    for track in main_audio_tracks:
+        print(f"Lossless audio track found. Track {track.id} - {track.language} - {track.name}")
+        plan.append(TrackPlan(track, True, False, None))
+        if len(main_audio_tracks) > 1 and is_english(track.language):
+            # Should handle cases where an English dub is wanted as a secondary audio track
+            print("Found English main track, dropping remaining lossless tracks.")
+            break
+
+    plan += [TrackPlan(track, False, None, None) for track in commentary_audio_tracks]
+
+    # Handle subtitle tracks
+    commentary_sub_tracks = []
+    forced_sub_tracks = []
+
+    for track in subtitle_tracks:
+        if is_english(track.language):
+            if track.forced or (
+                (track.name) and (
+                    ("forced" in track.name.lower()) or ("foreign" in track.name.lower())
+                    )
+                ):
+                forced_sub_tracks.append(track)
+                print("Forced subtitle track found. Track {} - {}".format(track.id, track.name))
+            if (track.name) and ("commentary" in track.name.lower()):
+                commentary_sub_tracks.append(track)
+                print("Commentary subtitle track found. Track {} - {}".format(track.id, track.name))
+
+    plan += [TrackPlan(track, False, True, "Forced") for track in forced_sub_tracks]
+    # External subtitle comes after forced tracks, and before commentary tracks
+    plan.append(EXTERNAL_SUBTITLE)
+    plan += [TrackPlan(track, False, None, None) for track in commentary_sub_tracks]
+    return plan
+
+
+def mkvmerge_cmd(output, file, subtitle_file, plan):
+    """
+    Build the mkvmerge command that muxes the tracks of file and the external subtitle chosen by plan_tracks.
+    """
+    track_ids = {"audio": [], "subtitles": []}
+    track_params = {"audio": [], "subtitles": []}
+    track_order = []
+
+    for planned in plan:
+        if planned.track is None:
+            track_order.append("1:0")
+            continue
+        track_id = planned.track.id
+        track_order.append("0:{}".format(track_id))
+        if planned.track.type not in track_ids:
+            continue
+        track_ids[planned.track.type].append(str(track_id))
+        params = track_params[planned.track.type]
+        if planned.forced is not None:
+            params.extend(["--forced-track", "{}:{}".format(track_id, "yes" if planned.forced else "no")])
+        if planned.default is not None:
+            params.extend(["--default-track", "{}:{}".format(track_id, "yes" if planned.default else "no")])
+        if planned.name is not None:
+            params.extend(["--track-name", "{}:{}".format(track_id, planned.name)])
+        params.extend(["--compression", "{}:none".format(track_id)])
+
+    audio_flags = ["-a", ",".join(track_ids["audio"])] + track_params["audio"]
+
+    if len(track_ids["subtitles"]) > 0:
+        sub_flags = ["-s", ",".join(track_ids["subtitles"])]
+    else:
+        sub_flags = ["-S"] # Do not copy any subtitles if none are of interest
+    sub_flags += track_params["subtitles"]
+
+    return ["mkvmerge", "-o", output, "--no-global-tags", *audio_flags, *sub_flags, "(", file, ")",
+        "--language", "0:eng", "--default-track", "0:no", "(", subtitle_file, ")", "--title", "", "--track-order", ",".join(track_order)]
+
+
+def find_subtitle(name):
+    for suffix in SUBTITLE_SUFFIXES:
+        if os.path.exists(name + suffix):
+            return name + suffix
+    return None
+
+
+def probe_tracks(files):
+    """
+    Map each file to a list of its tracks with their mkvmerge track IDs, or None if it could not be probed.
+    Matroska files are probed from their headers, other containers fall back to a MediaInfo parse in a process pool and
+    assume mkvmerge numbers their tracks in the same order.
+    """
+    mkv_files = [file for file in files if os.path.splitext(file)[1] == ".mkv"]
+    other_files = [file for file in files if os.path.splitext(file)[1] != ".mkv"]
+
+    tracks_by_file = {}
+    # Header probes are bound by I/O latency rather than CPU
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        for file, tracks in zip(mkv_files, pool.map(probe_matroska_tracks, mkv_files)):
+            tracks_by_file[file] = tracks
+
+    track_types = {"Video": "video", "Audio": "audio", "Text": "subtitles"}
+    for file, records in zip(other_files, probe_many(other_files, MEDIAINFO_FIELDS, track_types)):
+        if records is None:
+            tracks_by_file[file] = None
+            continue
+        tracks_by_file[file] = [
+            Track(
+                id=track.track_id - 1, number=track.track_id, uid=None, type=track_types[track.track_type], codec=track.codec_id,
+                language=track.language or "und", name=track.title, default=track.default == "Yes", forced=track.forced == "Yes",
+                enabled=True, commentary=False, lossless="lossless" in (track.compression_mode or "").lower(),
+                width=track.width, height=track.height, channels=track.channel_s,
+            )
+            for track in records
+        ]
+    return tracks_by_file
+
+
+def probe_matroska_tracks(file):
+    try:
+        return mkv_probe.probe(file).tracks
+    except (mkv_probe.InvalidMatroskaError, OSError) as e:
+        print(f"Could not probe {file}: {e}")
+        return None
+
+
+def is_english(language):
+    return language.lower().split("-")[0] in ("en", "eng")
+
+
+def merge(runner, entry, file, work_name, output_name, merge_cmd, remove_tags_cmd, budget=None, size=0):
+    """
+    Mux and edit a file at work_name, then move it to output_name if they differ. The scratch space used by the file is
+    reserved from budget until it has been moved.
+    """
+    with entry:
+        if budget:
+            budget.reserve(size)
+        try:
+            result = runner.run(merge_cmd, [disk_read(file), disk_write(work_name)], check=False)
+            # mkvmerge exits with 1 if there were only warnings
+            if result.returncode > 1:
+                result.check_returncode()
+            result = runner.run(remove_tags_cmd, [disk_write(work_name)], check=False)
+            # mkvpropedit also exits with 1 if there were only warnings
+            if result.returncode > 1:
+                result.check_returncode()
+
+            if work_name != output_name:
+                print(f"Moving {os.path.basename(output_name)} to output path")
+                # Copy to a temporary name first so that a partial file is never left at the output path
+                partial_name = output_name + ".partial"
+                with runner.hold([disk_read(work_name), disk_write(output_name)]), tracing.step("move output"):
+                    shutil.move(work_name, partial_name)
+                os.replace(partial_name, output_name)
+        finally:
+            if work_name != output_name and os.path.exists(work_name):
+                os.remove(work_name)
+            if budget:
+                budget.release(size)
+        entry.outputs = [output_name]
+
 
 if __name__ == "__main__":
     main()
@@ -1,11 +1,13 @@
 from pathlib import Path
-from subprocess import run
 
 import argparse
-import os
+import tempfile
 import xml.etree.ElementTree as ET
 
-from pymediainfo import MediaInfo
+from ledger import add_ledger_args, ledger_from_args
+import mkv_probe
+import tracing
+from tracing import run
 
 
 TAGS_SUFFIX = "_tags.xml"
@@ -24,66 +26,119 @@ def get_args():
         "The track type must be one of these characters: 'a' for an audio track, 's' for a subtitle track and 'v' for a video track. "
         "Track numbering starts at 1, similar to mkvmerge. Example: 'a1:Audio Source=5.1 Surround Mix from Blu-ray'")
     )
+    add_ledger_args(parser)
+    tracing.add_trace_args(parser)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    tracing.start(args.trace)
+    return args
 
 
 def main():
     args = get_args()
     input_file = Path(args.input).resolve(strict=True)
-    xml_filename = input_file.stem + TAGS_SUFFIX
 
     assert args.general_tags or args.track_tags, "No tags specified, specify at least one tag to append using either --general-tags or --track-tags."
 
-    if args.general_tags is None:
+    options = {'general_tags': args.general_tags, 'track_tags': args.track_tags}
+    with ledger_from_args(args).entry("mkv_append_tag", [input_file], options) as entry:
+        if entry.done:
+            print(f"Tags were already appended to {input_file.name}, skipping.")
+            return
+        append_tags(input_file, args.general_tags, args.track_tags)
+        # Tags are edited in place
+        entry.outputs = [input_file]
+
+
+def append_tags(input_file, general_tags=None, track_tags=None, info=None, output=None):
+    """
+    Append general and track-specific tags to an MKV file in place.
+    An existing mkv_probe result for the file can be passed in to avoid probing it again for track UIDs,
+    output is an optional file object that the output of mkvextract and mkvpropedit is written to.
+    """
+    input_file = Path(input_file)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        xml_out_filename = Path(tmp_dir) / (input_file.stem + OUTPUT_SUFFIX)
+        write_tags_xml(input_file, xml_out_filename, general_tags, track_tags, info, output)
+        run_mkvtoolnix(["mkvpropedit", input_file, "-t", f"all:{xml_out_filename}"], output)
+
+
+def write_tags_xml(input_file, xml_out_filename, general_tags=None, track_tags=None, info=None, output=None):
+    """
+    Write the existing tags of an MKV file with the given tags appended to xml_out_filename, ready to be applied with
+    mkvpropedit's --tags all: option. Only the header of the file is read.
+    """
+    input_file = Path(input_file)
+
+    if general_tags is None:
         gen_tags_to_append = []
     else:
-        gen_tags_to_append = args.general_tags
+        gen_tags_to_append = general_tags
 
     track_tags_to_append = {}
-    if args.track_tags:
+    if track_tags:
         # If track specific tags are passed in, parse them and map them to track UIDs
-        media_info = MediaInfo.parse(input_file)
+        if info is None:
+            with tracing.step("probe"):
+                info = mkv_probe.probe(input_file)
 
-        for track_tag in args.track_tags:
+        for track_tag in track_tags:
             track_selector, track_tag = track_tag.split(':', 1)
             key, val = track_tag.split('=', 1)
             
-            track_uid = get_track_uid_from_selector(media_info, track_selector)
+            track_uid = get_track_uid_from_selector(info.tracks, track_selector)
             
             if track_tags_to_append.get(track_uid):
                 track_tags_to_append[track_uid].append((key, val))
             else:
                 track_tags_to_append[track_uid] = [(key, val)]
 
-    run(["mkvextract", input_file, "tags", xml_filename])
-
-    tree = ET.parse(xml_filename)
-    root = tree.getroot()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        xml_filename = Path(tmp_dir) / (input_file.stem + TAGS_SUFFIX)
 
-    gen_tag_found = False
+        # mkvextract and mkvpropedit only touch the header of the file, not the full file
+        # A failed extraction has to stop here, the existing tags would be replaced by the new ones otherwise
+        run_mkvtoolnix(["mkvextract", input_file, "tags", xml_filename], output)
 
-    for tag in root.iter("Tag"):
-        track_uid = tag.find("./Targets/TrackUID")
-        if track_uid is not None:
-            if track_uid.text in track_tags_to_append:
-                for key, val in track_tags_to_append[track_uid.text]:
-                    tag.append(generate_simple(key, val))
+        if xml_filename.exists():
+            tree = ET.parse(xml_filename)
+            root = tree.getroot()
         else:
-            gen_tag_found = True
-            for gen_tag in gen_tags_to_append:
-                key, val = gen_tag.split('=', 1)
-                tag.append(generate_simple(key, val))
-
-    if not gen_tag_found:
-        # No existing general tags, we must create one
-        root.append(generate_tag(gen_tags_to_append))
-    
-    xml_out_filename = input_file.stem + OUTPUT_SUFFIX
-    with open(xml_out_filename, "w+") as f:
-        tree.write(f, encoding='unicode')
+            # mkvextract does not write anything if the file has no tags
+            root = ET.Element("Tags")
+            tree = ET.ElementTree(root)
+
+        gen_tag_found = False
+
+        for tag in root.iter("Tag"):
+            track_uid = tag.find("./Targets/TrackUID")
+            if track_uid is not None:
+                if track_uid.text in track_tags_to_append:
+                    for key, val in track_tags_to_append[track_uid.text]:
+                        tag.append(generate_simple(key, val))
+            else:
+                gen_tag_found = True
+                for gen_tag in gen_tags_to_append:
+                    key, val = gen_tag.split('=', 1)
+                    tag.append(generate_simple(key, val))
 
-    run(["mkvpropedit", input_file, "-t", f"all:{xml_out_filename}"])
+        if not gen_tag_found:
+            # No existing general tags, we must create one
+            root.append(generate_tag(gen_tags_to_append))
+        
+        with open(xml_out_filename, "w+") as f:
+            tree.write(f, encoding='unicode')
+
+
+def run_mkvtoolnix(cmd, output=None):
+    """
+    Run an MKVToolNix command, raising CalledProcessError if it fails. Warnings, exit status 1, are only written to output.
+    """
+    process = run(cmd, stdout=output, stderr=output)
+    if process.returncode > 1:
+        process.check_returncode()
+    return process
 
 
 def generate_simple(key, value):
@@ -138,41 +193,28 @@ def generate_tag(general_tags):
     return tag
 
 
-def get_track_uid_from_selector(media_info, track_selector):
+SELECTOR_TYPES = {'v': 'video', 'a': 'audio', 's': 'subtitles'}
+
+
+def get_track_uid_from_selector(tracks, track_selector):
     """
-    Retrieve track UID from MediaInfo for the given selector string.
+    Retrieve track UID from the probed tracks for the given selector string.
     """
     try:
         track_type = track_selector[0]
         track_num = int(track_selector[1:])
 
-        if track_type == 'v':
-            return media_info.video_tracks[track_num - 1].to_data()['unique_id']
-        elif track_type == 'a':
-            return media_info.audio_tracks[track_num - 1].to_data()['unique_id']
-        elif track_type == 's':
-            return media_info.text_tracks[track_num - 1].to_data()['unique_id']
-        else:
+        if track_type not in SELECTOR_TYPES:
             raise ValueError(f"Invalid track type '{track_type}'")
+        # UIDs are compared with the text of the TrackUID elements extracted by mkvextract
+        return str([track for track in tracks if track.type == SELECTOR_TYPES[track_type]][track_num - 1].uid)
     except IndexError as e:
         raise Exception(f"Could not find track {track_selector}")
 
 
-def cleanup():
-    for suffix in [TAGS_SUFFIX, OUTPUT_SUFFIX]:
-        for f in Path('.').glob(f"*{suffix}"):
-            os.remove(f)
-
-
 def entrypoint():
-    try:
-        main()
-    except:
-        raise
-    finally:
-        pass
-        cleanup()
-        
+    main()
+
 
 if __name__ == "__main__":
     entrypoint()
@@ -0,0 +1,391 @@
+import struct
+from collections import namedtuple
+
+
+# EBML element IDs, including their length marker bits
+EBML = 0x1A45DFA3
+DOC_TYPE = 0x4282
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMESTAMP_SCALE = 0x2AD7B1
+DURATION = 0x4489
+TITLE = 0x7BA9
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_UID = 0x73C5
+TRACK_TYPE = 0x83
+FLAG_ENABLED = 0xB9
+FLAG_DEFAULT = 0x88
+FLAG_FORCED = 0x55AA
+FLAG_COMMENTARY = 0x55AF
+NAME = 0x536E
+LANGUAGE = 0x22B59C
+LANGUAGE_BCP47 = 0x22B59D
+CODEC_ID = 0x86
+VIDEO = 0xE0
+PIXEL_WIDTH = 0xB0
+PIXEL_HEIGHT = 0xBA
+AUDIO = 0xE1
+CHANNELS = 0x9F
+TAGS = 0x1254C367
+TAG = 0x7373
+TARGETS = 0x63C0
+TARGET_TYPE_VALUE = 0x68CA
+TAG_TRACK_UID = 0x63C5
+SIMPLE_TAG = 0x67C8
+TAG_NAME = 0x45A3
+TAG_STRING = 0x4487
+CHAPTERS = 0x1043A770
+EDITION_ENTRY = 0x45B9
+CHAPTER_ATOM = 0xB6
+CHAPTER_TIME_START = 0x91
+CHAPTER_DISPLAY = 0x80
+CHAP_STRING = 0x85
+CUES = 0x1C53BB6B
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_TRACK = 0xF7
+CLUSTER = 0x1F43B675
+SIMPLE_BLOCK = 0xA3
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+
+TRACK_TYPES = {1: 'video', 2: 'audio', 17: 'subtitles', 16: 'logo', 18: 'buttons', 32: 'control', 33: 'metadata'}
+LOSSLESS_CODECS = ('A_TRUEHD', 'A_FLAC', 'A_PCM', 'A_MLP', 'A_ALAC', 'A_WAVPACK4')
+# Sync word of the lossless extension in DTS-HD Master Audio frames, which share their codec ID with lossy DTS
+DTS_XLL_SYNC = b'\x41\xa2\x95\x47'
+# Number of clusters to search for the first block of each DTS track
+DTS_CLUSTER_LIMIT = 4
+DTS_PEEK_SIZE = 64 * 1024
+
+UNKNOWN_SIZE = -1
+
+Track = namedtuple('Track', "id number uid type codec language name default forced enabled commentary lossless width height channels")
+Tag = namedtuple('Tag', "target_type track_uids tags")
+Chapter = namedtuple('Chapter', "start name")
+MkvInfo = namedtuple('MkvInfo', "title duration tracks tags chapters")
+
+
+class InvalidMatroskaError(Exception):
+    '''Raised when a file is not a Matroska file or its header is corrupt'''
+
+
+def probe(path):
+    """
+    Read the tracks, tags and chapters of a Matroska file from its header, without reading any of the media data.
+
+    Top level elements are read in order up to the first Cluster, and the SeekHead is followed to find elements stored
+    after the media data, which is usually the case for Tags. Track IDs are numbered the same way as mkvmerge, in the
+    order the tracks are stored in the file. Durations and chapter start times are in seconds.
+    """
+    with open(path, 'rb') as f:
+        return Reader(f).probe()
+
+
+def video_cues(path):
+    """
+    Times in seconds of the cue points of the first video track, read from the Cues index without reading any of the
+    media data. mkvmerge and ffmpeg write a cue point for every video keyframe. Returns None if the file has no video
+    track or no cue points for it.
+    """
+    with open(path, 'rb') as f:
+        return Reader(f).video_cues()
+
+
+class Reader:
+
+    def __init__(self, f):
+        self.f = f
+
+    def probe(self):
+        elements, first_cluster = self.read_elements({INFO, TRACKS, TAGS, CHAPTERS})
+
+        title, duration = self.parse_info(elements.get(INFO, b''))
+        tracks = self.parse_tracks(elements.get(TRACKS, b''))
+        if first_cluster is not None and any(track.codec == 'A_DTS' for track in tracks):
+            tracks = self.check_dts_lossless(tracks, first_cluster)
+
+        return MkvInfo(
+            title=title,
+            duration=duration,
+            tracks=tracks,
+            tags=self.parse_tags(elements.get(TAGS, b'')),
+            chapters=self.parse_chapters(elements.get(CHAPTERS, b'')),
+        )
+
+    def video_cues(self):
+        elements, _ = self.read_elements({INFO, TRACKS, CUES})
+        scale = self.timestamp_scale(elements.get(INFO, b''))
+        video = [track for track in self.parse_tracks(elements.get(TRACKS, b'')) if track.type == 'video']
+        if not video or CUES not in elements:
+            return None
+        times = []
+        for cue_point in children(elements[CUES]).get(CUE_POINT, []):
+            fields = children(cue_point)
+            if CUE_TIME not in fields:
+                continue
+            for positions in fields.get(CUE_TRACK_POSITIONS, []):
+                if uint(children(positions).get(CUE_TRACK, [b''])[0]) == video[0].number:
+                    times.append(uint(fields[CUE_TIME][0]) * scale / 1e9)
+                    break
+        return times or None
+
+    def read_elements(self, wanted):
+        """
+        Read the bodies of the wanted top level elements, returning a dict of them and the position of the first Cluster.
+
+        Top level elements are read in order up to the first Cluster, and the SeekHead is followed to find elements stored
+        after the media data, which is usually the case for Tags and Cues.
+        """
+        element_id, size = self.read_header()
+        if element_id != EBML:
+            raise InvalidMatroskaError("Missing EBML header")
+        header = self.read_children(size)
+        doc_type = self.string(header.get(DOC_TYPE, [b''])[0])
+        if doc_type not in ('matroska', 'webm'):
+            raise InvalidMatroskaError(f"Unsupported document type '{doc_type}'")
+
+        element_id, segment_size = self.read_header()
+        if element_id != SEGMENT:
+            raise InvalidMatroskaError("Missing Segment")
+        segment_start = self.f.tell()
+        segment_end = None if segment_size == UNKNOWN_SIZE else segment_start + segment_size
+
+        elements = {}
+        seek_heads = []
+        first_cluster = None
+
+        # Read the elements before the media data
+        position = segment_start
+        while segment_end is None or position < segment_end:
+            self.f.seek(position)
+            try:
+                element_id, size = self.read_header()
+            except EOFError:
+                break
+            if element_id == CLUSTER:
+                first_cluster = position
+                break
+            if size == UNKNOWN_SIZE:
+                break
+            if element_id in wanted and element_id not in elements:
+                elements[element_id] = self.f.read(size)
+            elif element_id == SEEK_HEAD:
+                seek_heads.append(self.f.read(size))
+            else:
+                self.f.seek(size, 1)
+            position = self.f.tell()
+
+        # Follow the SeekHead to the elements that come after the media data, including any further SeekHeads
+        visited = set()
+        while seek_heads:
+            for seek_id, seek_position in self.seek_entries(seek_heads.pop()):
+                position = segment_start + seek_position
+                if position in visited or (seek_id not in wanted and seek_id != SEEK_HEAD) or seek_id in elements:
+                    continue
+                visited.add(position)
+                self.f.seek(position)
+                element_id, size = self.read_header()
+                if element_id != seek_id or size == UNKNOWN_SIZE:
+                    continue
+                if element_id == SEEK_HEAD:
+                    seek_heads.append(self.f.read(size))
+                else:
+                    elements[element_id] = self.f.read(size)
+
+        return elements, first_cluster
+
+    def read_header(self):
+        element_id = self.read_vint(keep_marker=True)
+        size = self.read_vint()
+        return element_id, size
+
+    def read_vint(self, keep_marker=False):
+        first = self.f.read(1)
+        if not first:
+            raise EOFError
+        return read_vint(first + self.f.read(vint_length(first[0]) - 1), 0, keep_marker)[0]
+
+    def read_children(self, size):
+        data = self.f.read(size)
+        return children(data)
+
+    def seek_entries(self, data):
+        for seek in children(data).get(SEEK, []):
+            fields = children(seek)
+            if SEEK_ID in fields and SEEK_POSITION in fields:
+                yield uint(fields[SEEK_ID][0]), uint(fields[SEEK_POSITION][0])
+
+    def timestamp_scale(self, info):
+        fields = children(info)
+        return uint(fields[TIMESTAMP_SCALE][0]) if TIMESTAMP_SCALE in fields else 1000000
+
+    def parse_info(self, data):
+        fields = children(data)
+        scale = self.timestamp_scale(data)
+        duration = float_(fields[DURATION][0]) * scale / 1e9 if DURATION in fields else None
+        title = self.string(fields[TITLE][0]) if TITLE in fields else None
+        return title, duration
+
+    def parse_tracks(self, data):
+        tracks = []
+        for track_id, entry in enumerate(children(data).get(TRACK_ENTRY, [])):
+            fields = children(entry)
+            video = children(fields.get(VIDEO, [b''])[0])
+            audio = children(fields.get(AUDIO, [b''])[0])
+            codec = self.string(fields.get(CODEC_ID, [b''])[0])
+            if LANGUAGE_BCP47 in fields:
+                language = self.string(fields[LANGUAGE_BCP47][0])
+            else:
+                language = self.string(fields[LANGUAGE][0]) if LANGUAGE in fields else 'eng'
+            tracks.append(Track(
+                id=track_id,
+                number=uint(fields[TRACK_NUMBER][0]) if TRACK_NUMBER in fields else None,
+                uid=uint(fields[TRACK_UID][0]) if TRACK_UID in fields else None,
+                type=TRACK_TYPES.get(uint(fields.get(TRACK_TYPE, [b''])[0]), 'unknown'),
+                codec=codec,
+                language=language,
+                name=self.string(fields[NAME][0]) if NAME in fields else None,
+                default=flag(fields, FLAG_DEFAULT, True),
+                forced=flag(fields, FLAG_FORCED, False),
+                enabled=flag(fields, FLAG_ENABLED, True),
+                commentary=flag(fields, FLAG_COMMENTARY, False),
+                lossless=codec.startswith(LOSSLESS_CODECS),
+                width=uint(video[PIXEL_WIDTH][0]) if PIXEL_WIDTH in video else None,
+                height=uint(video[PIXEL_HEIGHT][0]) if PIXEL_HEIGHT in video else None,
+                channels=uint(audio[CHANNELS][0]) if CHANNELS in audio else None,
+            ))
+        return tracks
+
+    def check_dts_lossless(self, tracks, first_cluster):
+        """
+        DTS-HD Master Audio can only be told apart from lossy DTS by its frames, so the first block of each DTS track is
+        read from the first few clusters. Only block headers are read for other tracks.
+        """
+        pending = {track.number for track in tracks if track.codec == 'A_DTS'}
+        lossless = set()
+        position = first_cluster
+        for _ in range(DTS_CLUSTER_LIMIT):
+            if not pending:
+                break
+            self.f.seek(position)
+            try:
+                element_id, size = self.read_header()
+            except EOFError:
+                break
+            if element_id != CLUSTER:
+                break
+            cluster_end = None if size == UNKNOWN_SIZE else self.f.tell() + size
+            while pending and (cluster_end is None or self.f.tell() < cluster_end):
+                try:
+                    element_id, size = self.read_header()
+                except EOFError:
+                    break
+                if element_id == CLUSTER or size == UNKNOWN_SIZE:
+                    break
+                if element_id == BLOCK_GROUP:
+                    # Descend into the group, the Block is one of its children
+                    continue
+                if element_id not in (SIMPLE_BLOCK, BLOCK):
+                    self.f.seek(size, 1)
+                    continue
+                block_start = self.f.tell()
+                track_number = self.read_vint()
+                if track_number in pending:
+                    pending.discard(track_number)
+                    if DTS_XLL_SYNC in self.f.read(min(size, DTS_PEEK_SIZE)):
+                        lossless.add(track_number)
+                self.f.seek(block_start + size)
+            if cluster_end is None:
+                break
+            position = cluster_end
+        return [track._replace(lossless=True) if track.number in lossless else track for track in tracks]
+
+    def parse_tags(self, data):
+        tags = []
+        for tag in children(data).get(TAG, []):
+            fields = children(tag)
+            targets = children(fields.get(TARGETS, [b''])[0])
+            simple_tags = {}
+            for simple in fields.get(SIMPLE_TAG, []):
+                simple_fields = children(simple)
+                if TAG_NAME in simple_fields:
+                    simple_tags[self.string(simple_fields[TAG_NAME][0])] = self.string(simple_fields.get(TAG_STRING, [b''])[0])
+            tags.append(Tag(
+                target_type=uint(targets[TARGET_TYPE_VALUE][0]) if TARGET_TYPE_VALUE in targets else 50,
+                track_uids=[uint(uid) for uid in targets.get(TAG_TRACK_UID, [])],
+                tags=simple_tags,
+            ))
+        return tags
+
+    def parse_chapters(self, data):
+        chapters = []
+        for edition in children(data).get(EDITION_ENTRY, []):
+            for atom in children(edition).get(CHAPTER_ATOM, []):
+                fields = children(atom)
+                displays = [children(display) for display in fields.get(CHAPTER_DISPLAY, [])]
+                name = self.string(displays[0][CHAP_STRING][0]) if displays and CHAP_STRING in displays[0] else None
+                chapters.append(Chapter(start=uint(fields.get(CHAPTER_TIME_START, [b''])[0]) / 1e9, name=name))
+        return chapters
+
+    @staticmethod
+    def string(data):
+        return data.rstrip(b'\0').decode('utf-8', errors='replace')
+
+
+def vint_length(first_byte):
+    if first_byte == 0:
+        raise InvalidMatroskaError("Invalid variable length integer")
+    return 9 - first_byte.bit_length()
+
+
+def read_vint(data, offset, keep_marker=False):
+    """
+    Read an EBML variable length integer from data at offset, returning the value and the offset after it.
+    Sizes with every value bit set mean the size is unknown and are returned as UNKNOWN_SIZE.
+    """
+    length = vint_length(data[offset])
+    value = int.from_bytes(data[offset:offset + length], 'big')
+    if keep_marker:
+        return value, offset + length
+    value &= (1 << (7 * length)) - 1
+    if value == (1 << (7 * length)) - 1:
+        value = UNKNOWN_SIZE
+    return value, offset + length
+
+
+def children(data):
+    """
+    Split the body of a master element into a dict mapping each child element ID to a list of the bodies of the
+    children with that ID, in order.
+    """
+    elements = {}
+    offset = 0
+    while offset < len(data):
+        element_id, offset = read_vint(data, offset, keep_marker=True)
+        size, offset = read_vint(data, offset)
+        if size == UNKNOWN_SIZE:
+            size = len(data) - offset
+        elements.setdefault(element_id, []).append(data[offset:offset + size])
+        offset += size
+    return elements
+
+
+def uint(data):
+    return int.from_bytes(data, 'big')
+
+
+def float_(data):
+    if len(data) == 4:
+        return struct.unpack('>f', data)[0]
+    return struct.unpack('>d', data)[0]
+
+
+def flag(fields, element_id, default):
+    return bool(uint(fields[element_id][0])) if element_id in fields else default
@@ -0,0 +1,275 @@
+import argparse
+import math
+import re
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from extract_timecodes.pgsreader import PCS, InvalidSegmentError
+from media_probe import MEDIA_EXTENSIONS, probe_many
+import tracing
+
+
+SUBTITLE_SUFFIXES = (".srt", ".sup")
+PROBE_FIELDS = ("duration", "frame_count")
+
+BIN_SIZE = 2.0
+MAX_SHIFT = 60.0
+MIN_SCORE = 0.5
+MIN_MARGIN = 0.1
+DURATION_TOLERANCE = 1.0
+# Speed ups and slow downs between 23.976 fps and 25 fps releases, tried when guessing framerate differences
+FRAMERATE_SCALES = (25 / (24000 / 1001), (24000 / 1001) / 25)
+
+SRT_TIME = re.compile(rb"^\s*(\d+):(\d{2}):(\d{2})[,.](\d{3})\s*-->", re.MULTILINE)
+
+
+# events holds the cue start times in seconds of a subtitle, media files have None and are compared by duration and frame count
+Fingerprint = namedtuple("Fingerprint", "path events duration frame_count")
+
+Pair = namedtuple("Pair", "a b score margin ambiguous")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pair the files in two directories by their subtitle timelines or duration and frame count, instead of by name.")
+    parser.add_argument('a', type=str, help="First directory of subtitles (.srt, .sup) or media files.")
+    parser.add_argument('b', type=str, help="Second directory of subtitles or media files.")
+    add_pairing_args(parser)
+    parser.add_argument('--workers', '-j', type=int, help="Number of files to read at the same time.")
+    tracing.add_trace_args(parser)
+
+    args = parser.parse_args()
+    tracing.start(args.trace)
+
+    a_files = list_files(Path(args.a))
+    b_files = list_files(Path(args.b))
+
+    pairs = pair_files(a_files, b_files, args, workers=args.workers)
+    print_pairs(pairs, b_files)
+    if any(pair.ambiguous for pair in pairs):
+        sys.exit(1)
+
+
+def add_pairing_args(parser):
+    """
+    Add the arguments that tune how files are paired by pair_files to an argument parser.
+    """
+    parser.add_argument('--max-shift', type=float, default=MAX_SHIFT, help="Largest offset in seconds between subtitle timelines of the same file.")
+    parser.add_argument('--min-score', type=float, default=MIN_SCORE, help="Lowest similarity between 0 and 1 a pair can have.")
+    parser.add_argument('--min-margin', type=float, default=MIN_MARGIN,
+        help="Least amount a pair's similarity must exceed that of the next best candidate for either file of the pair.")
+    parser.add_argument('--framerate-scales', default=False, type=bool, action=argparse.BooleanOptionalAction,
+        help="Also compare subtitle timelines sped up or slowed down between 23.976 fps and 25 fps.")
+
+
+def list_files(path, suffixes=SUBTITLE_SUFFIXES + MEDIA_EXTENSIONS):
+    return sorted(p for p in path.iterdir() if p.suffix.lower() in suffixes)
+
+
+def pair_files(a_files, b_files, args, workers=None, fingerprints=None):
+    """
+    Pair each file in a_files with the most similar file in b_files, using the options added by add_pairing_args.
+    fingerprints optionally maps paths to fingerprints that were already built, the rest are built here.
+    """
+    fingerprints = dict(fingerprints or {})
+    missing = [path for path in (*a_files, *b_files) if path not in fingerprints]
+    with tracing.step("fingerprint"):
+        fingerprints.update(zip(missing, fingerprint_files(missing, workers)))
+
+    scales = (1.0, *FRAMERATE_SCALES) if args.framerate_scales else (1.0,)
+    with tracing.step("pair"):
+        return pair_fingerprints(
+            [fingerprints[path] for path in a_files], [fingerprints[path] for path in b_files],
+            args.max_shift, scales, args.min_score, args.min_margin
+        )
+
+
+def fingerprint_files(paths, workers=None):
+    """
+    Fingerprint subtitles by their cue times and media files by the duration and frame count of their first video track.
+    Subtitles are read on a thread pool and media files probed with probe_many.
+    """
+    subtitles = [path for path in paths if path.suffix.lower() in SUBTITLE_SUFFIXES]
+    media = [path for path in paths if path.suffix.lower() not in SUBTITLE_SUFFIXES]
+
+    fingerprints = {}
+    with ThreadPoolExecutor(max_workers=workers or 8) as pool:
+        fingerprints.update(zip(subtitles, pool.map(subtitle_fingerprint, subtitles)))
+    if media:
+        for path, tracks in zip(media, probe_many(media, PROBE_FIELDS, track_types=("Video",), workers=workers)):
+            fingerprints[path] = media_fingerprint(path, tracks[0] if tracks else None)
+    return [fingerprints[path] for path in paths]
+
+
+def subtitle_fingerprint(path):
+    import numpy as np
+
+    path = Path(path)
+    if path.suffix.lower() == ".sup":
+        events = sup_events(path)
+    else:
+        events = srt_events(path)
+    events = np.sort(np.asarray(events, dtype=np.float32))
+    return Fingerprint(path, events, float(events[-1]) if len(events) else 0.0, None)
+
+
+def media_fingerprint(path, track):
+    """
+    Fingerprint of a media file from a probed video track with duration (in ms) and frame_count fields.
+    """
+    duration = float(track.duration) / 1000 if track is not None and track.duration else None
+    frame_count = int(track.frame_count) if track is not None and track.frame_count else None
+    return Fingerprint(Path(path), None, duration, frame_count)
+
+
+def srt_events(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    return [int(h) * 3600 + int(m) * 60 + int(s) + int(ms) / 1000 for h, m, s, ms in SRT_TIME.findall(data)]
+
+
+def sup_events(path):
+    """
+    Times in seconds of every presentation composition segment that shows at least one object. Only the headers of the
+    other segments are read.
+    """
+    events = []
+    with open(path, "rb") as f:
+        while header := f.read(13):
+            if len(header) < 13 or header[:2] != b'PG':
+                raise InvalidSegmentError
+            size = int.from_bytes(header[11:13], "big")
+            if header[10] == PCS:
+                body = f.read(size)
+                # The number of composition objects follows the video size, frame rate, composition and palette fields
+                if len(body) > 10 and body[10] > 0:
+                    events.append(int.from_bytes(header[2:6], "big") / 90000)
+            else:
+                f.seek(size, 1)
+    return events
+
+
+def pair_fingerprints(a, b, max_shift=MAX_SHIFT, scales=(1.0,), min_score=MIN_SCORE, min_margin=MIN_MARGIN):
+    """
+    Pair each fingerprint in a with the most similar fingerprint in b. Returns a Pair for each fingerprint in a, which is
+    ambiguous if its score is below min_score, if it is not also the best match for its file in b, or if the next best
+    candidate of either file comes within min_margin of its score.
+    """
+    import numpy as np
+
+    if not a or not b:
+        return [Pair(fp.path, None, 0.0, 0.0, True) for fp in a]
+
+    scores = similarity(a, b, max_shift, scales)
+    best = scores.argmax(axis=1)
+    pairs = []
+    for i, j in enumerate(best):
+        score = scores[i, j]
+        others = np.concatenate([np.delete(scores[i], j), np.delete(scores[:, j], i)])
+        margin = score - others.max() if len(others) else score
+        mutual = scores[:, j].argmax() == i
+        ambiguous = bool(score < min_score or margin < min_margin or not mutual)
+        pairs.append(Pair(a[i].path, b[j].path, float(score), float(margin), ambiguous))
+    return pairs
+
+
+def similarity(a, b, max_shift=MAX_SHIFT, scales=(1.0,)):
+    """
+    Matrix of similarities between 0 and 1 of every fingerprint in a to every fingerprint in b. Subtitle fingerprints are
+    compared by the peak normalized cross-correlation of their binned timelines within max_shift seconds, and any other
+    pair by duration and frame count.
+    """
+    import numpy as np
+
+    scores = np.zeros((len(a), len(b)), dtype=np.float32)
+    for i, fp_a in enumerate(a):
+        for j, fp_b in enumerate(b):
+            if fp_a.events is None or fp_b.events is None:
+                scores[i, j] = duration_similarity(fp_a, fp_b)
+
+    a_subs = [i for i, fp in enumerate(a) if fp.events is not None]
+    b_subs = [j for j, fp in enumerate(b) if fp.events is not None]
+    if a_subs and b_subs:
+        a_events = [a[i].events for i in a_subs]
+        b_events = [b[j].events for j in b_subs]
+        scores[np.ix_(a_subs, b_subs)] = np.max([timeline_similarity(a_events, b_events, max_shift, scale) for scale in scales], axis=0)
+    return scores
+
+
+def duration_similarity(a, b):
+    if a.frame_count and b.frame_count and a.frame_count == b.frame_count:
+        return 1.0
+    if not a.duration or not b.duration:
+        return 0.0
+    return math.exp(-abs(a.duration - b.duration) / DURATION_TOLERANCE)
+
+
+def timeline_similarity(a_events, b_events, max_shift=MAX_SHIFT, scale=1.0):
+    """
+    Peak cross-correlation of the binned cue timelines of every subtitle in a_events with every subtitle in b_events, whose
+    cue times are multiplied by scale, over shifts of up to max_shift seconds in either direction.
+    """
+    import numpy as np
+
+    shift = int(np.ceil(max_shift / BIN_SIZE))
+    end = max(max((events[-1] for events in a_events if len(events)), default=0),
+        max((events[-1] * scale for events in b_events if len(events)), default=0))
+    length = int(end / BIN_SIZE) + 2
+    size = 1 << int(np.ceil(np.log2(length + shift)))
+
+    spectra_a = np.fft.rfft(timelines(a_events, length), size)
+    spectra_b = np.conj(np.fft.rfft(timelines(b_events, length, scale), size))
+
+    scores = np.empty((len(a_events), len(b_events)), dtype=np.float32)
+    for i, spectrum in enumerate(spectra_a):
+        # Correlation at positive shifts is at the start of the result and at negative shifts wraps around to the end
+        correlation = np.fft.irfft(spectrum * spectra_b, size)
+        scores[i] = np.concatenate([correlation[:, :shift + 1], correlation[:, size - shift:]], axis=1).max(axis=1)
+    return scores.clip(0, 1)
+
+
+def timelines(events, length, scale=1.0):
+    """
+    Bin cue times into rows of a matrix, blurred over neighbouring bins so that cues do not need to land in exactly the
+    same bin, with zero mean and unit norm so that the correlation of two rows is at most 1.
+    """
+    import numpy as np
+
+    rows = np.zeros((len(events), length), dtype=np.float32)
+    for row, times in zip(rows, events):
+        row += np.bincount((np.asarray(times) * scale / BIN_SIZE).astype(np.int64), minlength=length)[:length]
+    rows = rows + 0.5 * (np.roll(rows, 1, axis=1) + np.roll(rows, -1, axis=1))
+    rows -= rows.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    return np.divide(rows, norms, out=np.zeros_like(rows), where=norms > 0)
+
+
+def print_pairs(pairs, b_files=(), file=sys.stdout):
+    """
+    Print the pairs found by pair_files, flagging ambiguous pairs and files in b_files that were not paired.
+    """
+    for pair in pairs:
+        status = "AMBIGUOUS" if pair.ambiguous else "ok"
+        b_name = pair.b.name if pair.b else "-"
+        print(f"{status}\t{pair.score:.2f}\t{pair.margin:+.2f}\t{pair.a.name}\t{b_name}", file=file)
+    paired = {pair.b for pair in pairs if not pair.ambiguous}
+    for path in b_files:
+        if path not in paired:
+            print(f"unpaired\t\t\t\t{path.name}", file=file)
+
+
+def verified_pairs(pairs, b_files=()):
+    """
+    Return the pairs as (a, b) tuples if none of them are ambiguous, otherwise print them all and exit so that nothing
+    is processed with a wrong pairing.
+    """
+    if any(pair.ambiguous for pair in pairs):
+        print("Could not pair every file with confidence:", file=sys.stderr)
+        print_pairs(pairs, b_files, file=sys.stderr)
+        sys.exit(1)
+    return [(pair.a, pair.b) for pair in pairs]
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 import argparse
+import csv
 import json
+import os
 import shutil
 import sys
+import tempfile
 
-from plexapi.server import PlexServer
-from pythumb import Thumbnail
-from tqdm import tqdm
+from plex_extras_thumbnail.thumb_index import (
+	empty_index, find_thumbs, index_path_for, load_index, save_index, scan_thumbs, set_thumb_mtime, sorted_thumbs, update_index
+)
+import tracing
 
 
 CONFIG_PATH = Path(__file__).parent / "config.json"
+THUMB_WINDOW = 120
 
 
 def main():
-	with open(CONFIG_PATH, 'r') as f:
+	parser = argparse.ArgumentParser(description="Replace the thumbnail of an Extra in a Plex library.")
+	parser.add_argument('library', type=str, nargs='?', help="Name of the Plex library which the Extra is in")
+	parser.add_argument('title', type=str, nargs='?', help="Title of the movie/show of the Extra")
+	parser.add_argument('extra_name', type=str, nargs='?', help="Name of the Extra")
+	parser.add_argument('thumbnail', type=str, nargs='?', help="Path to the new thumbnail image or a YouTube link")
+	parser.add_argument('--batch', type=str,
+		help="Path to a CSV manifest with the columns library, title, extra and thumbnail to replace many thumbnails in a single run.")
+	parser.add_argument('--refresh', default=False, type=bool, action=argparse.BooleanOptionalAction,
+		help="Refresh the metadata of each movie/show in Plex once all of its thumbnails have been replaced.")
+	parser.add_argument('--config', type=str, default=CONFIG_PATH, help="Path to the config file, defaults to config.json next to this script.")
+	parser.add_argument('--index', default=True, type=bool, action=argparse.BooleanOptionalAction,
+		help="Use the persistent thumbnail index stored next to the config file instead of scanning the whole Plex Media directory.")
+	parser.add_argument('--rebuild-index', action='store_true', help="Discard the thumbnail index and rebuild it from scratch.")
+	tracing.add_trace_args(parser)
+
+	args = parser.parse_args()
+	tracing.start(args.trace)
+
+	with open(args.config, 'r') as f:
 		config = json.load(f)
 	
 	plex_media_path = Path(config['PLEX_HOME']) / "Library/Application Support/Plex Media Server/Media"
-	
-	parser = argparse.ArgumentParser(description="Replace the thumbnail of an Extra in a Plex library.")
-	parser.add_argument('library', type=str, help="Name of the Plex library which the Extra is in")
-	parser.add_argument('title', type=str, help="Title of the movie/show of the Extra")
-	parser.add_argument('extra_name', type=str, help="Name of the Extra")
-	parser.add_argument('thumbnail', type=str, help="Path to the new thumbnail image or a YouTube link")
 
-	args = parser.parse_args()
+	# Plex related packages are slow to import, only import them once arguments have been parsed
+	from plexapi.server import PlexServer
+	from tqdm import tqdm
 
 	plex = PlexServer(config['PLEX_SERVER_URL'], config['PLEX_TOKEN'])
+
+	if args.batch:
+		run_batch(plex, plex_media_path, read_manifest(args.batch), args)
+		return
+
+	if None in (args.library, args.title, args.extra_name, args.thumbnail):
+		parser.error("library, title, extra_name and thumbnail are required unless --batch is used")
+
 	library = plex.library.section(args.library)
 	titles = library.search(title=args.title)
 
 	yt = False
 	if args.thumbnail[0:4] == "http":
-		t = Thumbnail(args.thumbnail)
-		t.fetch()
-		thumb_path = Path(t.save('.', overwrite=True))
+		thumb_path = fetch_thumbnail(args.thumbnail, '.')
 		yt = True
 	else:
 		thumb_path = Path(args.thumbnail)
@@ -52,32 +78,40 @@ def main():
 	title = titles[0]
 	print(f"Found title {title.title} ({title.year})")
 
-	target_time = None
-	extra_path = None
-	for extra in title.extras():
-		if extra.title == args.extra_name:
-			extra_path = Path(extra.locations[0])
-			target_time = datetime.fromtimestamp(extra_path.stat().st_mtime)
-			print(f'Found Extra file "{extra_path.name}", created on {target_time.isoformat()}')
+	extra_path, target_time = find_extra(title.extras(), args.extra_name)
 
 	if extra_path is None or target_time is None:
 		print(f"Could not find an Extra matching {args.extra_name}")
 		sys.exit()
 
 	print("Searching for matching thumbnail path...")
-	thumb_paths = []
-	closest_thumb = None
-	min_delta = float('inf')
-	for thumb in tqdm(plex_media_path.rglob("thumb1.jpg")):
-		thumb_time = datetime.fromtimestamp(thumb.stat().st_mtime)
+	if args.index:
+		index_path = index_path_for(args.config)
+		index = empty_index() if args.rebuild_index else load_index(index_path)
+		update_index(index, plex_media_path)
+		save_index(index, index_path)
+		matches, closest = find_thumbs(sorted_thumbs(index), target_time.timestamp(), THUMB_WINDOW)
+		thumb_paths = [plex_media_path / rel_thumb for _, rel_thumb in matches]
+		closest_thumb = None
+		if closest is not None:
+			closest_thumb = datetime.fromtimestamp(closest[0]), plex_media_path / closest[1]
+	else:
+		thumb_paths = []
+		closest_thumb = None
+		min_delta = float('inf')
+		for thumb_mtime, thumb in tqdm(scan_thumbs(plex_media_path, target_time.timestamp() - THUMB_WINDOW)):
+			thumb_time = datetime.fromtimestamp(thumb_mtime)
 
-		delta = abs(thumb_time - target_time).total_seconds()
+			delta = abs(thumb_time - target_time).total_seconds()
 
-		if delta < 120:
-			thumb_paths.append(thumb)
-		if delta < min_delta:
-			closest_thumb = thumb_time, thumb
-			min_delta = delta
+			if delta < THUMB_WINDOW:
+				thumb_paths.append(thumb)
+			if delta < min_delta:
+				closest_thumb = thumb_time, thumb
+				min_delta = delta
+			if len(thumb_paths) > 1:
+				# The match is already ambiguous, there is no need to finish scanning
+				break
 
 	if len(thumb_paths) == 0:
 		print("\nCould not find matching thumbnail path.")
@@ -91,13 +125,19 @@ def main():
 	else:
 		print(f"Found matching thumbnail path: {thumb_paths[0]}")
 
-	thumb_paths[0].unlink()
-	shutil.copy2(thumb_path, thumb_paths[0])
+	replace_thumbnail(thumb_path, thumb_paths[0])
 	print("Successfully replaced thumbnail.")
 
+	if args.index:
+		set_thumb_mtime(index, plex_media_path, thumb_paths[0])
+		save_index(index, index_path)
+
 	if yt:
 		thumb_path.unlink()
 
+	if args.refresh:
+		title.refresh()
+
 	# TODO: Removing and re-adding the file will force Plex to use the new thumbnail
 	# shutil.move(extra_path, "..")
 	# library.update()
@@ -105,5 +145,144 @@ def main():
 	# library.update()
 
 
+def find_extra(extras, extra_name):
+	"""
+	Return the path and modification time of the Extra with the given name, or (None, None) if it was not found.
+	"""
+	extra_path = None
+	target_time = None
+	for extra in extras:
+		if extra.title == extra_name:
+			extra_path = Path(extra.locations[0])
+			target_time = datetime.fromtimestamp(extra_path.stat().st_mtime)
+			print(f'Found Extra file "{extra_path.name}", created on {target_time.isoformat()}')
+	return extra_path, target_time
+
+
+def replace_thumbnail(thumb_path, target_path):
+	"""
+	Copy the new thumbnail next to the target and swap it in, so a failed copy leaves Plex's current thumbnail in place.
+	"""
+	tmp_path = target_path.with_name(target_path.name + '.tmp')
+	shutil.copy2(thumb_path, tmp_path)
+	os.replace(tmp_path, target_path)
+
+
+def read_manifest(manifest_path):
+	with open(manifest_path, newline='') as f:
+		return list(csv.DictReader(f))
+
+
+def fetch_thumbnail(url, out_dir):
+	from pythumb import Thumbnail
+
+	t = Thumbnail(url)
+	t.fetch()
+	return Path(t.save(out_dir, overwrite=True))
+
+
+def try_fetch_thumbnail(url, out_dir):
+	"""
+	Fetch a thumbnail for the batch, returning None if it could not be fetched so that other rows are still processed.
+	"""
+	try:
+		return fetch_thumbnail(url, out_dir)
+	except Exception as e:
+		print(f"Failed to fetch {url}: {e}")
+		return None
+
+
+def run_batch(plex, plex_media_path, rows, args):
+	"""
+	Replace the thumbnails of every Extra in the manifest rows using a single Plex session and a single thumbnail scan.
+	"""
+	from tqdm import tqdm
+
+	sections = {}
+	titles = {}
+	extras = {}
+	targets = []
+
+	for row in rows:
+		label = f"{row['title']} - {row['extra']}"
+
+		if row['library'] not in sections:
+			sections[row['library']] = plex.library.section(row['library'])
+		library = sections[row['library']]
+
+		title_key = (row['library'], row['title'])
+		if title_key not in titles:
+			results = library.search(title=row['title'])
+			titles[title_key] = results[0] if results else None
+		title = titles[title_key]
+		if title is None:
+			print(f"{label}: No results found for {row['title']} in {row['library']}")
+			continue
+
+		if title.ratingKey not in extras:
+			extras[title.ratingKey] = title.extras()
+		extra_path, target_time = find_extra(extras[title.ratingKey], row['extra'])
+		if extra_path is None:
+			print(f"{label}: Could not find an Extra matching {row['extra']}")
+			continue
+
+		if row['thumbnail'][0:4] != "http" and not Path(row['thumbnail']).exists():
+			print(f"{label}: {row['thumbnail']} does not exist.")
+			continue
+
+		targets.append((label, row['thumbnail'], title, target_time.timestamp()))
+
+	if not targets:
+		return
+
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		urls = {thumbnail for _, thumbnail, _, _ in targets if thumbnail[0:4] == "http"}
+		print(f"Fetching {len(urls)} thumbnails...")
+		with ThreadPoolExecutor() as pool:
+			fetched = dict(zip(urls, pool.map(lambda url: try_fetch_thumbnail(url, tmp_dir), urls)))
+
+		failed = [(label, thumbnail) for label, thumbnail, _, _ in targets if thumbnail in fetched and fetched[thumbnail] is None]
+		for label, thumbnail in failed:
+			print(f"{label}: Could not fetch {thumbnail}, skipping.")
+		targets = [target for target in targets if fetched.get(target[1], True) is not None]
+		if not targets:
+			return
+
+		print("Searching for matching thumbnail paths...")
+		if args.index:
+			index_path = index_path_for(args.config)
+			index = empty_index() if args.rebuild_index else load_index(index_path)
+			update_index(index, plex_media_path)
+			save_index(index, index_path)
+			thumbs = sorted_thumbs(index)
+		else:
+			min_mtime = min(target_ts for _, _, _, target_ts in targets) - THUMB_WINDOW
+			thumbs = sorted((thumb_mtime, str(thumb.relative_to(plex_media_path)))
+				for thumb_mtime, thumb in tqdm(scan_thumbs(plex_media_path, min_mtime)))
+
+		refresh_titles = {}
+		for label, thumbnail, title, target_ts in targets:
+			matches, _ = find_thumbs(thumbs, target_ts, THUMB_WINDOW)
+			if len(matches) != 1:
+				print(f"{label}: Found {len(matches)} possible matching thumbnail paths, skipping.")
+				continue
+
+			target_path = plex_media_path / matches[0][1]
+			replace_thumbnail(fetched.get(thumbnail, Path(thumbnail)), target_path)
+			print(f"{label}: Replaced {target_path}")
+
+			if args.index:
+				set_thumb_mtime(index, plex_media_path, target_path)
+			refresh_titles[title.ratingKey] = title
+
+		if args.index:
+			save_index(index, index_path)
+
+	if args.refresh:
+		print(f"Refreshing {len(refresh_titles)} items...")
+		for title in refresh_titles.values():
+			title.refresh()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,222 @@
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import json
+import os
+
+
+INDEX_SUFFIX = ".thumb_index.json"
+INDEX_VERSION = 1
+
+THUMB_NAME = "thumb1.jpg"
+BUNDLE_SUFFIX = ".bundle"
+
+SCAN_WORKERS = 16
+SCAN_FAN_OUT_DEPTH = 2
+
+
+def index_path_for(config_path):
+	"""
+	Return the path of the thumbnail index kept next to a config file, so that servers with different configs do not
+	share an index, e.g. config.json is indexed in config.thumb_index.json.
+	"""
+	config_path = Path(config_path)
+	return config_path.with_name(config_path.stem + INDEX_SUFFIX)
+
+
+def load_index(index_path):
+	"""
+	Load the thumbnail index, returning an empty index if it does not exist or is out of date.
+	"""
+	try:
+		with open(index_path, 'r') as f:
+			index = json.load(f)
+	except FileNotFoundError:
+		index = None
+
+	if index is None or index.get('version') != INDEX_VERSION:
+		index = empty_index()
+	return index
+
+
+def empty_index():
+	return {'version': INDEX_VERSION, 'containers': {}, 'bundles': {}}
+
+
+def save_index(index, index_path):
+	tmp_path = Path(index_path).with_suffix('.tmp')
+	with open(tmp_path, 'w') as f:
+		json.dump(index, f)
+	os.replace(tmp_path, index_path)
+
+
+def update_index(index, media_path):
+	"""
+	Bring the index up to date with the Plex Media directory.
+
+	Plex stores thumbnails in bundle directories nested in hashed container directories, e.g.
+	Media/localhost/1/2345...bundle/Contents/Thumbnails/thumb1.jpg. A container's mtime only changes when a bundle is
+	added or removed from it, so containers are only listed again when their mtime has changed. Every bundle is still
+	stat'ed, since a bundle's own mtime changes when Plex regenerates its contents, and only bundles that are new or have
+	changed mtimes are searched for thumbnails.
+	"""
+	containers = index['containers']
+	bundles = index['bundles']
+	seen_containers = set()
+	seen_bundles = set()
+
+	stack = ['']
+	while stack:
+		rel_dir = stack.pop()
+		try:
+			mtime = os.stat(media_path / rel_dir).st_mtime
+		except FileNotFoundError:
+			continue
+		seen_containers.add(rel_dir)
+
+		container = containers.get(rel_dir)
+		if container is None or container['mtime'] != mtime:
+			subdirs, bundle_names = list_container(media_path / rel_dir)
+			container = {'mtime': mtime, 'subdirs': subdirs, 'bundles': bundle_names}
+			containers[rel_dir] = container
+
+		for bundle_name in container['bundles']:
+			rel_bundle = os.path.join(rel_dir, bundle_name)
+			seen_bundles.add(rel_bundle)
+			update_bundle(bundles, media_path, rel_bundle)
+
+		stack.extend(os.path.join(rel_dir, subdir) for subdir in container['subdirs'])
+
+	for rel_dir in set(containers) - seen_containers:
+		del containers[rel_dir]
+	for rel_bundle in set(bundles) - seen_bundles:
+		del bundles[rel_bundle]
+
+	return index
+
+
+def list_container(path):
+	subdirs = []
+	bundle_names = []
+	with os.scandir(path) as it:
+		for entry in it:
+			if not entry.is_dir(follow_symlinks=False):
+				continue
+			if entry.name.endswith(BUNDLE_SUFFIX):
+				bundle_names.append(entry.name)
+			else:
+				subdirs.append(entry.name)
+	return subdirs, bundle_names
+
+
+def update_bundle(bundles, media_path, rel_bundle):
+	try:
+		mtime = os.stat(media_path / rel_bundle).st_mtime
+	except FileNotFoundError:
+		bundles.pop(rel_bundle, None)
+		return
+
+	bundle = bundles.get(rel_bundle)
+	if bundle is not None and bundle['mtime'] == mtime:
+		return
+
+	thumbs = []
+	for thumb in (media_path / rel_bundle).rglob(THUMB_NAME):
+		thumbs.append([str(thumb.relative_to(media_path)), thumb.stat().st_mtime])
+	bundles[rel_bundle] = {'mtime': mtime, 'thumbs': thumbs}
+
+
+def set_thumb_mtime(index, media_path, thumb_path):
+	"""
+	Refresh the recorded mtime of a thumbnail that was replaced.
+	"""
+	rel_thumb = str(Path(thumb_path).relative_to(media_path))
+	for bundle in index['bundles'].values():
+		for thumb in bundle['thumbs']:
+			if thumb[0] == rel_thumb:
+				thumb[1] = Path(thumb_path).stat().st_mtime
+				return
+
+
+def sorted_thumbs(index):
+	"""
+	Return a list of (mtime, relative path) tuples for every indexed thumbnail, sorted by mtime.
+	"""
+	return sorted((mtime, rel_thumb) for bundle in index['bundles'].values() for rel_thumb, mtime in bundle['thumbs'])
+
+
+def find_thumbs(thumbs, target_time, window):
+	"""
+	Find the thumbnails in a sorted list of (mtime, path) tuples that were modified within window seconds of target_time.
+	Returns the matches and the closest thumbnail as (mtime, path), or None if there are no thumbnails.
+	"""
+	lo = bisect_left(thumbs, (target_time - window,))
+	hi = bisect_right(thumbs, (target_time + window, chr(0x10FFFF)))
+	matches = [thumb for thumb in thumbs[lo:hi] if abs(thumb[0] - target_time) < window]
+
+	i = bisect_left(thumbs, (target_time,))
+	neighbours = thumbs[max(i - 1, 0):i + 1]
+	closest = min(neighbours, key=lambda thumb: abs(thumb[0] - target_time), default=None)
+
+	return matches, closest
+
+
+def scan_thumbs(media_path, min_mtime=None, workers=SCAN_WORKERS):
+	"""
+	Yield (mtime, path) for thumbnails under media_path as they are found, without using the index.
+
+	The hashed directories a couple of levels below media_path are scanned concurrently. If min_mtime is given, only
+	thumbnails modified since then are yielded, and bundles last modified before it are skipped along with everything
+	inside them. Plex creates the bundle directory of a new Extra together with its thumbnails. The hashed container
+	directories above the bundles are always walked, since their mtimes only change when an entry is added to them
+	directly.
+	"""
+	roots = [Path(media_path)]
+	for _ in range(SCAN_FAN_OUT_DEPTH):
+		next_roots = []
+		for root in roots:
+			subdirs, thumbs = scan_dir(root, min_mtime)
+			next_roots.extend(subdirs)
+			yield from thumbs
+		roots = next_roots
+
+	pool = ThreadPoolExecutor(max_workers=workers)
+	try:
+		futures = [pool.submit(scan_subtree, root, min_mtime) for root in roots]
+		for future in as_completed(futures):
+			yield from future.result()
+	finally:
+		# Stop scanning any remaining subtrees if the caller stops iterating early
+		pool.shutdown(wait=False, cancel_futures=True)
+
+
+def scan_subtree(root, min_mtime):
+	found = []
+	stack = [root]
+	while stack:
+		subdirs, thumbs = scan_dir(stack.pop(), min_mtime)
+		stack.extend(subdirs)
+		found.extend(thumbs)
+	return found
+
+
+def scan_dir(path, min_mtime):
+	"""
+	List the subdirectories of path, leaving out bundles older than min_mtime, and the (mtime, path) of any thumbnail in
+	it that is not older than min_mtime.
+	"""
+	subdirs = []
+	thumbs = []
+	try:
+		with os.scandir(path) as it:
+			for entry in it:
+				if entry.is_dir(follow_symlinks=False):
+					if min_mtime is None or not entry.name.endswith(BUNDLE_SUFFIX) or entry.stat(follow_symlinks=False).st_mtime >= min_mtime:
+						subdirs.append(entry.path)
+				elif entry.name == THUMB_NAME:
+					mtime = entry.stat().st_mtime
+					if min_mtime is None or mtime >= min_mtime:
+						thumbs.append((mtime, Path(entry.path)))
+	except FileNotFoundError:
+		pass
+	return subdirs, thumbs
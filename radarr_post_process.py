@@ -1,27 +1,108 @@
 #!/usr/bin/env python3
 
+import argparse
 import os
 import logging
+import threading
+import time
 from pathlib import Path
-import subprocess
 
-from pymediainfo import MediaInfo
+import radarr_queue
+from mkv_append_tag import append_tags
+import mkv_probe
+import tracing
 
 HDR_REPLACE_STR = "HDR10"
+RELEASE_GROUP_TAG = "Release Group"
+RETRY_DELAY = 60
 
 
 log_file = Path(__file__).parent / "radarr_post_process.log"
 
-logging.basicConfig(filename=log_file, encoding='utf-8', level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
 logger = logging.getLogger(__name__)
 
 
+def configure_logging():
+    logging.basicConfig(filename=log_file, encoding='utf-8', level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
 def main():
-    event_type = os.environ.get('radarr_eventtype')
-    moviefile_path = os.environ.get('radarr_moviefile_path')
-    release_group = os.environ.get('radarr_moviefile_releasegroup')
-    
+    parser = argparse.ArgumentParser(description="Post process files imported by Radarr. Event details are read from radarr_* environment variables.")
+    parser.add_argument('--worker', action='store_true',
+        help="Run as a daemon that processes events added to the queue by radarr_queue.py instead of handling a single event.")
+    parser.add_argument('--concurrency', type=int, default=2, help="Number of queued events to process concurrently in worker mode.")
+    parser.add_argument('--retries', type=int, default=3, help="Number of times to retry a failed event in worker mode.")
+    parser.add_argument('--poll-interval', type=float, default=5, help="Seconds to wait before checking an empty queue again in worker mode.")
+    tracing.add_trace_args(parser)
+
+    args = parser.parse_args()
+    tracing.start(args.trace)
+    # Only log once there are events to handle, so that --help and argument errors do not create the log file
+    configure_logging()
+
+    if args.worker:
+        run_worker(args.concurrency, args.retries, args.poll_interval)
+    else:
+        process_event(os.environ)
+
+
+def run_worker(concurrency, retries, poll_interval):
+    conn = radarr_queue.connect()
+    radarr_queue.requeue_running(conn)
+    conn.close()
+
+    logger.info(f"Started worker with concurrency {concurrency}")
+
+    threads = [threading.Thread(target=drain_queue, args=(retries, poll_interval), daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def drain_queue(retries, poll_interval):
+    conn = radarr_queue.connect()
+    while True:
+        try:
+            handled = handle_next_event(conn, retries)
+        except Exception as e:
+            # Errors from the queue itself, such as a locked database, must not stop the worker thread
+            logger.exception(e)
+            handled = False
+        if not handled:
+            time.sleep(poll_interval)
+
+
+def handle_next_event(conn, retries):
+    """
+    Process the next queued event, returning False if there was nothing to do.
+    """
+    event = radarr_queue.claim(conn)
+    if event is None:
+        return False
+
+    event_id, env, attempts = event
+    try:
+        process_event(env)
+    except Exception as e:
+        logger.exception(e)
+        if attempts <= retries:
+            retry_delay = RETRY_DELAY * 2 ** (attempts - 1)
+            logger.info(f"Retrying event {event_id} in {retry_delay} seconds")
+            radarr_queue.fail(conn, event_id, repr(e), retry_delay)
+        else:
+            logger.error(f"Event {event_id} failed after {attempts} attempts")
+            radarr_queue.fail(conn, event_id, repr(e))
+        return True
+    radarr_queue.complete(conn, event_id)
+    return True
+
+
+def process_event(env):
+    event_type = env.get('radarr_eventtype')
+    moviefile_path = env.get('radarr_moviefile_path')
+    release_group = env.get('radarr_moviefile_releasegroup')
+
     logger.debug(f"radarr_eventtype={event_type}")
     logger.debug(f"radarr_moviefile_path={moviefile_path}")
     logger.debug(f"radarr_moviefile_releasegroup={release_group}")
@@ -30,35 +111,48 @@ def main():
         logger.info("Received Test Event from Radarr")
 
     if event_type == 'Download':
-        full_path = Path(os.environ.get('radarr_moviefile_path')).absolute()
+        from pymediainfo import MediaInfo
+
+        full_path = Path(env.get('radarr_moviefile_path')).absolute()
 
-        media_info = MediaInfo.parse(full_path)
+        with tracing.step("probe"):
+            media_info = MediaInfo.parse(full_path)
         video_data = media_info.video_tracks[0].to_data()
         hdr_format = video_data.get('other_hdr_format', [''])[0]
         logger.debug(f"hdr_format={hdr_format}")
 
-        if "HDR10+" in hdr_format:    
-            new_name = str(full_path.name).replace(HDR_REPLACE_STR, 'HDR10+')
-            full_path = full_path.rename(full_path.with_name(new_name))
-            logger.info(f"This file supports HDR10+, renamed to: {new_name}")
-
+        # Renaming is the last step, so that a retried event still finds the file at the path Radarr gave
+        final_path = full_path
+        if "HDR10+" in hdr_format:
+            final_path = full_path.with_name(str(full_path.name).replace(HDR_REPLACE_STR, 'HDR10+'))
 
-        release_group = os.environ.get('radarr_moviefile_releasegroup')
+        release_group = env.get('radarr_moviefile_releasegroup')
         logger.debug(f"radarr_moviefile_releasegroup={release_group}")
         if release_group:
-            with open(log_file, "a") as f:
-                subprocess.run(
-                    ["python3", Path(__file__).parent / "mkv_append_tag.py", full_path, "-g", f"Release Group={release_group}"],
-                    stdout=f, stderr=f
-                )
-            logger.info("Added release group tag.")
-
+            with tracing.step("probe"):
+                info = mkv_probe.probe(full_path)
+            # A retried event may have tagged the file already
+            if any(not tag.track_uids and tag.tags.get(RELEASE_GROUP_TAG) == release_group for tag in info.tags):
+                logger.info("Release group tag is already set.")
+            else:
+                with open(log_file, "a") as f:
+                    append_tags(full_path, [f"{RELEASE_GROUP_TAG}={release_group}"], info=info, output=f)
+                logger.info("Added release group tag.")
+
+        # Tagging only rewrites the header in place, extracting subtitles is the only full read of the file
         with open(log_file, "a") as f:
-            process = subprocess.run(
-                    ["mkvmerge", "-o", (full_path.parent / f"{full_path.stem}.mks").absolute(), "-A", "-D", "-B", "-T", "-M", "-s", "eng", full_path],
+            process = tracing.run(
+                    ["mkvmerge", "-o", (final_path.parent / f"{final_path.stem}.mks").absolute(), "-A", "-D", "-B", "-T", "-M", "-s", "eng", full_path],
                     stdout=f, stderr=f
             )
-            logger.info("Extracted subtitles.")
+        # mkvmerge exits with 1 if there were only warnings
+        if process.returncode > 1:
+            process.check_returncode()
+        logger.info("Extracted subtitles.")
+
+        if final_path != full_path:
+            full_path.rename(final_path)
+            logger.info(f"This file supports HDR10+, renamed to: {final_path.name}")
 
 
 def entrypoint():
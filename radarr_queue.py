@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+
+QUEUE_PATH = Path(__file__).parent / "radarr_queue.db"
+ENV_PREFIX = "radarr_"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    env TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    error TEXT
+)
+"""
+
+
+def connect(path=QUEUE_PATH):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(SCHEMA)
+    return conn
+
+
+def enqueue(env, path=QUEUE_PATH):
+    """
+    Add a Radarr event to the queue, only the radarr_* environment variables are stored.
+    """
+    event_env = {key: val for key, val in env.items() if key.startswith(ENV_PREFIX)}
+    now = time.time()
+    conn = connect(path)
+    try:
+        conn.execute(
+            "INSERT INTO events (env, available_at, created_at) VALUES (?, ?, ?)",
+            (json.dumps(event_env), now, now)
+        )
+    finally:
+        conn.close()
+
+
+def claim(conn):
+    """
+    Mark the oldest pending event as running and return (id, env, attempts), or None if there is nothing to do.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT id, env, attempts FROM events WHERE status = 'pending' AND available_at <= ? ORDER BY id LIMIT 1",
+            (time.time(),)
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute("UPDATE events SET status = 'running', attempts = attempts + 1 WHERE id = ?", (row[0],))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    event_id, env, attempts = row
+    return event_id, json.loads(env), attempts + 1
+
+
+def complete(conn, event_id):
+    conn.execute("UPDATE events SET status = 'done', error = NULL WHERE id = ?", (event_id,))
+
+
+def fail(conn, event_id, error, retry_delay=None):
+    """
+    Record a failed attempt. If a retry delay is given the event is rescheduled, otherwise it is marked as failed.
+    """
+    if retry_delay is None:
+        conn.execute("UPDATE events SET status = 'failed', error = ? WHERE id = ?", (error, event_id))
+    else:
+        conn.execute(
+            "UPDATE events SET status = 'pending', error = ?, available_at = ? WHERE id = ?",
+            (error, time.time() + retry_delay, event_id)
+        )
+
+
+def requeue_running(conn):
+    """
+    Return events left running by a worker that was stopped to the queue.
+    """
+    conn.execute("UPDATE events SET status = 'pending' WHERE status = 'running'")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add the Radarr event described by the radarr_* environment variables to the queue "
+        "processed by radarr_post_process.py --worker.")
+    parser.parse_args()
+    enqueue(os.environ)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
 import argparse
-import subprocess
+import os
+import sys
 
 from pathlib import Path
 
+from job_runner import add_runner_args, disk_read, disk_write, runner_from_args, JobRunner
+from ledger import add_ledger_args, ledger_from_args
+import tracing
+
 
 OUT_SUFFIX = "_no_cc.mkv"
 
@@ -10,24 +15,75 @@ OUT_SUFFIX = "_no_cc.mkv"
 def main():
     parser = argparse.ArgumentParser(description="Use ffmpeg to remove EIA-608 embedded closed captions.")
     parser.add_argument('path', type=str, help="Path to MKV file or directory of MKV files.")
+    parser.add_argument('--output-dir', '-o', type=str, default=".", help="Directory to write output files to, defaults to the current directory.")
+    parser.add_argument('--probe', default=True, type=bool, action=argparse.BooleanOptionalAction,
+        help="Probe the video track for closed captions and skip files without any.")
+    add_runner_args(parser)
+    add_ledger_args(parser)
+    tracing.add_trace_args(parser)
 
     args = parser.parse_args()
+    tracing.start(args.trace)
 
     target_path = Path(args.path)
+    output_dir = Path(args.output_dir)
+    assert output_dir.is_dir(), f"Output directory does not exist: {output_dir}"
 
     if target_path.is_dir():
-        for file in target_path.glob("*.mkv"):
-            remove_cc(file)
+        files = sorted(f for f in target_path.glob("*.mkv") if not f.name.endswith(OUT_SUFFIX))
     else:
-        remove_cc(target_path)
+        files = [target_path]
+
+    ledger = ledger_from_args(args)
+    options = {'output_dir': str(output_dir.resolve()), 'probe': args.probe}
+
+    with runner_from_args(args) as runner:
+        for file in files:
+            runner.submit(file.stem, process_file, runner, ledger, options, file, output_dir, args.probe, len(files) > 1)
+        if runner.wait():
+            sys.exit(1)
+
 
+def process_file(runner, ledger, options, file, output_dir, probe=True, quiet=False):
+    with ledger.entry("remove_cc", [file], options) as entry:
+        if entry.done:
+            print(f"{file.name} was already processed, skipping.")
+            return
+        if probe and not has_closed_captions(file, runner):
+            print(f"No closed captions found in {file.name}, skipping.")
+            return
+        entry.outputs = [remove_cc(file, output_dir, runner, quiet)]
 
-def remove_cc(path):
-    out_name = path.stem + OUT_SUFFIX
-    subprocess.run(
-        ["ffmpeg", "-i", path, "-codec", "copy", "-bsf:v", "filter_units=remove_types=6", out_name],
-        check=True
+
+def has_closed_captions(path, runner=None):
+    """
+    Check whether the first video track carries embedded closed captions.
+    ffprobe only decodes the first few frames of the stream to detect the caption SEI payloads.
+    """
+    runner = runner or JobRunner()
+    process = runner.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=closed_captions",
+         "-of", "default=noprint_wrappers=1:nokey=1", path],
+        capture=True
     )
+    return process.stdout.strip() == "1"
+
+
+def remove_cc(path, output_dir=Path("."), runner=None, quiet=False):
+    runner = runner or JobRunner()
+    out_name = Path(output_dir) / (path.stem + OUT_SUFFIX)
+    # Write to a temporary name first so that a failed or interrupted run never leaves a partial file at the output path
+    partial_name = out_name.with_name(out_name.name + ".partial")
+    cmd = ["ffmpeg", "-i", path, "-codec", "copy", "-bsf:v", "filter_units=remove_types=6", "-f", "matroska", "-y", partial_name]
+    if quiet:
+        cmd[1:1] = ["-hide_banner", "-loglevel", "error"]
+    try:
+        runner.run(cmd, [disk_read(path), disk_write(out_name)])
+        os.replace(partial_name, out_name)
+    finally:
+        if partial_name.exists():
+            partial_name.unlink()
+    return out_name
 
 
 if __name__ == "__main__":
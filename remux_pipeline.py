@@ -0,0 +1,208 @@
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+
+from job_runner import add_runner_args, disk_read, disk_write, runner_from_args
+from keyframes import add_keyframe_args, format_chapter_time, index_from_args, snap_chapter_times
+from ledger import add_ledger_args, ledger_from_args
+from merge_subs import find_subtitle, mkvmerge_cmd, plan_tracks, probe_tracks
+from mkv_append_tag import write_tags_xml
+import mkv_probe
+from remove_cc import has_closed_captions
+from rename_chapters import chapter_lines
+import tracing
+
+
+STEPS = ("remove_cc", "merge_subs", "append_tags", "rename_chapters")
+REMUX_STEPS = ("remove_cc", "merge_subs")
+CHAPTERS_SUFFIX = ".chapters.txt"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare MKV files with remove_cc, merge_subs, mkv_append_tag and rename_chapters, "
+        "rewriting each file at most once.")
+    parser.add_argument('paths', type=str, nargs='+', help="MKV files or directories of MKV files.")
+    parser.add_argument('--steps', type=str, nargs='+', choices=STEPS, required=True,
+        help="Steps to apply to each file. remove_cc and merge_subs are done together in a single remux into the output directory, "
+        "and append_tags and rename_chapters are applied to its output in a single header edit. Files that are not remuxed are edited in place.")
+    parser.add_argument('--output-dir', '-o', type=str,
+        help="Directory to write remuxed files to, required by the remove_cc and merge_subs steps. It must not contain any of the input files.")
+    parser.add_argument('--probe', default=True, type=bool, action=argparse.BooleanOptionalAction,
+        help="For remove_cc, probe the video track for closed captions and only remove them from files that have any.")
+    parser.add_argument('--general-tags', '-g', type=str, nargs='+', metavar='TAG', help="For append_tags, general tags in the format 'key=value'.")
+    parser.add_argument('--track-tags', '-t', type=str, nargs='+', metavar='TAG',
+        help="For append_tags, track tags in the format 'selector:key=value' as in mkv_append_tag. Selectors refer to the tracks of the output.")
+    parser.add_argument('--snap', default=False, type=bool, action=argparse.BooleanOptionalAction,
+        help="For rename_chapters, also snap the chapter times to the nearest keyframes.")
+    add_keyframe_args(parser)
+    add_runner_args(parser)
+    add_ledger_args(parser)
+    tracing.add_trace_args(parser)
+
+    args = parser.parse_args()
+    tracing.start(args.trace)
+
+    if "append_tags" in args.steps:
+        assert args.general_tags or args.track_tags, "The append_tags step needs at least one tag, specify them with --general-tags or --track-tags."
+
+    files = []
+    for path in map(Path, args.paths):
+        files.extend(sorted(path.glob("*.mkv")) if path.is_dir() else [path])
+
+    output_dir = None
+    if set(REMUX_STEPS) & set(args.steps):
+        if args.output_dir is None:
+            parser.error(f"--output-dir is required by the {' and '.join(REMUX_STEPS)} steps, remuxed files are never written over their input")
+        output_dir = Path(args.output_dir).resolve()
+        assert output_dir.is_dir(), f"Output directory does not exist: {output_dir}"
+        # Checked up front, rather than failing each file that would be remuxed while editing the others in place
+        for file in files:
+            if file.resolve().parent == output_dir:
+                parser.error(f"The output directory contains the input file {file.name}, choose a different output directory")
+
+    ledger = ledger_from_args(args)
+    index = index_from_args(args) if args.snap else None
+    options = {
+        'steps': sorted(set(args.steps)), 'output_dir': str(output_dir) if output_dir else None, 'probe': args.probe, 'general_tags': args.general_tags,
+        'track_tags': args.track_tags, 'snap': args.snap, 'tolerance': args.tolerance,
+    }
+
+    def process(file):
+        subtitle_file = find_subtitle(str(file.with_suffix(""))) if "merge_subs" in args.steps else None
+        inputs = [file, subtitle_file] if subtitle_file else [file]
+        # The chapters file is merged along with the subtitles, so changing it has to process the file again
+        if subtitle_file and file.with_name(file.stem + CHAPTERS_SUFFIX).exists():
+            inputs.append(file.with_name(file.stem + CHAPTERS_SUFFIX))
+        with ledger.entry("remux_pipeline", inputs, options) as entry:
+            if entry.done:
+                print(f"{file.name} was already processed, skipping.")
+                return
+            entry.outputs = [run_pipeline(file, subtitle_file, args.steps, output_dir, runner, args, index)]
+
+    with runner_from_args(args) as runner:
+        for file in files:
+            runner.submit(file.stem, process, file)
+        if runner.wait():
+            sys.exit(1)
+
+
+def run_pipeline(file, subtitle_file, steps, output_dir, runner, args, index=None):
+    """
+    Apply the steps to a file and return the path of the result. The stream steps are planned first and done in one
+    remux, with ffmpeg if closed captions have to be removed and mkvmerge otherwise. Tags and chapters are then
+    prepared from the header of the result and applied together with the track name edits of merge_subs in one
+    mkvpropedit call.
+    """
+    plan = None
+    if subtitle_file:
+        tracks = probe_tracks([str(file)])[str(file)]
+        assert tracks is not None, f"Could not probe {file.name}"
+        plan = plan_tracks(tracks)
+        if plan is None:
+            print(f"No audio tracks found in {file.name}, not merging subtitles.")
+    elif "merge_subs" in steps:
+        print(f"No matching subtitle file found for {file.name}, not merging subtitles.")
+
+    remove_cc = "remove_cc" in steps and (not args.probe or has_closed_captions(file, runner))
+    if "remove_cc" in steps and not remove_cc:
+        print(f"No closed captions found in {file.name}, not removing them.")
+
+    output = file
+    edits = []
+    chapters_file = None
+    if remove_cc or plan:
+        output = output_dir / (file.stem + ".mkv")
+        if output == file.resolve():
+            raise ValueError(f"Remuxing {file.name} would overwrite it, choose a different output directory.")
+        if remove_cc:
+            runner.run(ffmpeg_cmd(output, file, subtitle_file if plan else None, plan), [disk_read(file), disk_write(output)], label="remux")
+        else:
+            result = runner.run(mkvmerge_cmd(output, file, subtitle_file, plan), [disk_read(file), disk_write(output)], check=False, label="remux")
+            # mkvmerge exits with 1 if there were only warnings
+            if result.returncode > 1:
+                result.check_returncode()
+    if plan:
+        edits += ["--edit", "track:a1", "--delete", "name", "--edit", "track:v1", "--delete", "name"]
+        if file.with_name(file.stem + CHAPTERS_SUFFIX).exists():
+            print("Chapters file found, integrating chapters...")
+            chapters_file = file.with_name(file.stem + CHAPTERS_SUFFIX)
+
+    # The metadata steps only read the header of the output
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if "rename_chapters" in steps:
+            names, times = read_chapters(chapters_file) if chapters_file else probe_chapters(output)
+            if index is not None:
+                times, moved = snap_chapter_times(times, index.keyframes(output, runner), args.tolerance)
+                print(f"Snapped {moved} of {len(times)} chapters of {output.name} to keyframes.")
+            if times:
+                chapters_file = Path(tmp_dir) / (file.stem + CHAPTERS_SUFFIX)
+                with open(chapters_file, "w") as f:
+                    f.writelines(chapter_lines(names, times))
+        if chapters_file:
+            edits += ["--chapters", chapters_file]
+
+        if "append_tags" in steps:
+            tags_file = Path(tmp_dir) / (file.stem + "_tags.xml")
+            write_tags_xml(output, tags_file, args.general_tags, args.track_tags)
+            edits += ["--tags", f"all:{tags_file}"]
+
+        if edits:
+            runner.run(["mkvpropedit", output, *edits], [disk_write(output)], label="edit header")
+    return output
+
+
+def ffmpeg_cmd(output, file, subtitle_file=None, plan=None):
+    """
+    Build the ffmpeg command that remuxes file without its closed captions. If a merge_subs plan is given, only its tracks
+    are kept in its order and with its flags, along with the external subtitle. Otherwise every stream is kept as is.
+
+    With a plan, the output has the same metadata as mkvmerge_cmd's: no global tags or title, and the chapters,
+    attachments, track names, languages and flags of the kept tracks. The only difference is that mkvmerge writes new
+    track statistics tags, while ffmpeg copies them unchanged.
+    """
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", file]
+    if plan is None:
+        return cmd + ["-map", "0", "-codec", "copy", "-bsf:v", "filter_units=remove_types=6", output]
+
+    cmd += ["-i", subtitle_file]
+    for planned in plan:
+        # ffmpeg numbers the streams of a Matroska file in the same order as mkvmerge's track IDs
+        cmd += ["-map", "1:0" if planned.track is None else f"0:{planned.track.id}"]
+    # Attachments such as fonts are kept like mkvmerge does, global tags and the title are dropped like merge_subs does
+    cmd += ["-map", "0:t?", "-codec", "copy", "-bsf:v", "filter_units=remove_types=6", "-map_metadata:g", "-1", "-metadata", "title="]
+
+    for i, planned in enumerate(plan):
+        if planned.track is None:
+            cmd += [f"-metadata:s:{i}", "language=eng"]
+            default, forced = planned.default, False
+        else:
+            default = planned.track.default if planned.default is None else planned.default
+            forced = planned.track.forced if planned.forced is None else planned.forced
+        commentary = planned.track is not None and planned.track.commentary
+        flags = (("default", default), ("forced", forced), ("comment", commentary))
+        cmd += [f"-disposition:{i}", "+".join(flag for flag, on in flags if on) or "0"]
+        if planned.name is not None:
+            cmd += [f"-metadata:s:{i}", f"title={planned.name}"]
+    return cmd + [output]
+
+
+def read_chapters(path):
+    names = []
+    times = []
+    with open(path) as f:
+        for line in f:
+            if "NAME" in line:
+                names.append(line.split("=")[1].strip())
+            elif "=" in line:
+                times.append(line.split("=")[1].strip())
+    return names, times
+
+
+def probe_chapters(path):
+    chapters = mkv_probe.probe(path).chapters
+    return [chapter.name or "" for chapter in chapters], [format_chapter_time(chapter.start) for chapter in chapters]
+
+
+if __name__ == "__main__":
+    main()
@@ -1,54 +1,83 @@
 import argparse
+import sys
 import re
-from subprocess import run
+import tempfile
 from pathlib import Path
 
+from job_runner import add_runner_args, disk_read, disk_write, runner_from_args, JobRunner
+from keyframes import add_keyframe_args, index_from_args, snap_chapter_times, SNAP_TOLERANCE
+import tracing
+
 ORIGINAL_CHAPTERS_FILE = "{}.chapters.txt"
 RENAMED_CHAPTERS_FILE = "{}-renamed.chapters.txt"
 
 
-def cleanup():
-    for f in Path.cwd().glob("*.chapters.txt"):
-        f.unlink()
-
-
 def main():
     parser = argparse.ArgumentParser(description="Replace uninformative MKV chapter names with numbers.")
-    parser.add_argument('input', type=str, help="Path to MKV file with chapters")
+    parser.add_argument('input', type=str, nargs='+', help="Path to one or more MKV files with chapters")
+    parser.add_argument('--snap', default=False, type=bool, action=argparse.BooleanOptionalAction,
+        help="Also snap the chapter times to the nearest keyframes of each file.")
+    add_keyframe_args(parser)
+    add_runner_args(parser)
+    tracing.add_trace_args(parser)
 
     args = parser.parse_args()
+    tracing.start(args.trace)
+
+    index = index_from_args(args) if args.snap else None
+
+    with runner_from_args(args) as runner:
+        for filepath in map(Path, args.input):
+            runner.submit(filepath.stem, rename_chapters, filepath, runner, index, args.tolerance)
+        if runner.wait():
+            sys.exit(1)
+
+
+def rename_chapters(filepath, runner=None, index=None, tolerance=SNAP_TOLERANCE):
+    """
+    Number chapters with uninformative names, and snap their times to keyframes using the KeyframeIndex index if given.
+    """
+    runner = runner or JobRunner()
 
-    filepath = Path(args.input)
-
-    run(["mkvextract", filepath, "chapters", "-s", ORIGINAL_CHAPTERS_FILE.format(filepath.stem)], check=True)
-    names = []
-    times = []
-    with open(ORIGINAL_CHAPTERS_FILE.format(filepath.stem)) as f:
-        for line in f:
-            if "NAME" in line:
-                names.append(line.split("=")[1].strip())
-            if "NAME" not in line:
-                times.append(line.split("=")[1].strip())
-                
+    # Files are renamed concurrently, so each keeps its chapter files in its own temporary directory
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        original_chapters = Path(tmp_dir) / ORIGINAL_CHAPTERS_FILE.format(filepath.stem)
+        renamed_chapters = Path(tmp_dir) / RENAMED_CHAPTERS_FILE.format(filepath.stem)
+
+        runner.run(["mkvextract", filepath, "chapters", "-s", original_chapters], [disk_read(filepath)])
+        names = []
+        times = []
+        with open(original_chapters) as f:
+            for line in f:
+                if "NAME" in line:
+                    names.append(line.split("=")[1].strip())
+                if "NAME" not in line:
+                    times.append(line.split("=")[1].strip())
+
+        if index is not None:
+            times, moved = snap_chapter_times(times, index.keyframes(filepath, runner), tolerance)
+            print(f"Snapped {moved} of {len(times)} chapters of {filepath.name} to keyframes.")
+
+        with open(renamed_chapters, "w+") as f:
+            f.writelines(chapter_lines(names, times))
+        runner.run(["mkvpropedit", filepath, "--chapters", renamed_chapters], [disk_write(filepath)])
+
+
+def chapter_lines(names, times):
+    """
+    Lines of a simple chapters file with names that are only a timestamp or number replaced by the chapter number.
+    """
     output = []
     for i, (name, time) in enumerate(zip(names, times)):
         if re.fullmatch("^[0-9|:|\.]+$", name):
             name = f"Chapter {i+1:02}"
         output.append(f"CHAPTER{i+1:02}={time}\n")
         output.append(f"CHAPTER{i+1:02}NAME={name}\n")
-
-    with open(RENAMED_CHAPTERS_FILE.format(filepath.stem), "w+") as f:
-        f.writelines(output)
-    run(["mkvpropedit", filepath, "--chapters", RENAMED_CHAPTERS_FILE.format(filepath.stem)], check=True)
+    return output
 
 
 def entrypoint():
-    try:
-        main()
-    except:
-        raise
-    finally:
-        cleanup()
+    main()
 
 
 if __name__ == "__main__":
@@ -5,6 +5,7 @@ setup(
     version='0.1',
     description='A collection of scripts and utilities to manipulate media files.',
     install_requires=[
+        'numpy',
         'pymediainfo',
         'plexapi',
         'pythumb',
@@ -19,11 +20,19 @@ setup(
             'combine_chapters=combine_chapters:main',
             'gifenc=gifenc:main',
             'merge_subs=merge_subs:main',
+            'media_probe=media_probe:main',
+            'light_levels=light_levels:main',
             'set_extra_thumbnail=plex_extras_thumbnail.set_extra_thumbnail:main',
             'rename_chapters=rename_chapters:entrypoint',
             'dv_hybrid=dv_hdr_hybrid.dv_hybrid:main',
             'merge_hybrid=dv_hdr_hybrid.merge_hybrid:main',
-            'remove_cc=remove_cc:main'
+            'pair_files=pair_files:main',
+            'remove_cc=remove_cc:main',
+            'remux_pipeline=remux_pipeline:main',
+            'sup_filter=extract_timecodes.sup_filter:main',
+            'tag_episodes=tv_episode_tagger.tag_episodes:main',
+            'watch_folder=watch_folder:main',
+            'media-utils=media_utils:main'
         ],
     }
 )
\ No newline at end of file
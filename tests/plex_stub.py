@@ -0,0 +1,118 @@
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import quoteattr
+
+
+SERVER_XML = '<MediaContainer friendlyName="stub" machineIdentifier="stub" version="1.40.0.0" myPlex="0"/>'
+
+
+class PlexStub:
+    """
+    Plex Media Server stand-in for tests, serving just enough of the HTTP API for plexapi to open a server, look up a
+    library section, search it by title, load a movie, list its Extras and refresh it.
+
+    libraries maps section titles to lists of movies, each a dict with a title, year and the titles and file paths of
+    its extras as a list of (title, path). Every request is counted in requests by method and path.
+    """
+
+    def __init__(self, libraries):
+        self.sections = []
+        self.movies = {}
+        rating_key = 100
+        for section_key, (library, movies) in enumerate(libraries.items(), start=1):
+            self.sections.append((str(section_key), library))
+            for movie in movies:
+                rating_key += 1
+                self.movies[str(rating_key)] = {**movie, 'section': str(section_key)}
+        self.requests = Counter()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                stub.handle(self, "GET")
+
+            def do_PUT(self):
+                stub.handle(self, "PUT")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def rating_key(self, title):
+        return next(key for key, movie in self.movies.items() if movie['title'] == title)
+
+    def handle(self, handler, method):
+        url = urlsplit(handler.path)
+        path = url.path.rstrip("/") or "/"
+        self.requests[method, path] += 1
+        body = self.respond(method, path, parse_qs(url.query))
+        if body is None:
+            handler.send_response(404)
+            handler.end_headers()
+            return
+        data = body.encode()
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/xml;charset=utf-8")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def respond(self, method, path, query):
+        parts = path.strip("/").split("/")
+        if method == "PUT":
+            if len(parts) == 4 and parts[:2] == ["library", "metadata"] and parts[3] == "refresh" and parts[2] in self.movies:
+                return ""
+            return None
+        if path == "/":
+            return SERVER_XML
+        if path == "/library":
+            return '<MediaContainer size="0" title1="Plex Library"/>'
+        if path == "/library/sections":
+            directories = "".join(
+                f'<Directory key="{key}" type="movie" title={quoteattr(title)} agent="tv.plex.agents.movie" '
+                f'scanner="Plex Movie" language="en-US" uuid="section-{key}"/>'
+                for key, title in self.sections
+            )
+            return f'<MediaContainer size="{len(self.sections)}">{directories}</MediaContainer>'
+        if len(parts) == 4 and parts[:2] == ["library", "sections"] and parts[3] == "all":
+            titles = query.get("title", [])
+            movies = [(key, movie) for key, movie in self.movies.items()
+                if movie['section'] == parts[2] and (not titles or movie['title'].lower() == titles[0].lower())]
+            return container(movie_xml(key, movie) for key, movie in movies)
+        if len(parts) == 3 and parts[:2] == ["library", "metadata"] and parts[2] in self.movies:
+            # plexapi reloads the full metadata of a search result when it needs an attribute it does not have
+            return container([movie_xml(parts[2], self.movies[parts[2]])])
+        if len(parts) == 4 and parts[:2] == ["library", "metadata"] and parts[3] == "extras" and parts[2] in self.movies:
+            movie = self.movies[parts[2]]
+            return container(extra_xml(f"{parts[2]}{i}", title, file) for i, (title, file) in enumerate(movie['extras']))
+        return None
+
+
+def container(elements):
+    elements = list(elements)
+    return f'<MediaContainer size="{len(elements)}" totalSize="{len(elements)}" offset="0">{"".join(elements)}</MediaContainer>'
+
+
+def movie_xml(rating_key, movie):
+    return (f'<Video ratingKey="{rating_key}" key="/library/metadata/{rating_key}" type="movie" title={quoteattr(movie["title"])} '
+        f'year="{movie["year"]}" librarySectionID="{movie["section"]}"/>')
+
+
+def extra_xml(rating_key, title, file):
+    return (f'<Video ratingKey="{rating_key}" key="/library/metadata/{rating_key}" type="clip" subtype="behindTheScenes" '
+        f'extraType="5" title={quoteattr(title)}><Media id="{rating_key}"><Part id="{rating_key}" file={quoteattr(str(file))}/></Media></Video>')
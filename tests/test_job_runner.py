@@ -0,0 +1,51 @@
+import sys
+import time
+
+import pytest
+
+import job_runner
+from job_runner import JobRunner
+import tracing
+
+
+def fail(message):
+    raise RuntimeError(message)
+
+
+def test_wait_only_reports_failures_since_the_last_wait():
+    with JobRunner() as runner:
+        runner.submit("first", fail, "first")
+        assert [name for name, _ in runner.wait()] == ["first"]
+
+        runner.submit("second", fail, "second")
+        runner.submit("ok", print, "ok")
+        assert [name for name, _ in runner.wait()] == ["second"]
+        assert runner.wait() == []
+
+
+def test_failures_are_capped_without_wait(monkeypatch, capsys):
+    monkeypatch.setattr(job_runner, "MAX_FAILURES", 2)
+    with JobRunner() as runner:
+        for i in range(5):
+            runner.submit(f"job{i}", fail, "boom")
+        # Tasks are only forgotten once their done callback has recorded the failure
+        while runner._futures:
+            time.sleep(0.01)
+        assert len(runner._failures) == 2
+        assert len(runner.wait()) == 2
+    assert "5 of 5 jobs failed" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("kwargs", [{'input': b"data"}, {'timeout': 5}])
+def test_tracing_run_rejects_unsupported_arguments(kwargs):
+    with pytest.raises(TypeError):
+        tracing.run([sys.executable, "-c", "pass"], **kwargs)
+
+
+def test_hold_cpu_slots_blocks_other_cpu_jobs():
+    with JobRunner(cpu=2) as runner:
+        with runner.hold([job_runner.CPU], cpu_slots=2):
+            future = runner.submit("cpu", runner.run, [sys.executable, "-c", "pass"], [job_runner.CPU])
+            time.sleep(0.5)
+            assert not future.done()
+        future.result(timeout=10)
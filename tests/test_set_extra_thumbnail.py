@@ -0,0 +1,63 @@
+import argparse
+import csv
+import os
+
+from plexapi.server import PlexServer
+
+from plex_extras_thumbnail.set_extra_thumbnail import read_manifest, run_batch
+from tests.plex_stub import PlexStub
+
+
+EXTRA_TIME = 1_700_000_000
+
+
+def make_thumb(media_path, rel_bundle, mtime):
+    thumb = media_path / rel_bundle / "Contents/Thumbnails/thumb1.jpg"
+    thumb.parent.mkdir(parents=True)
+    thumb.write_bytes(b"old")
+    os.utime(thumb, (mtime, mtime))
+    os.utime(thumb.parent.parent.parent, (mtime, mtime))
+    return thumb
+
+
+def test_run_batch_replaces_thumbnails_and_refreshes_each_title_once(tmp_path):
+    extras = {}
+    for i, name in enumerate(("Making Of", "Deleted Scenes")):
+        extras[name] = tmp_path / "extras" / f"{name}.mkv"
+        extras[name].parent.mkdir(exist_ok=True)
+        extras[name].touch()
+        os.utime(extras[name], (EXTRA_TIME + i * 1000, EXTRA_TIME + i * 1000))
+
+    media_path = tmp_path / "Media"
+    thumbs = {
+        "Making Of": make_thumb(media_path, "localhost/1/a1.bundle", EXTRA_TIME + 5),
+        "Deleted Scenes": make_thumb(media_path, "localhost/2/b2.bundle", EXTRA_TIME + 1000 + 5),
+    }
+    # A thumbnail that is far from both extras' times must be left alone
+    other_thumb = make_thumb(media_path, "localhost/3/c3.bundle", EXTRA_TIME + 50000)
+
+    manifest = tmp_path / "manifest.csv"
+    with open(manifest, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["library", "title", "extra", "thumbnail"])
+        for name in extras:
+            new_thumb = tmp_path / f"{name}.jpg"
+            new_thumb.write_bytes(f"new {name}".encode())
+            writer.writerow(["Movies", "Some Movie", name, str(new_thumb)])
+
+    libraries = {"Movies": [{'title': "Some Movie", 'year': 2020, 'extras': list(extras.items())}]}
+    with PlexStub(libraries) as stub:
+        plex = PlexServer(stub.url, "token")
+        args = argparse.Namespace(index=False, rebuild_index=False, refresh=True)
+        run_batch(plex, media_path, read_manifest(manifest), args)
+
+    for name, thumb in thumbs.items():
+        assert thumb.read_bytes() == f"new {name}".encode()
+        assert not thumb.with_name(thumb.name + ".tmp").exists()
+    assert other_thumb.read_bytes() == b"old"
+
+    # Both rows share the movie, so it is searched for, listed and refreshed once
+    rating_key = stub.rating_key("Some Movie")
+    assert stub.requests["GET", "/library/sections/1/all"] == 1
+    assert stub.requests["GET", f"/library/metadata/{rating_key}/extras"] == 1
+    assert stub.requests["PUT", f"/library/metadata/{rating_key}/refresh"] == 1
@@ -0,0 +1,40 @@
+import os
+from pathlib import Path
+
+from plex_extras_thumbnail.thumb_index import empty_index, index_path_for, sorted_thumbs, update_index
+
+
+CONTAINER_TIME = 1_700_000_000
+
+
+def test_update_index_rescans_changed_bundle_in_unchanged_container(tmp_path):
+    container = tmp_path / "localhost/1"
+    bundle = container / "a1.bundle"
+    thumb = bundle / "Contents/Thumbnails/thumb1.jpg"
+    thumb.parent.mkdir(parents=True)
+    thumb.touch()
+    os.utime(thumb, (CONTAINER_TIME, CONTAINER_TIME))
+    os.utime(bundle, (CONTAINER_TIME, CONTAINER_TIME))
+    os.utime(container, (CONTAINER_TIME, CONTAINER_TIME))
+
+    index = update_index(empty_index(), tmp_path)
+    assert sorted_thumbs(index) == [(CONTAINER_TIME, str(thumb.relative_to(tmp_path)))]
+
+    # Plex regenerates the bundle's contents without adding or removing anything in its container
+    new_thumb = bundle / "Contents/Art/thumb1.jpg"
+    new_thumb.parent.mkdir()
+    new_thumb.touch()
+    os.utime(new_thumb, (CONTAINER_TIME + 10, CONTAINER_TIME + 10))
+    os.utime(bundle, (CONTAINER_TIME + 10, CONTAINER_TIME + 10))
+    os.utime(container, (CONTAINER_TIME, CONTAINER_TIME))
+
+    update_index(index, tmp_path)
+    assert sorted_thumbs(index) == [
+        (CONTAINER_TIME, str(thumb.relative_to(tmp_path))),
+        (CONTAINER_TIME + 10, str(new_thumb.relative_to(tmp_path))),
+    ]
+
+
+def test_index_path_for_keeps_configs_apart():
+    assert index_path_for("plex/config.json") == Path("plex/config.thumb_index.json")
+    assert index_path_for("plex/config.json") != index_path_for("plex/other.json")
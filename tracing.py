@@ -0,0 +1,190 @@
+import atexit
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, only wall time is recorded there
+    resource = None
+
+
+# ru_maxrss is reported in kilobytes on Linux and bytes on macOS, block I/O is counted in 512 byte units on Linux
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+BLOCK_SIZE = 512
+# Per thread usage is only available on Linux, steps fall back to the usage of the whole process elsewhere
+RUSAGE_STEP = getattr(resource, 'RUSAGE_THREAD', None) or getattr(resource, 'RUSAGE_SELF', None)
+
+_tracer = None
+
+
+def add_trace_args(parser):
+    parser.add_argument('--trace', type=str, metavar='PATH',
+        help="Record the wall time, CPU time, peak memory and disk I/O of each step and external command, "
+        "and write them to PATH as Chrome trace event JSON. A summary table is printed on exit.")
+
+
+def start(trace_path):
+    """
+    Start recording a trace that is written to trace_path when the program exits. Does nothing if trace_path is None.
+    """
+    global _tracer
+    if trace_path is None or _tracer is not None:
+        return
+    _tracer = Tracer(trace_path)
+    atexit.register(_tracer.finish)
+
+
+def enabled():
+    return _tracer is not None
+
+
+@contextmanager
+def step(name, **args):
+    """
+    Record the time spent in a block of code as a step named name. Extra keyword arguments are stored with the event.
+    """
+    if _tracer is None:
+        yield
+        return
+
+    start_ns = time.perf_counter_ns()
+    start_cpu = time.thread_time()
+    start_usage = resource.getrusage(RUSAGE_STEP) if resource else None
+    try:
+        yield
+    finally:
+        end_ns = time.perf_counter_ns()
+        stats = {'cpu_s': time.thread_time() - start_cpu}
+        if start_usage:
+            end_usage = resource.getrusage(RUSAGE_STEP)
+            stats['read_bytes'] = (end_usage.ru_inblock - start_usage.ru_inblock) * BLOCK_SIZE
+            stats['write_bytes'] = (end_usage.ru_oublock - start_usage.ru_oublock) * BLOCK_SIZE
+        _tracer.record(name, 'step', start_ns, end_ns, stats, args)
+
+
+def communicate(process, name=None):
+    """
+    Equivalent of process.communicate() that also records the resource usage of the process when tracing.
+    """
+    if _tracer is None or not hasattr(os, 'wait4'):
+        return process.communicate()
+
+    start_ns = time.perf_counter_ns()
+    outputs = {}
+    readers = []
+    for key, pipe in (('stdout', process.stdout), ('stderr', process.stderr)):
+        if pipe is not None:
+            reader = threading.Thread(target=lambda key=key, pipe=pipe: outputs.__setitem__(key, pipe.read()))
+            reader.start()
+            readers.append(reader)
+    for reader in readers:
+        reader.join()
+    for pipe in (process.stdout, process.stderr):
+        if pipe is not None:
+            pipe.close()
+
+    # Reap the process ourselves, since the resource usage of a single child is only available from wait4
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    end_ns = time.perf_counter_ns()
+
+    stats = {
+        'cpu_s': usage.ru_utime + usage.ru_stime,
+        'peak_rss_bytes': usage.ru_maxrss * MAXRSS_UNIT,
+        'read_bytes': usage.ru_inblock * BLOCK_SIZE,
+        'write_bytes': usage.ru_oublock * BLOCK_SIZE,
+    }
+    args = [str(arg) for arg in process.args]
+    _tracer.record(name or Path(args[0]).name, 'process', start_ns, end_ns, stats, {'cmd': args, 'returncode': process.returncode})
+
+    return outputs.get('stdout'), outputs.get('stderr')
+
+
+def run(cmd, check=False, capture_output=False, stdout=None, stderr=None, name=None, **kwargs):
+    """
+    Drop in replacement for subprocess.run that records the command when tracing. input and timeout are not supported,
+    since the traced process is reaped with wait4 once its output pipes close.
+    """
+    unsupported = sorted({'input', 'timeout'} & kwargs.keys())
+    if unsupported:
+        raise TypeError(f"tracing.run() does not support {', '.join(unsupported)}")
+    if capture_output:
+        stdout = stderr = subprocess.PIPE
+    process = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, **kwargs)
+    try:
+        out, err = communicate(process, name)
+    except:
+        process.kill()
+        process.wait()
+        raise
+
+    result = subprocess.CompletedProcess(cmd, process.returncode, out, err)
+    if check:
+        result.check_returncode()
+    return result
+
+
+class Tracer:
+
+    def __init__(self, trace_path):
+        self.trace_path = Path(trace_path)
+        self.origin_ns = time.perf_counter_ns()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, name, category, start_ns, end_ns, stats, args):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start_ns - self.origin_ns) / 1000,
+            'dur': (end_ns - start_ns) / 1000,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': {**stats, **args},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def finish(self):
+        with open(self.trace_path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        print_summary(self.events, file=sys.stderr)
+        print(f"Trace written to {self.trace_path}", file=sys.stderr)
+
+
+def summarize(events):
+    """
+    Aggregate trace events by name, returning a list of rows sorted by total wall time.
+    """
+    rows = {}
+    for event in events:
+        row = rows.setdefault(event['name'], {
+            'name': event['name'], 'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_bytes': 0, 'read_bytes': 0, 'write_bytes': 0
+        })
+        args = event['args']
+        row['count'] += 1
+        row['wall_s'] += event['dur'] / 1e6
+        row['cpu_s'] += args.get('cpu_s', 0)
+        row['peak_rss_bytes'] = max(row['peak_rss_bytes'], args.get('peak_rss_bytes', 0))
+        row['read_bytes'] += args.get('read_bytes', 0)
+        row['write_bytes'] += args.get('write_bytes', 0)
+    return sorted(rows.values(), key=lambda row: row['wall_s'], reverse=True)
+
+
+def print_summary(events, file=sys.stdout):
+    mib = 1024 * 1024
+    print(f"\n{'step':<32} {'count':>6} {'wall s':>10} {'cpu s':>10} {'peak RSS MiB':>13} {'read MiB':>10} {'write MiB':>10}", file=file)
+    for row in summarize(events):
+        print(
+            f"{row['name'][:32]:<32} {row['count']:>6} {row['wall_s']:>10.2f} {row['cpu_s']:>10.2f} "
+            f"{row['peak_rss_bytes'] / mib:>13.1f} {row['read_bytes'] / mib:>10.1f} {row['write_bytes'] / mib:>10.1f}",
+            file=file
+        )
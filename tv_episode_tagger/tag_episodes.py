@@ -0,0 +1,101 @@
+from pathlib import Path
+import argparse
+import copy
+import csv
+import json
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+
+from job_runner import add_runner_args, disk_write, runner_from_args, JobRunner
+import tracing
+
+
+TEMPLATE_PATH = Path(__file__).parent / "tv_show_template.xml"
+DOC_TYPE = '<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE Tags SYSTEM "matroskatags.dtd">'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Set the title and TV show tags of MKV episodes in place from a manifest.")
+    parser.add_argument('manifest', type=str,
+        help="Path to a CSV or JSON manifest of episodes with the fields file, title, season, season_total, episode and episode_imdb.")
+    parser.add_argument('--imdb', type=str, required=True, help="IMDB id of the series, e.g. tt0944947")
+    parser.add_argument('--tmdb', type=str, required=True, help="TMDB id of the series, e.g. tv/1399")
+    parser.add_argument('--tvdb', type=str, required=True, help="TVDB id of the series, e.g. 121361")
+    add_runner_args(parser)
+    tracing.add_trace_args(parser)
+
+    args = parser.parse_args()
+    tracing.start(args.trace)
+
+    manifest_path = Path(args.manifest)
+    episodes = read_manifest(manifest_path)
+
+    template = ET.parse(TEMPLATE_PATH).getroot()
+    fill_tag(template[0], {'IMDB': args.imdb, 'TMDB': args.tmdb, 'TVDB': args.tvdb})
+
+    with tempfile.TemporaryDirectory() as tmp_dir, runner_from_args(args) as runner:
+        for episode in episodes:
+            # Relative paths in the manifest are relative to the manifest itself
+            mkv_path = manifest_path.parent / episode['file']
+            runner.submit(mkv_path.stem, tag_episode, mkv_path, episode, template, Path(tmp_dir), runner)
+        if runner.wait():
+            sys.exit(1)
+
+
+def tag_episode(mkv_path, episode, template, tmp_dir, runner=None):
+    """
+    Set the title and tags of an episode in place, writing its tags XML to tmp_dir first.
+    """
+    runner = runner or JobRunner()
+    xml_path = tmp_dir / (mkv_path.stem + ".xml")
+    write_tags(generate_tags(template, episode), xml_path)
+    runner.run(["mkvpropedit", mkv_path, "--edit", "info", "--set", f"title={episode['title']}", "--tags", f"global:{xml_path}"],
+        [disk_write(mkv_path)])
+    print(f"Tagged {mkv_path.name}")
+
+
+def read_manifest(manifest_path):
+    with open(manifest_path, newline='') as f:
+        if manifest_path.suffix.lower() == ".json":
+            episodes = json.load(f)
+        else:
+            episodes = list(csv.DictReader(f))
+    return [{key: str(val) for key, val in episode.items()} for episode in episodes]
+
+
+def fill_tag(tag, values):
+    for child in tag:
+        if child.tag == "Simple":
+            child.find('String').text = values[child.find('Name').text]
+
+
+def generate_tags(template, episode):
+    """
+    Copy the template, which already has the series ids filled in, and fill in the season and episode tags.
+    """
+    root = copy.deepcopy(template)
+    show_tag, season_tag, episode_tag = root
+
+    fill_tag(season_tag, {
+        'PART_NUMBER': episode['season'],
+        'TOTAL_PARTS': episode['season_total'],
+    })
+    fill_tag(episode_tag, {
+        'PART_NUMBER': episode['episode'],
+        'IMDB': episode['episode_imdb'],
+    })
+
+    return root
+
+
+def write_tags(root, output_filename):
+    tree = ET.ElementTree(root)
+    ET.indent(tree, ' ' * 4)
+    with open(output_filename, "w+", encoding='UTF-8') as xf:
+        tostring = ET.tostring(root).decode('utf-8')
+        xf.write(f"{DOC_TYPE}\n{tostring}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+import argparse
+import ctypes
+import ctypes.util
+import fnmatch
+import json
+import os
+import queue
+import select
+import sqlite3
+import struct
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from job_runner import CPU, JobRunner
+import media_utils
+import tracing
+
+
+CONFIG_PATH = Path(__file__).parent / "watch_folder.json"
+STATE_PATH = Path(__file__).parent / "watch_folder.db"
+MEDIA_UTILS = Path(media_utils.__file__)
+
+SETTLE_TIME = 30
+POLL_INTERVAL = 5
+
+# inotify event flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+IN_EVENT = struct.Struct("iIII")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    error TEXT
+)
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Watch directories for new files and run each one through a pipeline of media-utils commands once it has "
+        "finished being written.")
+    parser.add_argument('--config', type=str, default=CONFIG_PATH, help="Path to the config file, defaults to watch_folder.json next to this script.")
+    parser.add_argument('--state', type=str, default=STATE_PATH,
+        help="Path to the database of processed files, defaults to watch_folder.db next to this script.")
+    parser.add_argument('--jobs', '-j', type=int, default=2, help="Maximum number of pipeline commands to run at once.")
+    parser.add_argument('--retries', type=int, default=0, help="Number of times to retry a failed pipeline command.")
+    parser.add_argument('--log-dir', type=str, help="Write the output of each file's pipeline to its own log file in this directory.")
+    parser.add_argument('--poll', action='store_true', help="Poll the directories for changes instead of using inotify.")
+    tracing.add_trace_args(parser)
+
+    args = parser.parse_args()
+    tracing.start(args.trace)
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    watches = [Watch(**watch) for watch in config['watches']]
+    settle_time = config.get('settle_time', SETTLE_TIME)
+    poll_interval = config.get('poll_interval', POLL_INTERVAL)
+
+    conn = connect(args.state)
+    watcher = None if args.poll else Inotify.create([watch.path for watch in watches])
+    if watcher is None:
+        watcher = Poller([watch.path for watch in watches])
+        print(f"Polling {len(watches)} directories every {poll_interval} seconds")
+    else:
+        print(f"Watching {len(watches)} directories with inotify")
+
+    with JobRunner(cpu=args.jobs, retries=args.retries, log_dir=args.log_dir) as runner:
+        try:
+            run(watches, watcher, conn, runner, settle_time, poll_interval)
+        except KeyboardInterrupt:
+            print("\nStopping...")
+            runner.cancel()
+
+
+class Watch:
+    """
+    A watched directory and the pipeline of media-utils commands that each new file matching patterns is passed to.
+
+    Each step of the pipeline is a list of arguments to media-utils, where {file}, {dir}, {name} and {stem} are replaced
+    with the path of the new file, its directory, its file name and its file name without the extension. Steps are run
+    in order from the directory of the file, and the pipeline stops at the first step that fails.
+    """
+
+    def __init__(self, path, pipeline, patterns=("*.mkv",), ignore=()):
+        self.path = Path(path).resolve()
+        self.pipeline = pipeline
+        self.patterns = patterns
+        self.ignore = ignore
+        for step in pipeline:
+            if step[0].replace('-', '_') not in media_utils.SUBCOMMANDS:
+                raise ValueError(f"Unknown command in pipeline for {path}: {step[0]}")
+
+    def matches(self, path):
+        return (
+            path.parent == self.path
+            and any(fnmatch.fnmatch(path.name, pattern) for pattern in self.patterns)
+            and not any(fnmatch.fnmatch(path.name, pattern) for pattern in self.ignore)
+        )
+
+    def commands(self, path):
+        fields = {'file': str(path), 'dir': str(path.parent), 'name': path.name, 'stem': path.stem}
+        return [[sys.executable, MEDIA_UTILS, *(arg.format(**fields) for arg in step)] for step in self.pipeline]
+
+
+def run(watches, watcher, conn, runner, settle_time, poll_interval):
+    """
+    Dispatch files to their pipelines once their size and mtime have not changed for settle_time seconds.
+    Files are debounced here, while the pipelines run on the runner and report back through a queue so that the state
+    database is only used from this thread.
+    """
+    pending = {}
+    in_flight = set()
+    results = queue.Queue()
+
+    def consider(path):
+        if path in in_flight or path in pending:
+            return
+        watch = next((watch for watch in watches if watch.matches(path)), None)
+        if watch is None:
+            return
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return
+        if is_processed(conn, path, stat.st_size, stat.st_mtime):
+            return
+        pending[path] = (watch, stat.st_size, stat.st_mtime, time.monotonic())
+
+    for watch in watches:
+        for path in sorted(watch.path.iterdir()):
+            consider(path)
+
+    while True:
+        for path in watcher.changed(poll_interval):
+            consider(path)
+
+        while not results.empty():
+            path, size, mtime, error = results.get()
+            in_flight.discard(path)
+            record(conn, path, size, mtime, error)
+            print(f"Failed {path.name}: {error}" if error else f"Finished {path.name}")
+
+        now = time.monotonic()
+        for path, (watch, size, mtime, stable_since) in list(pending.items()):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                del pending[path]
+                continue
+
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                # Still being written
+                pending[path] = (watch, stat.st_size, stat.st_mtime, now)
+            elif now - stable_since >= settle_time:
+                del pending[path]
+                in_flight.add(path)
+                record(conn, path, size, mtime, status='running')
+                print(f"Processing {path.name}")
+                runner.submit(path.name, run_pipeline, runner, watch, path, size, mtime, results)
+
+
+def run_pipeline(runner, watch, path, size, mtime, results):
+    error = None
+    try:
+        for cmd in watch.commands(path):
+            runner.run(cmd, [CPU], label=cmd[2], cwd=path.parent)
+    except subprocess.CalledProcessError as e:
+        error = f"{e.cmd[2]} exited with status {e.returncode}"
+    except Exception as e:
+        error = repr(e)
+    finally:
+        # Steps may edit the file in place, record its final state so that it is not picked up again
+        try:
+            stat = path.stat()
+            size, mtime = stat.st_size, stat.st_mtime
+        except FileNotFoundError:
+            pass
+        results.put((path, size, mtime, error))
+
+
+def connect(path=STATE_PATH):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(SCHEMA)
+    return conn
+
+
+def is_processed(conn, path, size, mtime):
+    """
+    Check whether a file has already been through its pipeline, successfully or not, since it was last changed.
+    Files left running when the daemon was stopped are processed again.
+    """
+    row = conn.execute(
+        "SELECT 1 FROM files WHERE path = ? AND size = ? AND mtime = ? AND status != 'running'", (str(path), size, mtime)
+    ).fetchone()
+    return row is not None
+
+
+def record(conn, path, size, mtime, error=None, status=None):
+    if status is None:
+        status = 'failed' if error else 'done'
+    conn.execute(
+        "INSERT OR REPLACE INTO files (path, size, mtime, status, updated_at, error) VALUES (?, ?, ?, ?, ?, ?)",
+        (str(path), size, mtime, status, time.time(), error)
+    )
+
+
+class Poller:
+    """
+    Report every file in the watched directories each poll interval.
+    """
+
+    def __init__(self, dirs):
+        self.dirs = dirs
+
+    def changed(self, timeout):
+        time.sleep(timeout)
+        paths = []
+        for directory in self.dirs:
+            with os.scandir(directory) as it:
+                paths.extend(Path(entry.path) for entry in it if entry.is_file())
+        return paths
+
+
+class Inotify:
+    """
+    Report files created, written to or moved into the watched directories using Linux's inotify.
+    """
+
+    def __init__(self, libc, fd, dirs):
+        self.libc = libc
+        self.fd = fd
+        self.dirs = {}
+        self.poller = Poller(dirs)
+        for directory in dirs:
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory), IN_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"Could not watch {directory}")
+            self.dirs[wd] = Path(directory)
+
+    @classmethod
+    def create(cls, dirs):
+        """
+        Return an Inotify watcher for dirs, or None if inotify is not available.
+        """
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            try:
+                return cls(libc, fd, dirs)
+            except:
+                # Close the descriptor if a directory could not be watched, it is kept open by the watcher otherwise
+                os.close(fd)
+                raise
+        except (AttributeError, OSError) as e:
+            print(f"inotify is not available, falling back to polling: {e}")
+            return None
+
+    def changed(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset + IN_EVENT.size <= len(data):
+            wd, mask, _, length = IN_EVENT.unpack_from(data, offset)
+            name = data[offset + IN_EVENT.size:offset + IN_EVENT.size + length].rstrip(b"\0")
+            offset += IN_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, fall back to listing everything
+                return self.poller.changed(0)
+            if name and wd in self.dirs:
+                paths.append(self.dirs[wd] / os.fsdecode(name))
+        return paths
+
+
+if __name__ == "__main__":
+    main()